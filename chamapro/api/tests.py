@@ -1,3 +1,105 @@
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from chama.models import Chama
+from payments.models import MpesaTransaction
+from payments.rollups import record_created
 
-# Create your tests here.
+User = get_user_model()
+
+
+class ContributionHistoryTests(TestCase):
+    def setUp(self):
+        self.member = User.objects.create_user(username='member', email='member@example.com', password='pw')
+        self.chama = Chama.objects.create(
+            name='History Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.member,
+        )
+        self.chama.members.add(self.member)
+        self.client.force_login(self.member)
+        self.url = reverse('api:chama_contributions', kwargs={'chama_id': self.chama.pk})
+
+    def add_contributions(self, count):
+        start = MpesaTransaction.objects.count()
+        MpesaTransaction.objects.bulk_create([
+            MpesaTransaction(
+                user=self.member, chama=self.chama, merchant_request_id='m',
+                checkout_request_id=f'ws_{i}', amount=100, phone_number='254700000000',
+                status='SUCCESS', receipt_number=f'R{i}',
+            )
+            for i in range(start, start + count)
+        ])
+        # Several rows per timestamp so the id tie-breaker is exercised
+        base = timezone.now()
+        for t in MpesaTransaction.objects.filter(chama=self.chama):
+            MpesaTransaction.objects.filter(pk=t.pk).update(transaction_date=base - timedelta(minutes=t.pk // 3))
+
+    def test_cursor_walks_every_contribution_once_in_order(self):
+        self.add_contributions(60)
+        seen, cursor = [], None
+        while True:
+            data = self.client.get(self.url, {'cursor': cursor or '', 'limit': 25}).json()
+            seen.extend(c['id'] for c in data['results'])
+            cursor = data['next']
+            if not cursor:
+                break
+        expected = list(
+            MpesaTransaction.objects.filter(chama=self.chama).order_by('-transaction_date', '-id').values_list('id', flat=True)
+        )
+        self.assertEqual(seen, expected)
+
+    def test_invalid_cursor_is_rejected(self):
+        self.assertEqual(self.client.get(self.url, {'cursor': 'not-a-cursor'}).status_code, 400)
+
+    def test_detail_page_cost_does_not_grow_with_history(self):
+        detail = reverse('chama:chama_detail', kwargs={'slug': self.chama.slug, 'pk': self.chama.pk})
+        self.add_contributions(5)
+        self.client.get(detail)
+        with CaptureQueriesContext(connection) as short:
+            self.client.get(detail)
+        self.add_contributions(200)
+        with CaptureQueriesContext(connection) as long:
+            response = self.client.get(detail)
+        self.assertEqual(len(short.captured_queries), len(long.captured_queries))
+        self.assertEqual(len(response.context['contributions']), 25)
+        self.assertIsNotNone(response.context['next_cursor'])
+
+
+class DashboardChartsCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='charts', email='charts@example.com', password='pw')
+        self.other = User.objects.create_user(username='other', email='other@example.com', password='pw')
+        self.client.force_login(self.user)
+        self.url = reverse('api:dashboard_charts')
+
+    def create_transaction(self, user, i):
+        with self.captureOnCommitCallbacks(execute=True):
+            record_created([MpesaTransaction.objects.create(
+                user=user, merchant_request_id='m', checkout_request_id=f'charts_{i}',
+                amount=100, phone_number='254700000000',
+            )])
+
+    def test_repeat_requests_revalidate_without_touching_rollups(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        with CaptureQueriesContext(connection) as ctx:
+            second = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 304)
+        self.assertFalse(any('transactionrollup' in q['sql'] for q in ctx.captured_queries))
+
+    def test_version_moves_only_with_the_users_own_transactions(self):
+        etag = self.client.get(self.url)['ETag']
+        self.create_transaction(self.other, 1)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.create_transaction(self.user, 2)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['distribution'], {'labels': ['PENDING'], 'data': [1]})
@@ -5,4 +5,6 @@ app_name = 'api'
 
 urlpatterns = [
     path('charts/dashboard/', views.dashboard_charts, name='dashboard_charts'),
+    path('chamas/search/', views.chama_search, name='chama_search'),
+    path('chamas/<uuid:chama_id>/contributions/', views.chama_contributions, name='chama_contributions'),
 ]
@@ -1,53 +1,83 @@
-from django.http import JsonResponse
+import json
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.http import etag
 from django.contrib.auth.decorators import login_required
-from django.db.models import Sum, Count
-from django.db.models.functions import TruncMonth
+from django.db.models import Sum
 from django.utils import timezone
 from datetime import timedelta
-from payments.models import MpesaTransaction
+from payments.models import TransactionRollup
+from payments.history import PAGE_SIZE, MAX_PAGE_SIZE, contribution_page, serialize_contribution
+from chama.caching import CHARTS_TIMEOUT, charts_version
+from chama import search
+from chama.membership import MEMBER, chama_access
+
+def _chart_window():
+    """First month of the six-month trend window"""
+    return timezone.localdate(timezone.now() - timedelta(days=180)).replace(day=1)
+
+
+def _charts_etag(request):
+    # The window moves at month boundaries, so it is part of the version too
+    if not request.user.is_authenticated:
+        return None
+    request._charts_version = f"{charts_version(request.user.pk)}.{_chart_window():%Y%m}"
+    return f"charts-{request._charts_version}"
+
 
 @login_required
+@etag(_charts_etag)
 def dashboard_charts(request):
     """
     Returns JSON data for dashboard charts:
     1. Monthly contributions trend (Last 6 months)
     2. Transaction status distribution (Success vs Failed vs Pending)
+
+    The serialized response is cached per user under a version that moves
+    only when one of their transactions changes; browsers revalidate with
+    If-None-Match and get a 304 while it holds.
     """
-    # Calculate date 6 months ago to filter recent data
-    six_months_ago = timezone.now() - timedelta(days=180)
-    
+    key = f"charts:data:{request.user.pk}:{request._charts_version}"
+    body = cache.get(key)
+    if body is None:
+        body = json.dumps(_chart_data(request.user))
+        cache.set(key, body, CHARTS_TIMEOUT)
+    response = HttpResponse(body, content_type='application/json')
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def _chart_data(user):
+    # Both charts read the monthly rollup, so cost does not grow with history
+    rollups = TransactionRollup.objects.filter(user=user)
+
     # --- Chart 1: Monthly Contributions Trend ---
-    # Filter for successful contributions by the logged-in user
-    contributions = MpesaTransaction.objects.filter(
-        user=request.user,
-        transaction_type='CONTRIBUTION',
-        status='SUCCESS',
-        transaction_date__gte=six_months_ago
-    ).annotate(
-        month=TruncMonth('transaction_date')
+    # Successful contributions by the logged-in user
+    contributions = rollups.filter(
+        month__gte=_chart_window(),
+        contribution_count__gt=0
     ).values('month').annotate(
-        total=Sum('amount')
+        total=Sum('contribution_total')
     ).order_by('month')
     
     trend_labels = []
     trend_data = []
     
     for entry in contributions:
-        if entry['month']:
-            trend_labels.append(entry['month'].strftime('%b %Y'))
-            trend_data.append(float(entry['total'] or 0))
+        trend_labels.append(entry['month'].strftime('%b %Y'))
+        trend_data.append(float(entry['total'] or 0))
             
     # --- Chart 2: Transaction Status Distribution ---
-    status_counts = MpesaTransaction.objects.filter(
-        user=request.user
-    ).values('status').annotate(
-        count=Count('id')
+    status_counts = rollups.aggregate(
+        SUCCESS=Sum('success_count'),
+        PENDING=Sum('pending_count'),
+        FAILED=Sum('failed_count'),
     )
     
-    status_labels = [entry['status'] for entry in status_counts]
-    status_data = [entry['count'] for entry in status_counts]
+    status_labels = [status for status, count in status_counts.items() if count]
+    status_data = [count for count in status_counts.values() if count]
         
-    return JsonResponse({
+    return {
         'trend': {
             'labels': trend_labels,
             'data': trend_data
@@ -56,4 +86,60 @@ def dashboard_charts(request):
             'labels': status_labels,
             'data': status_data
         }
+    }
+
+@login_required
+@chama_access(role=MEMBER)
+def chama_contributions(request, chama_id):
+    """
+    Infinite-scroll feed of a chama's successful contributions.
+    Pass the previous response's `next` cursor as ?cursor= to get the next page.
+    """
+    try:
+        limit = min(max(int(request.GET.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        contributions, next_cursor = contribution_page(request.chama, request.GET.get('cursor'), limit)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({
+        'results': [serialize_contribution(t) for t in contributions],
+        'next': next_cursor,
+    })
+
+
+def chama_search(request):
+    """
+    Public directory search. ?q= matches name, excerpt and description,
+    best match first (newest first without a query); county, constituency
+    and frequency may repeat, and contribution takes a MIN-MAX range in KSh.
+    Each facet's counts leave out its own filter, so alternatives stay visible.
+    """
+    try:
+        filters = search.parse_filters(request.GET)
+        page = int(request.GET.get('page', 1))
+        page_size = int(request.GET.get('page_size', search.PAGE_SIZE))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    found = search.search(request.GET.get('q', ''), filters, page, page_size)
+    response = JsonResponse({
+        'results': [
+            {
+                'id': str(chama.pk),
+                'name': chama.name,
+                'url': chama.get_absolute_url(),
+                'excerpt': chama.excerpt,
+                'county': chama.county,
+                'constituency': chama.constituency,
+                'frequency': chama.contribution_frequency,
+                'contribution': str(chama.monthly_contribution),
+            }
+            for chama in found['results']
+        ],
+        'total': found['total'],
+        'page': found['page'],
+        'pages': found['pages'],
+        'facets': found['facets'],
     })
+    response['Cache-Control'] = 'public, max-age=60'
+    return response
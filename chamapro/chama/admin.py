@@ -1,8 +1,120 @@
+import json
 from django.contrib import admin
-from .models import Chama, Investment, Loan
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
+from payments.disbursements import fail_loan
+from .models import BalanceSnapshot, Chama, ContributionObligation, Investment, LedgerEntry, Loan, RequestProfile
 
 
 # Register your models here.
 admin.site.register(Chama)
 admin.site.register(Investment)
-admin.site.register(Loan)
\ No newline at end of file
+
+
+@admin.register(Loan)
+class LoanAdmin(admin.ModelAdmin):
+    list_display = ['borrower', 'chama', 'amount', 'status', 'action_date', 'conversation_id', 'failure_reason']
+    list_filter = ['status']
+    search_fields = ['conversation_id', 'receipt_number', 'borrower__username']
+    raw_id_fields = ['chama', 'borrower', 'action_by']
+    actions = ['fail_disbursement']
+
+    @admin.action(description="Mark disbursement failed and refund the chama balance")
+    def fail_disbursement(self, request, queryset):
+        # For DISBURSING loans whose B2C request timed out and never paid out
+        failed = sum(fail_loan(loan_id, "Marked failed by staff") for loan_id in queryset.values_list('id', flat=True))
+        self.message_user(request, f"{failed} loan(s) marked failed.")
+
+
+@admin.register(ContributionObligation)
+class ContributionObligationAdmin(admin.ModelAdmin):
+    list_display = ['chama', 'user', 'period_start', 'due_date', 'expected_amount', 'paid_amount', 'status']
+    list_filter = ['status', 'period_start']
+    raw_id_fields = ['chama', 'user']
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    """Append-only: entries can be added (e.g. an ADJUSTMENT) but never edited or deleted"""
+    list_display = ['created_at', 'chama', 'kind', 'amount', 'reference']
+    list_filter = ['kind']
+    search_fields = ['reference']
+    raw_id_fields = ['chama']
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(BalanceSnapshot)
+class BalanceSnapshotAdmin(admin.ModelAdmin):
+    list_display = ['as_of', 'chama', 'balance', 'entry_count', 'last_entry_id']
+    raw_id_fields = ['chama']
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    """Read-only: profiles are written by chamapro.profiling and can be downloaded or deleted"""
+    list_display = [
+        'created_at', 'method', 'path', 'view_name', 'status_code', 'trigger',
+        'duration_ms', 'sql_count', 'sql_ms', 'template_ms', 'gateway_ms', 'samples',
+    ]
+    list_filter = ['trigger', 'view_name', 'status_code']
+    search_fields = ['path', 'view_name']
+    exclude = ['collapsed', 'report']
+    readonly_fields = ['downloads', 'summary']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/collapsed/', self.admin_site.admin_view(self.download_collapsed),
+                 name='chama_requestprofile_collapsed'),
+            path('<int:pk>/report/', self.admin_site.admin_view(self.download_report),
+                 name='chama_requestprofile_report'),
+        ] + super().get_urls()
+
+    def _download(self, request, pk, content, content_type, extension):
+        if not self.has_view_permission(request):
+            return HttpResponse(status=403)
+        response = HttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="profile-{pk}.{extension}"'
+        return response
+
+    def download_collapsed(self, request, pk):
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        return self._download(request, pk, profile.collapsed, 'text/plain; charset=utf-8', 'collapsed.txt')
+
+    def download_report(self, request, pk):
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        return self._download(request, pk, json.dumps(profile.report, indent=2), 'application/json', 'json')
+
+    @admin.display(description='Downloads')
+    def downloads(self, obj):
+        return format_html(
+            '<a href="{}">Collapsed stacks</a> (for flamegraph.pl or speedscope) &middot; <a href="{}">JSON report</a>',
+            reverse('admin:chama_requestprofile_collapsed', args=[obj.pk]),
+            reverse('admin:chama_requestprofile_report', args=[obj.pk]),
+        )
+
+    @admin.display(description='Report')
+    def summary(self, obj):
+        sql = obj.report.get('sql', {})
+        return format_html(
+            '<pre style="white-space: pre-wrap">{}</pre>',
+            json.dumps({
+                'repeated_sql': sql.get('repeated', []),
+                'slowest_sql': sorted(sql.get('queries', []), key=lambda q: q['ms'], reverse=True)[:10],
+                'templates': obj.report.get('templates', []),
+                'gateway': obj.report.get('gateway', []),
+                'top_frames': obj.report.get('top_frames', []),
+            }, indent=2),
+        )
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class ChamaConfig(AppConfig):
     name = 'chama'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,183 @@
+"""
+Query budgets and latency for the main pages, over fixtures of three sizes.
+
+`manage.py bench_views` loads each fixture, requests every page in VIEWS
+through the test client and compares its query count and p95 latency with
+the baselines committed in benchmarks.json; ViewBudgetTests checks the
+query counts of the small fixture on every test run. Budgets are the same
+at every size: a page whose query count grows with the data has an N+1.
+"""
+import json
+import time
+from datetime import timedelta
+from decimal import Decimal
+from pathlib import Path
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from chamapro.bench import percentile
+from chamapro.metrics import QueryTimer
+from payments.models import MpesaTransaction
+from payments.rollups import rebuild_rollups
+from . import ledger
+from .models import Chama, LedgerEntry, Loan
+
+User = get_user_model()
+Membership = Chama.members.through
+
+BASELINES = Path(__file__).with_name('benchmarks.json')
+
+# chamas the measured user belongs to, members per chama, months of contributions
+SCALES = {
+    'small': {'chamas': 2, 'members': 10, 'months': 3, 'loans': 2},
+    'medium': {'chamas': 10, 'members': 100, 'months': 6, 'loans': 10},
+    'large': {'chamas': 25, 'members': 1000, 'months': 12, 'loans': 50},
+}
+
+# name -> URL for a fixture; the chama pages use its first (largest history) chama
+VIEWS = {
+    'dashboard_view': lambda fixture: reverse('chama:dashboard'),
+    'chama_detail_view': lambda fixture: reverse('chama:chama_detail', args=[fixture['chama'].slug, fixture['chama'].pk]),
+    'list_members': lambda fixture: reverse('chama:members_list', args=[fixture['chama'].slug, fixture['chama'].pk]),
+    'profile_view': lambda fixture: reverse('chama:profile'),
+    'dashboard_charts': lambda fixture: reverse('api:dashboard_charts'),
+}
+
+# Every page is measured cold against a per-process cache, so counts do not
+# depend on CACHE_BACKEND (the database cache would add its own queries)
+MEASURE_CACHES = {
+    'default': {'BACKEND': 'chamapro.cache.LocMemCache', 'LOCATION': 'view-benchmarks'},
+    'mpesa': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'view-benchmarks-mpesa'},
+}
+
+
+def build_fixture(scale):
+    """
+    Deterministic data for `scale`: a chama admin who belongs to every chama,
+    members shared between the chamas, a SUCCESS contribution per member,
+    chama and month (plus the odd FAILED one), loans, ledger entries folded
+    into snapshots, and rebuilt rollups. Returns {'user', 'chama'}.
+    """
+    size = SCALES[scale]
+    password = make_password(None)
+    owner = User.objects.create(
+        username=f'{scale}-admin', email=f'{scale}-admin@example.com', password=password, phone_number='254700000000',
+    )
+    members = User.objects.bulk_create(
+        [User(username=f'{scale}-m{i}', email=f'{scale}-m{i}@example.com', password=password,
+              phone_number=f'2547{i:08d}') for i in range(size['members'])],
+        batch_size=1000,
+    )
+    chamas = Chama.objects.bulk_create([
+        Chama(name=f'{scale.title()} Chama {i}', slug=f'{scale}-chama-{i}', county='Nairobi',
+              phone='254700000000', monthly_contribution=500, created_by=owner)
+        for i in range(size['chamas'])
+    ])
+    user_field = Chama.members.field.m2m_reverse_field_name()
+    Membership.objects.bulk_create(
+        [Membership(chama_id=chama.id, **{user_field: user}) for chama in chamas for user in [owner, *members]],
+        batch_size=5000,
+    )
+
+    now = timezone.now()
+    for month in range(size['months']):
+        rows, entries = [], []
+        for c, chama in enumerate(chamas):
+            for m, user in enumerate([owner, *members]):
+                reference = f'{scale}-{month}-{c}-{m}'
+                failed = (m + month) % 10 == 9
+                rows.append(MpesaTransaction(
+                    user=user, chama=chama, merchant_request_id='bench', checkout_request_id=reference,
+                    amount=500, phone_number=user.phone_number, status='FAILED' if failed else 'SUCCESS',
+                    receipt_number=None if failed else reference.upper(),
+                ))
+                if not failed:
+                    entries.append(LedgerEntry(chama=chama, kind='CONTRIBUTION', amount=500, reference=f'mpesa:{reference}'))
+        MpesaTransaction.objects.bulk_create(rows, batch_size=5000)
+        LedgerEntry.objects.bulk_create(entries, batch_size=5000)
+        # transaction_date is auto_now_add: date each month's batch afterwards
+        MpesaTransaction.objects.filter(checkout_request_id__startswith=f'{scale}-{month}-').update(
+            transaction_date=now - timedelta(days=30 * month)
+        )
+
+    loans = Loan.objects.bulk_create([
+        Loan(chama=chamas[i % len(chamas)], borrower=members[i % len(members)], amount=Decimal(1000 + i),
+             status='APPROVED' if i % 2 else 'PENDING')
+        for i in range(size['loans'])
+    ])
+    ledger.record([(loan.chama_id, 'DISBURSEMENT', -loan.amount, f'loan:{loan.id}') for loan in loans if loan.status == 'APPROVED'])
+    ledger.take_snapshots(lag=timedelta(0))
+    rebuild_rollups()
+    return {'user': owner, 'chama': chamas[0]}
+
+
+def measure(fixture, iterations=10, views=None):
+    """
+    {view: {queries, db_ms, p50_ms, p95_ms}} for the fixture's user, every
+    request made with a cold cache. Raises AssertionError on a non-200.
+    """
+    results = {}
+    with override_settings(CACHES=MEASURE_CACHES, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        client = Client()
+        client.force_login(fixture['user'])
+        for name in views or VIEWS:
+            url = VIEWS[name](fixture)
+            timings, queries, db_seconds = [], [], []
+            client.get(url)  # compile templates and fill the session cache outside the figures
+            for _ in range(max(iterations, 1)):
+                cache.clear()
+                timer = QueryTimer()
+                start = time.perf_counter()
+                with connection.execute_wrapper(timer):
+                    response = client.get(url)
+                timings.append((time.perf_counter() - start) * 1000)
+                assert response.status_code == 200, f"{name}: HTTP {response.status_code}"
+                queries.append(timer.queries)
+                db_seconds.append(timer.seconds * 1000)
+            results[name] = {
+                'queries': max(queries),
+                'db_ms': round(percentile(db_seconds, 50), 2),
+                'p50_ms': round(percentile(timings, 50), 2),
+                'p95_ms': round(percentile(timings, 95), 2),
+            }
+    return results
+
+
+def load_baselines():
+    """{scale: {view: {queries, p95_ms}}} as committed"""
+    return json.loads(BASELINES.read_text())
+
+
+def save_baselines(results):
+    """Replace the baselines of the measured scales and views, keeping the rest"""
+    baselines = load_baselines() if BASELINES.exists() else {}
+    for scale, views in results.items():
+        for view, r in views.items():
+            baselines.setdefault(scale, {})[view] = {'queries': r['queries'], 'p95_ms': r['p95_ms']}
+    BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+
+
+def over_budget(scale, results, baselines, latency_tolerance=None):
+    """
+    Messages for every view above its baseline: any extra query, or a p95
+    more than `latency_tolerance` (a fraction, None to skip) above it.
+    """
+    problems = []
+    for view, result in results.items():
+        budget = baselines.get(scale, {}).get(view)
+        if budget is None:
+            problems.append(f"{scale}/{view}: no baseline (run bench_views --update-baselines)")
+            continue
+        if result['queries'] > budget['queries']:
+            problems.append(f"{scale}/{view}: {result['queries']} queries, budget {budget['queries']}")
+        if latency_tolerance is not None and result['p95_ms'] > budget['p95_ms'] * (1 + latency_tolerance):
+            problems.append(
+                f"{scale}/{view}: p95 {result['p95_ms']:.1f}ms, budget {budget['p95_ms']:.1f}ms "
+                f"+{latency_tolerance:.0%}"
+            )
+    return problems
@@ -0,0 +1,38 @@
+# chama/caching.py
+"""Per-user cache versions for rendered dashboard fragments and chart data, and the public directory's"""
+from chamapro.cache import CacheNamespace
+
+DASHBOARD_TIMEOUT = 600
+CHARTS_TIMEOUT = 60 * 60 * 24
+DIRECTORY_TIMEOUT = 60 * 15
+# Bulk loads skip the signals that move the directory version; a day bounds how stale they leave the sitemap
+SITEMAP_TIMEOUT = 60 * 60 * 24
+
+# `manage.py invalidate_cache dashboard` (or `charts`) drops every user's entries at once
+dashboards = CacheNamespace('dashboard')
+charts = CacheNamespace('charts')
+# Everything derived from the public chama listing (search counts, sitemap); moves when a public chama changes
+directory = CacheNamespace('directory')
+
+
+def dashboard_version(user_id):
+    """Current fragment version for the user; part of every dashboard cache key"""
+    return f"{dashboards.version()}.{dashboards.item_version(user_id)}"
+
+
+def invalidate_dashboards(user_ids):
+    """Bump the version so the users' cached dashboard fragments are skipped"""
+    dashboards.touch(user_ids)
+
+
+def charts_version(user_id):
+    """Changes whenever one of the user's transactions is created or settled"""
+    return f"{charts.version()}.{charts.item_version(user_id)}"
+
+
+def invalidate_charts(user_ids):
+    charts.touch(user_ids)
+
+
+def invalidate_directory():
+    directory.invalidate()
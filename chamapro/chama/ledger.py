@@ -0,0 +1,135 @@
+"""
+Chama balances from the append-only ledger.
+
+Money movements are inserted as LedgerEntry rows; nothing updates a shared
+balance row, so concurrent callbacks and loan approvals do not contend.
+`snapshot_balances` periodically folds the entries into a BalanceSnapshot,
+and a balance is the latest snapshot plus the short tail of entries after it.
+Snapshots are cut by entry id, which only grows: an entry committed after
+a snapshot with an earlier created_at is still in the tail, not lost.
+"""
+from datetime import timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.db.models import BigIntegerField, Count, DecimalField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import BalanceSnapshot, Chama, LedgerEntry
+
+ZERO = Decimal('0')
+CHUNK = 500  # ids per IN (...) list
+
+
+def record(entries):
+    """
+    Append (chama_id, kind, amount, reference) tuples in one INSERT. Call it
+    inside the transaction that moves the money, so both commit together.
+    """
+    return LedgerEntry.objects.bulk_create(
+        [LedgerEntry(chama_id=c, kind=kind, amount=amount, reference=ref) for c, kind, amount, ref in entries],
+        batch_size=500,
+    )
+
+
+def record_investment(investment, deleted=False):
+    """
+    Bring the investment's INVESTMENT entries to minus its amount (zero once
+    deleted) by appending the difference, so edits leave a trail. Call it
+    inside the transaction that saves or deletes it, holding the chama row.
+    """
+    reference = f"investment:{investment.pk}"
+    recorded = LedgerEntry.objects.filter(
+        chama_id=investment.chama_id, kind='INVESTMENT', reference__startswith=f"{reference}:"
+    ).aggregate(total=Sum('amount'), count=Count('id'))
+    change = (ZERO if deleted else -investment.amount) - (recorded['total'] or ZERO)
+    if change:
+        record([(investment.chama_id, 'INVESTMENT', change, f"{reference}:{recorded['count'] + 1}")])
+    return change
+
+
+def _latest_snapshot(chama_id, at=None):
+    snapshots = BalanceSnapshot.objects.filter(chama_id=chama_id)
+    if at is not None:
+        snapshots = snapshots.filter(as_of__lte=at)
+    return snapshots.order_by('-as_of').first()
+
+
+def balance(chama_id, at=None):
+    """The chama's balance now, or as it stood at `at`: a snapshot plus the entries after it"""
+    snapshot = _latest_snapshot(chama_id, at)
+    tail = LedgerEntry.objects.filter(chama_id=chama_id)
+    if snapshot is not None:
+        tail = tail.filter(id__gt=snapshot.last_entry_id)
+    if at is not None:
+        tail = tail.filter(created_at__lte=at)
+    total = tail.aggregate(total=Sum('amount'))['total'] or ZERO
+    return (snapshot.balance if snapshot else ZERO) + total
+
+
+def balance_expression(chama_ref='pk'):
+    """
+    Live balance as an expression for Chama querysets (or any queryset with
+    `chama_ref` pointing at a chama), so lists need no query per chama.
+    """
+    money = DecimalField(max_digits=14, decimal_places=2)
+    latest = BalanceSnapshot.objects.filter(chama_id=OuterRef(chama_ref)).order_by('-as_of')
+    tail = LedgerEntry.objects.filter(
+        chama_id=OuterRef(chama_ref),
+        id__gt=Coalesce(
+            Subquery(BalanceSnapshot.objects.filter(chama_id=OuterRef(OuterRef(chama_ref))).order_by('-as_of').values('last_entry_id')[:1]),
+            Value(0), output_field=BigIntegerField(),
+        ),
+    ).values('chama_id').annotate(total=Sum('amount')).values('total')
+    return (
+        Coalesce(Subquery(latest.values('balance')[:1]), Value(ZERO), output_field=money)
+        + Coalesce(Subquery(tail), Value(ZERO), output_field=money)
+    )
+
+
+def take_snapshots(lag=None, now=None):
+    """
+    Snapshot every chama with entries since its last snapshot, up to the
+    last entry created `lag` ago: newer ones may still have earlier ids in
+    open transactions. Also copies the balances to Chama.total_balance.
+    Returns the number of snapshots written.
+    """
+    if lag is None:
+        lag = timedelta(seconds=getattr(settings, 'LEDGER_SNAPSHOT_LAG', 60))
+    as_of = (now or timezone.now()) - lag
+    # Walks the primary key back over the last `lag` of entries only
+    cut = LedgerEntry.objects.filter(created_at__lte=as_of).order_by('-id').values_list('id', flat=True).first()
+    if cut is None:
+        return 0
+    # The latest snapshot of every chama: one index probe per chama
+    latest = BalanceSnapshot.objects.filter(chama_id=OuterRef('pk')).order_by('-as_of').values('id')[:1]
+    last_ids = dict(Chama.objects.annotate(last_snapshot=Subquery(latest)).values_list('id', 'last_snapshot'))
+    previous = {}
+    snapshot_ids = [i for i in last_ids.values() if i]
+    for i in range(0, len(snapshot_ids), CHUNK):
+        for snapshot in BalanceSnapshot.objects.filter(id__in=snapshot_ids[i:i + CHUNK]):
+            previous[snapshot.chama_id] = snapshot
+
+    # Snapshots taken together share as_of and the cut: one grouped SUM per starting point and chunk of chamas
+    starts = {}
+    for chama_id in last_ids:
+        prev = previous.get(chama_id)
+        starts.setdefault(prev.last_entry_id if prev else 0, []).append(chama_id)
+
+    snapshots = []
+    for start, chama_ids in starts.items():
+        if start >= cut:
+            continue
+        for i in range(0, len(chama_ids), CHUNK):
+            entries = LedgerEntry.objects.filter(chama_id__in=chama_ids[i:i + CHUNK], id__gt=start, id__lte=cut)
+            totals = entries.values('chama_id').annotate(total=Sum('amount'), count=Count('id'))
+            for chama_id, total, count in totals.values_list('chama_id', 'total', 'count'):
+                prev = previous.get(chama_id)
+                snapshots.append(BalanceSnapshot(
+                    chama_id=chama_id, as_of=as_of, last_entry_id=cut,
+                    balance=(prev.balance if prev else ZERO) + total, entry_count=count,
+                ))
+    BalanceSnapshot.objects.bulk_create(snapshots, batch_size=500)
+
+    chamas = [Chama(id=s.chama_id, total_balance=s.balance) for s in snapshots]
+    Chama.objects.bulk_update(chamas, ['total_balance'], batch_size=500)
+    return len(snapshots)
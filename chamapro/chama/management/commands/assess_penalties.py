@@ -0,0 +1,31 @@
+import time
+from datetime import date
+from django.core.management.base import BaseCommand
+from chama.penalties import assess_penalties
+
+
+class Command(BaseCommand):
+    help = "Nightly job: penalise members of due chamas who have not contributed for the period"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=date.fromisoformat, help='Assess as of this day (YYYY-MM-DD); defaults to today')
+        parser.add_argument('--lookback-days', type=int, default=1,
+                            help='Also assess chamas whose grace period ended up to this many days ago (catch up missed runs)')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Chamas checked per grouped query')
+        parser.add_argument('--dry-run', action='store_true', help='Count penalties without creating them')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        stats = assess_penalties(
+            today=options['date'],
+            lookback_days=options['lookback_days'],
+            chunk_size=options['chunk_size'],
+            dry_run=options['dry_run'],
+        )
+        elapsed = time.perf_counter() - start
+        rate = stats['chamas'] / elapsed if elapsed else 0
+        verb = 'Would create' if options['dry_run'] else 'Created'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {stats['penalties']} penalties: {stats['chamas']} chamas / {stats['members']} members "
+            f"checked in {elapsed:.2f}s ({rate:,.0f} chamas/s)"
+        ))
@@ -0,0 +1,131 @@
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+from contextlib import redirect_stdout
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.sessions.backends.db import SessionStore as DBSessionStore
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, reset_queries
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from chamapro import cache as shared_cache
+from chamapro.bench import temporary_database
+from chama.models import Chama
+
+User = get_user_model()
+
+BACKENDS = {
+    'locmem': 'chamapro.cache.LocMemCache',
+    'file': 'chamapro.cache.FileBasedCache',
+    'db': 'chamapro.cache.DatabaseCache',
+}
+
+
+def _serve(session_keys):
+    """Worker process: replay its share of dashboard requests; return its counters"""
+    connections.close_all()  # never share the parent's sqlite handle
+    shared_cache.reset_stats()
+    client = Client(HTTP_HOST='localhost')
+    url = reverse('chama:dashboard')
+    queries = 0
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for key in session_keys:
+            client.cookies[settings.SESSION_COOKIE_NAME] = key
+            reset_queries()
+            with CaptureQueriesContext(connection) as ctx:
+                response = client.get(url)
+            assert response.status_code == 200, response.status_code
+            queries += len(ctx.captured_queries)
+    return {'elapsed': time.perf_counter() - start, 'queries': queries, 'stats': shared_cache.stats()}
+
+
+class Command(BaseCommand):
+    help = "Compare session and page-data cache hit rates across worker processes for each cache backend"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--requests', type=int, default=4000)
+        parser.add_argument('--backends', default='locmem,file,db', help=f"Comma-separated, from {', '.join(BACKENDS)}")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        workdir = tempfile.mkdtemp(prefix='chamapro_bench_cache_')
+        try:
+            with temporary_database(sqlite_file=os.path.join(workdir, 'bench.sqlite3')):
+                session_keys = self._seed(options['users'])
+                # Each request goes to whichever worker picks it up, as with gunicorn
+                stream = [rng.choice(session_keys) for _ in range(options['requests'])]
+                shares = [[] for _ in range(options['workers'])]
+                for key in stream:
+                    shares[rng.randrange(options['workers'])].append(key)
+
+                for backend in options['backends'].split(','):
+                    self._report(backend, len(stream), self._run(backend, shares, workdir))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _seed(self, count):
+        password = make_password(None)
+        users = User.objects.bulk_create(
+            [User(username=f'user{i}', email=f'user{i}@example.com', password=password) for i in range(count)]
+        )
+        for i in range(0, count, 5):
+            chama = Chama.objects.create(
+                name=f'Chama {i}', county='Nairobi', phone='254700000000',
+                monthly_contribution=500, created_by=users[i],
+            )
+            chama.members.add(*users[i:i + 5])
+        keys = []
+        for user in users:
+            # Written straight to the table: every backend starts with a cold cache
+            session = DBSessionStore()
+            session['_auth_user_id'] = str(user.pk)
+            session['_auth_user_backend'] = 'django.contrib.auth.backends.ModelBackend'
+            session['_auth_user_hash'] = user.get_session_auth_hash()
+            session.create()
+            keys.append(session.session_key)
+        return keys
+
+    def _run(self, backend, shares, workdir):
+        location = {
+            'locmem': 'bench',
+            'file': os.path.join(workdir, 'cache'),
+            'db': 'bench_cache',
+        }[backend]
+        cache_settings = dict(settings.CACHES, default={
+            'BACKEND': BACKENDS[backend],
+            'LOCATION': location,
+            'OPTIONS': {'MAX_ENTRIES': 50000},  # Django's 300 would cull sessions mid-run
+        })
+        with override_settings(CACHES=cache_settings):
+            if backend == 'db':
+                call_command('createcachetable', verbosity=0)
+            caches['default'].clear()
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(len(shares)) as pool:
+                return pool.map(_serve, shares)
+
+    def _report(self, backend, total, results):
+        def rate(*namespaces):
+            hits = sum(r['stats'].get(ns, {}).get('hits', 0) for r in results for ns in namespaces)
+            misses = sum(r['stats'].get(ns, {}).get('misses', 0) for r in results for ns in namespaces)
+            return 100 * hits / (hits + misses) if hits + misses else 0.0
+
+        elapsed = max(r['elapsed'] for r in results)
+        queries = sum(r['queries'] for r in results) / total
+        self.stdout.write(
+            f"{backend:<7} {len(results)} workers  sessions hit {rate('sessions'):5.1f}%  "
+            f"page data hit {rate('template', 'dashboard'):5.1f}%  "
+            f"{queries:4.1f} queries/request  {total / elapsed:6.0f} req/s"
+        )
@@ -0,0 +1,71 @@
+import time
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from chamapro.bench import percentile, temporary_database
+from chama.membership import resolve_chama
+from chama.models import Chama
+
+User = get_user_model()
+Membership = Chama.members.through
+
+
+class Command(BaseCommand):
+    help = "Benchmark the membership check: `user in chama.members.all()` vs resolve_chama"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000,5000', help='Comma-separated member counts to test')
+        parser.add_argument('--iterations', type=int, default=200, help='Checks per size and method')
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options['sizes'].split(',')]
+        with temporary_database():
+            password = make_password(None)
+            owner = User.objects.create(username='owner', email='owner@example.com', password=password)
+            users = User.objects.bulk_create(
+                [User(username=f'm{i}', email=f'm{i}@example.com', password=password) for i in range(max(sizes))],
+                batch_size=1000,
+            )
+            factory = RequestFactory()
+            user_field = Chama.members.field.m2m_reverse_field_name()
+            for size in sizes:
+                chama = Chama.objects.create(
+                    name=f'Bench {size}', county='Nairobi', phone='254700000000',
+                    monthly_contribution=500, created_by=owner,
+                )
+                Membership.objects.bulk_create(
+                    [Membership(chama_id=chama.id, **{user_field: u}) for u in users[:size]],
+                    batch_size=1000,
+                )
+                # The last member added is the worst case for a linear scan
+                user = users[size - 1]
+                request = factory.get('/')
+                request.user = user
+
+                def legacy():
+                    c = Chama.objects.get(id=chama.id, slug=chama.slug)
+                    return user == c.created_by or user in c.members.all()
+
+                def resolved():
+                    request.__dict__.pop('_chama_roles', None)
+                    return resolve_chama(request, id=chama.id, slug=chama.slug)[1] is not None
+
+                for label, check in (('members.all()', legacy), ('resolve_chama', resolved)):
+                    timings, queries = self._run(check, options['iterations'])
+                    self.stdout.write(
+                        f"{size:>6} members  {label:<14} p50 {percentile(timings, 50):7.3f}ms  "
+                        f"p95 {percentile(timings, 95):7.3f}ms  queries {queries}"
+                    )
+
+    def _run(self, check, iterations):
+        timings = []
+        with CaptureQueriesContext(connection) as ctx:
+            assert check()
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            check()
+            timings.append((time.perf_counter() - t0) * 1000)
+        return timings, len(ctx.captured_queries)
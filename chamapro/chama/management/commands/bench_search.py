@@ -0,0 +1,84 @@
+import random
+import time
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from django.utils import timezone
+from chamapro.bench import percentile, temporary_database
+from chama import search
+from chama.benchmarks import MEASURE_CACHES
+from chama.models import Chama
+from chama.seeding import CONTRIBUTIONS, COUNTIES, GROUP_WORDS, NAME_WORDS
+
+AREAS = ['Central', 'East', 'West', 'North', 'South']
+ACTIVITIES = ['table banking', 'land buying', 'poultry farming', 'school fees', 'merry-go-round', 'dairy goats']
+
+# label -> (query, filters)
+SCENARIOS = {
+    'browse': ('', {}),
+    'browse+county': ('', {'county': ['Nairobi']}),
+    'common word': ('group', {}),
+    'two words': ('umoja savings', {}),
+    'prefix': ('haramb', {}),
+    'word+facets': ('poultry', {'county': ['Kisumu'], 'frequency': ['WEEKLY'], 'contribution': [500, 2000]}),
+    'no match': ('zzzz', {}),
+}
+
+
+class Command(BaseCommand):
+    help = "Time directory search (ranked full-text plus facet counts), cold and cached, over a throwaway database of chamas"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chamas', type=int, default=100_000)
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=7)
+
+    def handle(self, *args, **options):
+        with temporary_database(), override_settings(CACHES=MEASURE_CACHES):
+            start = time.perf_counter()
+            self._seed(options['chamas'], random.Random(options['seed']))
+            indexed = search.rebuild_index()
+            self.stdout.write(f"{options['chamas']:,} chamas ({indexed:,} public) loaded and indexed "
+                              f"in {time.perf_counter() - start:.1f}s")
+
+            for label, (query, filters) in SCENARIOS.items():
+                cold, warm = [], []
+                for _ in range(options['iterations']):
+                    cache.clear()
+                    t0 = time.perf_counter()
+                    found = search.search(query, filters)
+                    cold.append((time.perf_counter() - t0) * 1000)
+                    t0 = time.perf_counter()
+                    search.search(query, filters)
+                    warm.append((time.perf_counter() - t0) * 1000)
+                self.stdout.write(
+                    f"{label:<14} {found['total']:>7,} hits  cold p50 {percentile(cold, 50):7.2f}ms "
+                    f"p95 {percentile(cold, 95):7.2f}ms  cached p50 {percentile(warm, 50):6.2f}ms "
+                    f"p95 {percentile(warm, 95):6.2f}ms"
+                )
+
+    def _seed(self, count, rng):
+        owner = get_user_model().objects.create(username='bench-search', email='bench-search@example.com')
+        now = timezone.now()
+        batch = []
+        for n in range(count):
+            name = f"{rng.choice(NAME_WORDS)} {rng.choice(GROUP_WORDS)} {n}"
+            county = rng.choice(COUNTIES)
+            activity = rng.choice(ACTIVITIES)
+            batch.append(Chama(
+                name=name, slug=f'bench-search-{n}', county=county,
+                constituency=f"{county} {rng.choice(AREAS)}",
+                excerpt=f"{activity.capitalize()} in {county}",
+                description=f"{name} meets to save, lend and invest in {activity} and "
+                            f"{rng.choice(ACTIVITIES)} around {county}.",
+                contribution_frequency='WEEKLY' if rng.random() < 0.3 else 'MONTHLY',
+                monthly_contribution=rng.choice(CONTRIBUTIONS + [10000, 20000]),
+                is_public=rng.random() < 0.6, phone='254700000000', created_by=owner,
+                created_at=now - timedelta(minutes=n),
+            ))
+            if len(batch) == 5000:
+                Chama.objects.bulk_create(batch)
+                batch = []
+        Chama.objects.bulk_create(batch)
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from chamapro.bench import temporary_database
+from chama.benchmarks import SCALES, VIEWS, build_fixture, load_baselines, measure, over_budget, save_baselines
+
+
+class Command(BaseCommand):
+    help = "Measure query counts, DB time and latency of the main pages and fail if any is over its committed budget"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default=','.join(SCALES), help='Comma-separated fixture sizes')
+        parser.add_argument('--views', default=','.join(VIEWS), help='Comma-separated views to measure')
+        parser.add_argument('--iterations', type=int, default=20, help='Requests per view')
+        parser.add_argument('--latency-tolerance', type=float, default=0.5,
+                            help='Allowed p95 growth over the baseline, as a fraction (latency depends on the machine)')
+        parser.add_argument('--queries-only', action='store_true', help='Check query budgets only')
+        parser.add_argument('--update-baselines', action='store_true', help='Write the results as the new budgets')
+
+    def handle(self, *args, **options):
+        scales = options['scales'].split(',')
+        views = options['views'].split(',')
+        unknown = [s for s in scales if s not in SCALES] + [v for v in views if v not in VIEWS]
+        if unknown:
+            raise CommandError(f"Unknown scale or view: {', '.join(unknown)}")
+
+        results = {}
+        for scale in scales:
+            # A fresh database per scale, so the smaller fixtures are not measured on top of the larger
+            with temporary_database():
+                fixture = build_fixture(scale)
+                results[scale] = measure(fixture, options['iterations'], views)
+            for view, r in results[scale].items():
+                self.stdout.write(
+                    f"{scale:<7} {view:<18} queries {r['queries']:>3}  db {r['db_ms']:7.2f}ms  "
+                    f"p50 {r['p50_ms']:7.2f}ms  p95 {r['p95_ms']:7.2f}ms"
+                )
+
+        if options['update_baselines']:
+            save_baselines(results)
+            self.stdout.write(self.style.SUCCESS("Baselines updated"))
+            return
+
+        baselines = load_baselines()
+        tolerance = None if options['queries_only'] else options['latency_tolerance']
+        problems = [p for scale, r in results.items() for p in over_budget(scale, r, baselines, tolerance)]
+        if problems:
+            raise CommandError("Over budget:\n  " + "\n  ".join(problems))
+        self.stdout.write(self.style.SUCCESS("Every view is within budget"))
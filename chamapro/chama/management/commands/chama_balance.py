@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+from chama.ledger import balance
+from chama.models import Chama
+
+
+class Command(BaseCommand):
+    help = "Print a chama's balance from the ledger, now or at a point in time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('chama', help='Chama id')
+        parser.add_argument('--at', help='ISO date-time, e.g. 2026-01-31T23:59:59 (local time unless an offset is given)')
+
+    def handle(self, *args, **options):
+        chama = Chama.objects.filter(id=options['chama']).first()
+        if chama is None:
+            raise CommandError(f"No chama {options['chama']}")
+        at = None
+        if options['at']:
+            at = parse_datetime(options['at'])
+            if at is None:
+                raise CommandError(f"Invalid date-time: {options['at']}")
+            if timezone.is_naive(at):
+                at = timezone.make_aware(at)
+        when = at.isoformat() if at else 'now'
+        self.stdout.write(f"{chama.name}: KES {balance(chama.id, at)} ({when})")
@@ -0,0 +1,23 @@
+import time
+from datetime import date
+from django.core.management.base import BaseCommand
+from chama.obligations import generate_obligations, rebuild_obligations
+
+
+class Command(BaseCommand):
+    help = "Open the current contribution period's obligations for every member (run daily)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=date.fromisoformat, help='Open periods containing this day (YYYY-MM-DD)')
+        parser.add_argument('--rebuild-since', type=date.fromisoformat,
+                            help='Also recompute paid amounts from transactions for periods from this month on')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options['rebuild_since']:
+            written = rebuild_obligations(options['rebuild_since'])
+            self.stdout.write(f"Rebuilt {written} obligations from successful contributions")
+        covered = generate_obligations(today=options['date'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Current-period obligations ensured for {covered} memberships in {time.perf_counter() - start:.2f}s"
+        ))
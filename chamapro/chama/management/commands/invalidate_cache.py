@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from chamapro.cache import CacheNamespace
+
+
+class Command(BaseCommand):
+    help = "Orphan every cached value in the given key namespaces (e.g. dashboard) by bumping their version"
+
+    def add_arguments(self, parser):
+        parser.add_argument('namespaces', nargs='+')
+
+    def handle(self, *args, **options):
+        for name in options['namespaces']:
+            version = CacheNamespace(name).invalidate()
+            self.stdout.write(self.style.SUCCESS(f"{name}: now at version {version}"))
@@ -0,0 +1,17 @@
+import time
+from django.core.management.base import BaseCommand
+from chama.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Refill the directory's full-text index after bulk loads that bypass Chama.save() (SQLite only; Postgres keeps its own)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        indexed = rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {indexed} public chamas in {time.perf_counter() - start:.2f}s"
+        ))
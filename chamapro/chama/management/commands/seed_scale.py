@@ -0,0 +1,72 @@
+import os
+import time
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from chama import ledger, search
+from chama.obligations import generate_obligations
+from chama.seeding import already_seeded, generate, make_config
+from payments.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Generate deterministic production-scale data (users, chamas, M-Pesa history, loans...) for load tests"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=1, help='Same seed and --until, same data')
+        parser.add_argument('--users', type=int, default=50_000)
+        parser.add_argument('--chamas', type=int, default=10_000)
+        parser.add_argument('--months', type=int, default=12, help='Months of contribution history')
+        parser.add_argument('--members', default='5-40', help='Members per chama, as MIN-MAX')
+        parser.add_argument('--weekly-share', type=float, default=0.3, help='Share of chamas contributing weekly')
+        parser.add_argument('--until', type=date.fromisoformat, help='Last day of history (default today)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes')
+        parser.add_argument('--shards', type=int, help='Shards per phase (default 4 per worker)')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--skip-derived', action='store_true',
+                            help='Do not rebuild rollups, ledger snapshots, current obligations and the search index')
+
+    def handle(self, *args, **options):
+        low, _, high = options['members'].partition('-')
+        config = make_config(
+            seed=options['seed'], users=options['users'], chamas=options['chamas'], months=options['months'],
+            members=(int(low), int(high or low)), weekly_share=options['weekly_share'],
+            until=options['until'], batch_size=options['batch_size'],
+        )
+        if already_seeded(config):
+            raise CommandError(f"Seed {options['seed']} is already loaded (users named {config['prefix']}...)")
+        workers = max(options['workers'], 1)
+        shards = options['shards'] or workers * 4
+
+        sqlite = connection.vendor == 'sqlite'
+        if sqlite and workers > 1:
+            # Lets the other shards keep generating while one writes
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode=WAL')
+        start = time.perf_counter()
+        try:
+            counts = generate(config, shards=shards, workers=workers)
+        finally:
+            if sqlite and workers > 1:
+                with connection.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode=DELETE')
+        elapsed = time.perf_counter() - start
+        total = sum(counts.values())
+        for name, count in sorted(counts.items()):
+            self.stdout.write(f"{name:<28} {count:>12,}")
+        self.stdout.write(
+            f"{total:,} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} rows/s, "
+            f"{shards} shards on {workers} worker(s))"
+        )
+
+        if not options['skip_derived']:
+            start = time.perf_counter()
+            rollups = rebuild_rollups()
+            snapshots = ledger.take_snapshots(lag=timedelta(0))
+            obligations = generate_obligations(today=config['until'])
+            indexed = search.rebuild_index()
+            self.stdout.write(
+                f"Derived {rollups:,} rollups, {snapshots:,} balance snapshots, {obligations:,} current "
+                f"obligations and {indexed:,} search entries in {time.perf_counter() - start:.1f}s"
+            )
+        self.stdout.write(self.style.SUCCESS(f"Seed {options['seed']} loaded"))
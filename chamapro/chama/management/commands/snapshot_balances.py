@@ -0,0 +1,26 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chama.ledger import take_snapshots
+
+
+class Command(BaseCommand):
+    help = "Fold new ledger entries into balance snapshots, so balances are a snapshot plus a short tail"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lag', type=int, default=getattr(settings, 'LEDGER_SNAPSHOT_LAG', 60),
+                            help='Seconds to stay behind now, so entries of open transactions are not skipped')
+        parser.add_argument('--loop', action='store_true', help='Keep snapshotting instead of exiting after one pass')
+        parser.add_argument('--sleep', type=float, default=300.0, help='Seconds between passes')
+
+    def handle(self, *args, **options):
+        while True:
+            start = time.perf_counter()
+            written = take_snapshots(lag=timedelta(seconds=options['lag']))
+            self.stdout.write(self.style.SUCCESS(
+                f"Wrote {written} balance snapshots in {time.perf_counter() - start:.2f}s"
+            ))
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
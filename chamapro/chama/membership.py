@@ -0,0 +1,83 @@
+# chama/membership.py
+"""Resolve a chama and the requesting user's role in it with a single query"""
+from functools import wraps
+from django.db.models import Exists, OuterRef
+from django.shortcuts import get_object_or_404, redirect
+from .models import Chama
+
+ADMIN = 'admin'
+MEMBER = 'member'
+
+
+def _membership_rows(chama_id, user_id):
+    """Rows of the M2M through table; (chama_id, user_id) is its unique index"""
+    user_column = f"{Chama.members.field.m2m_reverse_field_name()}_id"
+    return Chama.members.through.objects.filter(chama_id=chama_id, **{user_column: user_id})
+
+
+def _role(chama, user):
+    if not user.is_authenticated:
+        return None
+    if chama.created_by_id == user.pk:
+        return ADMIN
+    return MEMBER if getattr(chama, 'is_member', False) else None
+
+
+def resolve_chama(request, **lookup):
+    """
+    Fetch the chama matching `lookup` together with an indexed EXISTS on the
+    membership table. Returns (chama, role) where role is ADMIN for the
+    creator, MEMBER for members and None otherwise. Memoised on the request.
+    """
+    chama = get_object_or_404(
+        Chama.objects.annotate(is_member=Exists(_membership_rows(OuterRef('pk'), request.user.pk or 0))),
+        **lookup
+    )
+    roles = request.__dict__.setdefault('_chama_roles', {})
+    roles[chama.pk] = _role(chama, request.user)
+    return chama, roles[chama.pk]
+
+
+def chama_role(request, chama):
+    """The user's role in an already loaded chama; one EXISTS query at most per request"""
+    roles = request.__dict__.setdefault('_chama_roles', {})
+    if chama.pk not in roles:
+        if not hasattr(chama, 'is_member'):
+            chama.is_member = (
+                request.user.is_authenticated and _membership_rows(chama.pk, request.user.pk).exists()
+            )
+        roles[chama.pk] = _role(chama, request.user)
+    return roles[chama.pk]
+
+
+def is_member(chama, user):
+    """Indexed membership test for any user, without loading the member list"""
+    return _membership_rows(chama.pk, user.pk).exists()
+
+
+def chama_access(view=None, *, role=None):
+    """
+    Resolve the chama named by the URL (`slug` + `pk`, or `chama_id`) and set
+    `request.chama` and `request.chama_role` before calling the view.
+
+    With role=MEMBER, non-members (the creator counts as a member) are sent
+    to the dashboard; with role=ADMIN, everyone but the creator is.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if 'chama_id' in kwargs:
+                lookup = {'id': kwargs['chama_id']}
+            else:
+                lookup = {'id': kwargs['pk'], 'slug': kwargs['slug']}
+            request.chama, request.chama_role = resolve_chama(request, **lookup)
+            if role == ADMIN and request.chama_role != ADMIN:
+                return redirect('chama:dashboard')
+            if role == MEMBER and request.chama_role is None:
+                return redirect('chama:dashboard')
+            return view_func(request, *args, **kwargs)
+        return wrapper
+
+    if view is not None:
+        return decorator(view)
+    return decorator
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:12
+
+from datetime import datetime
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_period(apps, schema_editor):
+    """Lazily assessed penalties carry their month in the reason, e.g. 'Late Contribution: January 2026'"""
+    Penalty = apps.get_model('chama', 'Penalty')
+    for penalty in Penalty.objects.filter(period__isnull=True, reason__startswith='Late Contribution: '):
+        try:
+            month = datetime.strptime(penalty.reason.split(': ', 1)[1], '%B %Y').date()
+        except ValueError:
+            continue
+        Penalty.objects.filter(pk=penalty.pk).update(period=month)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0004_chama_subscription_expiry_chama_subscription_plan_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='penalty',
+            name='period',
+            field=models.DateField(blank=True, help_text='Start of the contribution period penalised', null=True),
+        ),
+        migrations.RunPython(backfill_period, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='penalty',
+            constraint=models.UniqueConstraint(fields=('user', 'chama', 'period'), name='unique_penalty_per_period'),
+        ),
+    ]
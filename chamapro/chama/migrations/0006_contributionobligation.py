@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:13
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0005_penalty_period'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContributionObligation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period_start', models.DateField()),
+                ('due_date', models.DateField(blank=True, null=True)),
+                ('expected_amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('paid_amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('status', models.CharField(choices=[('DUE', 'Due'), ('PARTIAL', 'Partially Paid'), ('PAID', 'Paid')], default='DUE', max_length=10)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('chama', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='obligations', to='chama.chama')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='obligations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-period_start'],
+                'indexes': [models.Index(fields=['chama', 'period_start', 'status'], name='chama_contr_chama_i_97d2b1_idx')],
+                'constraints': [models.UniqueConstraint(fields=('chama', 'user', 'period_start'), name='unique_obligation_per_period')],
+            },
+        ),
+    ]
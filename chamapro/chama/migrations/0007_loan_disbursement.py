@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0006_contributionobligation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loan',
+            name='conversation_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='loan',
+            name='disbursed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='loan',
+            name='disbursement_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='loan',
+            name='failure_reason',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='loan',
+            name='receipt_number',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='loan',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending Approval'), ('APPROVED', 'Approved'), ('REJECTED', 'Rejected'), ('DISBURSING', 'Disbursing'), ('DISBURSED', 'Disbursed'), ('FAILED', 'Disbursement Failed'), ('PAID', 'Fully Paid')], db_index=True, default='PENDING', max_length=20),
+        ),
+    ]
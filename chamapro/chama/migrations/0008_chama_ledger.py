@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:06
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def open_ledgers(apps, schema_editor):
+    """Carry each chama's current balance into the ledger as its OPENING entry"""
+    Chama = apps.get_model('chama', 'Chama')
+    LedgerEntry = apps.get_model('chama', 'LedgerEntry')
+    LedgerEntry.objects.bulk_create([
+        LedgerEntry(chama_id=chama_id, kind='OPENING', amount=balance, reference='opening')
+        for chama_id, balance in Chama.objects.exclude(total_balance=0).values_list('id', 'total_balance').iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0007_loan_disbursement'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chama',
+            name='total_balance',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, help_text='Balance as of the last snapshot; see chama.ledger for the live figure', max_digits=12, verbose_name='total balance'),
+        ),
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('as_of', models.DateTimeField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('entry_count', models.PositiveIntegerField(default=0, help_text='Entries added since the previous snapshot')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('chama', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_snapshots', to='chama.chama')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('chama', 'as_of'), name='unique_snapshot_per_instant')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('OPENING', 'Opening Balance'), ('CONTRIBUTION', 'Contribution'), ('DISBURSEMENT', 'Loan Disbursement'), ('REFUND', 'Failed Disbursement Refund'), ('PENALTY', 'Penalty Payment'), ('INVESTMENT', 'Investment'), ('ADJUSTMENT', 'Adjustment')], max_length=20)),
+                ('amount', models.DecimalField(decimal_places=2, help_text='Negative when money leaves the chama', max_digits=12)),
+                ('reference', models.CharField(blank=True, max_length=120)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('chama', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='chama.chama')),
+            ],
+            options={
+                'verbose_name_plural': 'ledger entries',
+                'indexes': [models.Index(fields=['chama', 'created_at'], name='chama_ledge_chama_i_e91a97_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('reference', ''), _negated=True), fields=('chama', 'kind', 'reference'), name='unique_ledger_reference')],
+            },
+        ),
+        migrations.RunPython(open_ledgers, migrations.RunPython.noop),
+    ]
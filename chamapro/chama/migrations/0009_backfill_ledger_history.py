@@ -0,0 +1,61 @@
+from django.db import migrations
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+RESERVED_LOAN_STATUSES = ['APPROVED', 'DISBURSING', 'DISBURSED', 'PAID']
+
+
+def backfill_history(apps, schema_editor):
+    """
+    Write the contributions and loans from before the ledger existed as
+    dated entries, so point-in-time balances and verify_balances see them.
+    They are already inside each OPENING balance: an ADJUSTMENT per chama
+    offsets them and leaves today's balance unchanged.
+    """
+    Chama = apps.get_model('chama', 'Chama')
+    LedgerEntry = apps.get_model('chama', 'LedgerEntry')
+    Loan = apps.get_model('chama', 'Loan')
+    MpesaTransaction = apps.get_model('payments', 'MpesaTransaction')
+    now = timezone.now()
+
+    for chama_id in Chama.objects.values_list('id', flat=True).iterator():
+        have = set(LedgerEntry.objects.filter(
+            chama_id=chama_id, kind__in=['CONTRIBUTION', 'DISBURSEMENT']
+        ).values_list('kind', 'reference'))
+        sources = [
+            (('CONTRIBUTION', f"mpesa:{checkout_id}", amount, when)
+             for checkout_id, amount, when in MpesaTransaction.objects.filter(
+                 chama_id=chama_id, transaction_type='CONTRIBUTION', status='SUCCESS', user__isnull=False,
+             ).values_list('checkout_request_id', 'amount', 'transaction_date').iterator()),
+            (('DISBURSEMENT', f"loan:{loan_id}", -amount, when)
+             for loan_id, amount, when in Loan.objects.filter(
+                 chama_id=chama_id, status__in=RESERVED_LOAN_STATUSES,
+             ).values_list('id', 'amount', Coalesce('action_date', 'request_date')).iterator()),
+        ]
+        batch, offset = [], 0
+        for source in sources:
+            for kind, reference, amount, when in source:
+                if (kind, reference) in have:
+                    continue
+                batch.append(LedgerEntry(chama_id=chama_id, kind=kind, amount=amount, reference=reference, created_at=when))
+                offset += amount
+                if len(batch) >= 1000:
+                    LedgerEntry.objects.bulk_create(batch)
+                    batch = []
+        LedgerEntry.objects.bulk_create(batch)
+        if offset:
+            LedgerEntry.objects.create(
+                chama_id=chama_id, kind='ADJUSTMENT', amount=-offset, reference='ledger-history-offset', created_at=now,
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0008_chama_ledger'),
+        ('payments', '0009_pending_transactions_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_history, migrations.RunPython.noop),
+    ]
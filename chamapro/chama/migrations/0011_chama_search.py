@@ -0,0 +1,76 @@
+from django.db import migrations, models
+
+POSTGRES_FORWARD = [
+    """
+    ALTER TABLE chama_chama ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(excerpt, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'C')
+    ) STORED
+    """,
+    "CREATE INDEX chama_chama_search_gin ON chama_chama USING GIN (search_vector)",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS chama_chama_search_gin",
+    "ALTER TABLE chama_chama DROP COLUMN IF EXISTS search_vector",
+]
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE chama_chama_fts USING fts5(
+        chama_id UNINDEXED, name, excerpt, description,
+        tokenize = 'porter unicode61 remove_diacritics 2'
+    )
+    """,
+]
+SQLITE_BACKWARD = ["DROP TABLE IF EXISTS chama_chama_fts"]
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Postgres maintains a generated tsvector column itself. SQLite gets an
+    FTS5 shadow table, filled here and then kept in sync by chama.signals.
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for sql in POSTGRES_FORWARD:
+            schema_editor.execute(sql)
+    elif vendor == 'sqlite':
+        for sql in SQLITE_FORWARD:
+            schema_editor.execute(sql)
+        Chama = apps.get_model('chama', 'Chama')
+        rows = [
+            (int(pk.hex[:15], 16), pk.hex, name, excerpt, description)
+            for pk, name, excerpt, description in Chama.objects.filter(is_public=True, is_active=True).values_list(
+                'id', 'name', 'excerpt', 'description'
+            ).iterator()
+        ]
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO chama_chama_fts (rowid, chama_id, name, excerpt, description) VALUES (%s, %s, %s, %s, %s)',
+                rows,
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for sql in {'postgresql': POSTGRES_BACKWARD, 'sqlite': SQLITE_BACKWARD}.get(vendor, []):
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0010_requestprofile'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chama',
+            index=models.Index(condition=models.Q(('is_active', True), ('is_public', True)), fields=['created_at', 'id'], name='chama_directory_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chama',
+            index=models.Index(condition=models.Q(('is_active', True), ('is_public', True)), fields=['county', 'constituency', 'contribution_frequency', 'monthly_contribution'], name='chama_directory_facets_idx'),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
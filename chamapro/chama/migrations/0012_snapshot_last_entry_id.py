@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:33
+
+from django.db import migrations, models
+
+
+def drop_snapshots(apps, schema_editor):
+    """
+    Snapshots cut by created_at cannot be given an entry id exactly. They
+    only summarise the ledger: balances are summed from the entries until
+    the next snapshot_balances run writes new ones.
+    """
+    apps.get_model('chama', 'BalanceSnapshot').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0011_chama_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_snapshots, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='balancesnapshot',
+            name='last_entry_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['chama', 'id'], name='chama_ledge_chama_i_5d5fec_idx'),
+        ),
+    ]
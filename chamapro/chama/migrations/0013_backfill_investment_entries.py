@@ -0,0 +1,47 @@
+from datetime import datetime, time
+from django.db import migrations
+from django.db.models import Sum
+from django.utils import timezone
+
+
+def backfill_investments(apps, schema_editor):
+    """
+    Write the investments made before they reached the ledger as dated
+    INVESTMENT entries, so point-in-time balances see them. The balances
+    the ledger opened with never had them taken off: an ADJUSTMENT per
+    chama offsets them and leaves today's balance unchanged, and
+    verify_balances reports it as drift until an admin confirms it.
+    """
+    Investment = apps.get_model('chama', 'Investment')
+    LedgerEntry = apps.get_model('chama', 'LedgerEntry')
+    now = timezone.now()
+
+    batch = []
+    for investment_id, chama_id, amount, invested in Investment.objects.values_list(
+        'id', 'chama_id', 'amount', 'date_invested'
+    ).iterator():
+        when = timezone.make_aware(datetime.combine(invested, time.min))
+        batch.append(LedgerEntry(
+            chama_id=chama_id, kind='INVESTMENT', amount=-amount, reference=f"investment:{investment_id}:1", created_at=when,
+        ))
+        if len(batch) >= 1000:
+            LedgerEntry.objects.bulk_create(batch)
+            batch = []
+    LedgerEntry.objects.bulk_create(batch)
+
+    offsets = Investment.objects.values('chama_id').annotate(total=Sum('amount')).values_list('chama_id', 'total')
+    LedgerEntry.objects.bulk_create([
+        LedgerEntry(chama_id=chama_id, kind='ADJUSTMENT', amount=total, reference='ledger-investment-offset', created_at=now)
+        for chama_id, total in offsets if total
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0012_snapshot_last_entry_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_investments, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,13 @@
 import uuid
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth import get_user_model
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.utils.text import slugify
-from datetime import date
+from datetime import date, timedelta
+import calendar
 
 User = get_user_model()
 
@@ -153,13 +156,15 @@ class Chama(models.Model):
     meta_description = models.TextField(_('meta description'), max_length=160, blank=True)
     meta_keywords = models.CharField(_('meta keywords'), max_length=255, blank=True)
     
-    # Financial tracking
+    # Financial tracking. The ledger (LedgerEntry) is the source of truth;
+    # this copy is refreshed by `snapshot_balances` for sorting and the admin.
     total_balance = models.DecimalField(
         _('total balance'),
         max_digits=12,
         decimal_places=2,
         default=0,
-        db_index=True
+        db_index=True,
+        help_text=_('Balance as of the last snapshot; see chama.ledger for the live figure'),
     )
     
     # Timestamps for freshness
@@ -180,6 +185,11 @@ class Chama(models.Model):
             models.Index(fields=['slug', 'is_active']),
             models.Index(fields=['county', 'is_public']),
             models.Index(fields=['created_at', 'total_balance']),
+            # The public directory (chama.search): newest-first browsing, and facet counts read from the index alone
+            models.Index(fields=['created_at', 'id'], condition=Q(is_public=True, is_active=True),
+                         name='chama_directory_recent_idx'),
+            models.Index(fields=['county', 'constituency', 'contribution_frequency', 'monthly_contribution'],
+                         condition=Q(is_public=True, is_active=True), name='chama_directory_facets_idx'),
         ]
     
     def __str__(self):
@@ -218,10 +228,52 @@ class Chama(models.Model):
     def active_members_count(self):
         return self.members.filter(is_active=True).count()
     
+    def contribution_period(self, day):
+        """(start, end) of the contribution period containing `day`; end is exclusive"""
+        if self.contribution_frequency == 'WEEKLY':
+            start = day - timedelta(days=day.weekday())
+            return start, start + timedelta(days=7)
+        start = day.replace(day=1)
+        return start, (start + timedelta(days=32)).replace(day=1)
+
+    def contribution_due_date(self, period_start):
+        """Due date of the period starting on `period_start`, or None without a schedule"""
+        if self.contribution_frequency == 'WEEKLY':
+            if self.contribution_weekday is None:
+                return None
+            return period_start + timedelta(days=self.contribution_weekday)
+        if not self.contribution_day:
+            return None
+        last_day = calendar.monthrange(period_start.year, period_start.month)[1]
+        return period_start.replace(day=min(self.contribution_day, last_day))
+
+    def penalty_cutoff(self, period_start):
+        """Last day a contribution for the period is accepted without penalty"""
+        due_date = self.contribution_due_date(period_start)
+        if due_date is None:
+            return None
+        return due_date + timedelta(days=self.penalty_grace_period)
+
+    def assessable_period(self, today):
+        """Start of the latest period whose grace period ended before `today`"""
+        period_start, _ = self.contribution_period(today)
+        cutoff = self.penalty_cutoff(period_start)
+        if cutoff is None:
+            return None
+        while cutoff >= today:
+            period_start, _ = self.contribution_period(period_start - timedelta(days=1))
+            cutoff = self.penalty_cutoff(period_start)
+        return period_start
+
     @property
     def next_contribution_date(self):
+        """Next due date on or after today, or None without a schedule"""
         today = date.today()
-        return date(today.year, today.month, self.contribution_day)
+        period_start, period_end = self.contribution_period(today)
+        due_date = self.contribution_due_date(period_start)
+        if due_date is not None and due_date < today:
+            due_date = self.contribution_due_date(period_end)
+        return due_date
     
     def get_schema_org_data(self):
         """SEO: Structured data for Google"""
@@ -243,11 +295,14 @@ class Chama(models.Model):
 
 class Loan(models.Model):
     """Loan Model for Chama Members"""
+    # PENDING -> APPROVED (balance reserved) -> DISBURSING (B2C sent) -> DISBURSED or FAILED (refunded)
     STATUS_CHOICES = [
         ('PENDING', 'Pending Approval'),
         ('APPROVED', 'Approved'),
         ('REJECTED', 'Rejected'),
+        ('DISBURSING', 'Disbursing'),
         ('DISBURSED', 'Disbursed'),
+        ('FAILED', 'Disbursement Failed'),
         ('PAID', 'Fully Paid'),
     ]
     
@@ -263,6 +318,13 @@ class Loan(models.Model):
     action_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='processed_loans')
     
     repayment_date = models.DateField(null=True, blank=True)
+
+    # B2C disbursement, filled in by payments.disbursements
+    conversation_id = models.CharField(max_length=100, blank=True, db_index=True)
+    receipt_number = models.CharField(max_length=50, blank=True)
+    disbursement_started_at = models.DateTimeField(null=True, blank=True)
+    disbursed_at = models.DateTimeField(null=True, blank=True)
+    failure_reason = models.CharField(max_length=200, blank=True)
     
     class Meta:
         ordering = ['-request_date']
@@ -304,8 +366,135 @@ class Penalty(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     date_assessed = models.DateField(auto_now_add=True)
     reason = models.CharField(max_length=200) # e.g., "Late payment for Jan 2024"
+    period = models.DateField(null=True, blank=True, help_text=_('Start of the contribution period penalised'))
     is_paid = models.BooleanField(default=False)
     paid_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chama', 'period'], name='unique_penalty_per_period'),
+        ]
+
     def __str__(self):
         return f"{self.user} - {self.amount} ({self.reason})"
+
+class ContributionObligation(models.Model):
+    """What a member owes a chama for one contribution period, and what they have paid"""
+    STATUS_CHOICES = [
+        ('DUE', 'Due'),
+        ('PARTIAL', 'Partially Paid'),
+        ('PAID', 'Paid'),
+    ]
+
+    chama = models.ForeignKey(Chama, on_delete=models.CASCADE, related_name='obligations')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='obligations')
+    period_start = models.DateField()
+    due_date = models.DateField(null=True, blank=True)
+    expected_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    paid_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='DUE')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-period_start']
+        constraints = [
+            models.UniqueConstraint(fields=['chama', 'user', 'period_start'], name='unique_obligation_per_period'),
+        ]
+        indexes = [
+            models.Index(fields=['chama', 'period_start', 'status']),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.chama} {self.period_start} ({self.status})"
+
+    @property
+    def outstanding(self):
+        return max(self.expected_amount - self.paid_amount, 0)
+
+
+class LedgerEntry(models.Model):
+    """
+    One movement of a chama's money. Append-only: entries are inserted,
+    never updated or deleted, so writers take no row locks. A correction
+    is a new ADJUSTMENT entry.
+    """
+    KIND_CHOICES = [
+        ('OPENING', 'Opening Balance'),
+        ('CONTRIBUTION', 'Contribution'),
+        ('DISBURSEMENT', 'Loan Disbursement'),
+        ('REFUND', 'Failed Disbursement Refund'),
+        ('PENALTY', 'Penalty Payment'),
+        ('INVESTMENT', 'Investment'),
+        ('ADJUSTMENT', 'Adjustment'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    chama = models.ForeignKey(Chama, on_delete=models.CASCADE, related_name='ledger_entries')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    amount = models.DecimalField(max_digits=12, decimal_places=2, help_text=_('Negative when money leaves the chama'))
+    # What the entry is for, e.g. "mpesa:<checkout id>" or "loan:<id>"; unique per chama and kind
+    reference = models.CharField(max_length=120, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name_plural = 'ledger entries'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['chama', 'kind', 'reference'], condition=~models.Q(reference=''),
+                name='unique_ledger_reference',
+            ),
+        ]
+        indexes = [
+            # Point-in-time balances
+            models.Index(fields=['chama', 'created_at']),
+            # Tail sums after a snapshot
+            models.Index(fields=['chama', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.chama_id} {self.kind} {self.amount}"
+
+
+class BalanceSnapshot(models.Model):
+    """A chama's balance including every ledger entry up to `last_entry_id`, taken as of `as_of`"""
+    chama = models.ForeignKey(Chama, on_delete=models.CASCADE, related_name='balance_snapshots')
+    as_of = models.DateTimeField()
+    # Entry ids only grow, unlike created_at, which comes from the writer's clock before its commit
+    last_entry_id = models.BigIntegerField(default=0)
+    balance = models.DecimalField(max_digits=14, decimal_places=2)
+    entry_count = models.PositiveIntegerField(default=0, help_text=_('Entries added since the previous snapshot'))
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chama', 'as_of'], name='unique_snapshot_per_instant'),
+        ]
+
+    def __str__(self):
+        return f"{self.chama_id} {self.balance} @ {self.as_of}"
+
+
+class RequestProfile(models.Model):
+    """One profiled request (see chamapro.profiling), browsable in the admin"""
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    view_name = models.CharField(max_length=200, blank=True)
+    status_code = models.PositiveSmallIntegerField()
+    trigger = models.CharField(max_length=10, help_text=_('"flag" when staff asked for it, "sample" when picked at random'))
+    duration_ms = models.FloatField()
+    sql_count = models.PositiveIntegerField(default=0)
+    sql_ms = models.FloatField(default=0)
+    template_ms = models.FloatField(default=0)
+    gateway_ms = models.FloatField(default=0)
+    samples = models.PositiveIntegerField(default=0)
+    # "frame;frame;frame count" lines, for flamegraph.pl or speedscope
+    collapsed = models.TextField(blank=True)
+    report = models.JSONField(default=dict)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
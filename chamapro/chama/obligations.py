@@ -0,0 +1,175 @@
+# chama/obligations.py
+"""Per-member, per-period contribution obligations"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from django.db import transaction as db_transaction
+from django.utils import timezone
+from payments.models import MpesaTransaction
+from .models import Chama, ContributionObligation
+
+SCHEDULE_FIELDS = (
+    'id', 'contribution_frequency', 'contribution_day', 'contribution_weekday',
+    'penalty_grace_period', 'penalty_amount', 'monthly_contribution',
+)
+
+
+def obligation_status(expected, paid):
+    if paid >= expected:
+        return 'PAID'
+    return 'PARTIAL' if paid > 0 else 'DUE'
+
+
+def ensure_obligations(entries):
+    """Create missing obligations for (chama, user_id, period_start) entries"""
+    ContributionObligation.objects.bulk_create(
+        [
+            ContributionObligation(
+                chama_id=chama.id,
+                user_id=user_id,
+                period_start=period_start,
+                due_date=chama.contribution_due_date(period_start),
+                expected_amount=chama.monthly_contribution,
+            )
+            for chama, user_id, period_start in entries
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+def member_pairs(chama_ids):
+    """(chama_id, user_id) for every membership of the given chamas, in one query"""
+    Membership = Chama.members.through
+    user_column = f"{Chama.members.field.m2m_reverse_field_name()}_id"
+    return Membership.objects.filter(chama_id__in=list(chama_ids)).values_list('chama_id', user_column)
+
+
+def get_obligation(chama, user, day=None):
+    """The member's obligation for the period containing `day` (default today)"""
+    period_start, _ = chama.contribution_period(day or timezone.localdate())
+    obligation, _ = ContributionObligation.objects.get_or_create(
+        chama=chama,
+        user=user,
+        period_start=period_start,
+        defaults={
+            'due_date': chama.contribution_due_date(period_start),
+            'expected_amount': chama.monthly_contribution,
+        },
+    )
+    return obligation
+
+
+def generate_obligations(today=None, chunk_size=500):
+    """
+    Open the current period's obligation for every member of every active chama.
+    Returns the number of memberships covered.
+    """
+    today = today or timezone.localdate()
+    chamas = Chama.objects.filter(is_active=True).only(*SCHEDULE_FIELDS).order_by()
+    covered = 0
+    batch = []
+    for chama in chamas.iterator(chunk_size=2000):
+        batch.append(chama)
+        if len(batch) == chunk_size:
+            covered += _open_periods(batch, today)
+            batch = []
+    if batch:
+        covered += _open_periods(batch, today)
+    return covered
+
+
+def _open_periods(chamas, today):
+    by_id = {c.id: c for c in chamas}
+    entries = [
+        (by_id[chama_id], user_id, by_id[chama_id].contribution_period(today)[0])
+        for chama_id, user_id in member_pairs(by_id)
+    ]
+    ensure_obligations(entries)
+    return len(entries)
+
+
+def record_contributions(transactions):
+    """
+    Credit successful contribution transactions to their obligations.
+    Called by the callback worker inside its batch transaction.
+    """
+    chamas = Chama.objects.only(*SCHEDULE_FIELDS).in_bulk({t.chama_id for t in transactions})
+    totals = defaultdict(Decimal)
+    for t in transactions:
+        chama = chamas[t.chama_id]
+        period_start, _ = chama.contribution_period(timezone.localdate(t.transaction_date))
+        totals[(t.chama_id, t.user_id, period_start)] += Decimal(t.amount)
+
+    ensure_obligations((chamas[c], u, p) for c, u, p in totals)
+    # Lock, add in Python, write back in one bulk statement: no per-member UPDATE
+    rows = ContributionObligation.objects.select_for_update().filter(
+        chama_id__in={c for c, _, _ in totals},
+        user_id__in={u for _, u, _ in totals},
+        period_start__in={p for _, _, p in totals},
+    ).order_by('id')
+    now = timezone.now()
+    changed = []
+    for row in rows:
+        amount = totals.get((row.chama_id, row.user_id, row.period_start))
+        if amount is None:
+            continue
+        row.paid_amount += amount
+        row.status = obligation_status(row.expected_amount, row.paid_amount)
+        row.updated_at = now
+        changed.append(row)
+    ContributionObligation.objects.bulk_update(changed, ['paid_amount', 'status', 'updated_at'], batch_size=500)
+
+
+def rebuild_obligations(since):
+    """
+    Recompute paid amounts from successful contributions for every period
+    starting on or after the Monday before the 1st of `since`'s month.
+    Returns the number of obligations written.
+    """
+    first = since.replace(day=1)
+    start = first - timedelta(days=first.weekday())
+    start_dt = timezone.make_aware(datetime.combine(start, time.min))
+
+    chamas = Chama.objects.only(*SCHEDULE_FIELDS).in_bulk()
+    totals = defaultdict(Decimal)
+    rows = MpesaTransaction.objects.filter(
+        transaction_type='CONTRIBUTION',
+        status='SUCCESS',
+        transaction_date__gte=start_dt,
+        chama__isnull=False,
+        user__isnull=False,
+    ).values_list('chama_id', 'user_id', 'transaction_date', 'amount').order_by()
+    for chama_id, user_id, transaction_date, amount in rows.iterator(chunk_size=5000):
+        chama = chamas[chama_id]
+        period_start, _ = chama.contribution_period(timezone.localdate(transaction_date))
+        if period_start >= start:  # earlier periods are only partly inside the window
+            totals[(chama_id, user_id, period_start)] += amount
+
+    now = timezone.now()
+    objs = []
+    for (chama_id, user_id, period_start), paid in totals.items():
+        chama = chamas[chama_id]
+        objs.append(ContributionObligation(
+            chama_id=chama_id,
+            user_id=user_id,
+            period_start=period_start,
+            due_date=chama.contribution_due_date(period_start),
+            expected_amount=chama.monthly_contribution,
+            paid_amount=paid,
+            status=obligation_status(chama.monthly_contribution, paid),
+            updated_at=now,
+        ))
+
+    with db_transaction.atomic():
+        ContributionObligation.objects.filter(period_start__gte=start).update(
+            paid_amount=0, status='DUE', updated_at=now
+        )
+        ContributionObligation.objects.bulk_create(
+            objs,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['chama', 'user', 'period_start'],
+            update_fields=['paid_amount', 'status', 'updated_at'],
+        )
+    return len(objs)
@@ -0,0 +1,80 @@
+# chama/penalties.py
+"""Set-based late-contribution penalty assessment"""
+from collections import defaultdict
+from datetime import timedelta
+from django.utils import timezone
+from .models import Chama, ContributionObligation, Penalty
+from .obligations import SCHEDULE_FIELDS, ensure_obligations, member_pairs
+
+
+def period_reason(chama, period_start):
+    if chama.contribution_frequency == 'WEEKLY':
+        return f"Late Contribution: week of {period_start:%d %b %Y}"
+    return f"Late Contribution: {period_start:%B %Y}"
+
+
+def due_chamas(today, lookback_days=1):
+    """
+    Yield (chama, period_start) for chamas whose grace period ended within the
+    last `lookback_days` days, i.e. those owed an assessment run today.
+    """
+    earliest = today - timedelta(days=lookback_days)
+    chamas = Chama.objects.filter(is_active=True, penalty_amount__gt=0).only(*SCHEDULE_FIELDS).order_by()
+    for chama in chamas.iterator(chunk_size=2000):
+        period_start = chama.assessable_period(today)
+        if period_start is not None and chama.penalty_cutoff(period_start) >= earliest:
+            yield chama, period_start
+
+
+def assess_penalties(today=None, lookback_days=1, chunk_size=500, dry_run=False):
+    """
+    Create a Penalty for every member of every due chama whose obligation for
+    the assessed period is still DUE (nothing paid). Chamas sharing a period
+    are handled together, a chunk at a time, with one query each for members,
+    their obligations and existing penalties; missing obligations are opened.
+    Safe to re-run: the (user, chama, period) constraint drops repeats.
+
+    Returns counts: chamas assessed, members checked, penalties created.
+    """
+    today = today or timezone.localdate()
+    stats = {'chamas': 0, 'members': 0, 'penalties': 0}
+
+    groups = defaultdict(list)
+    for chama, period_start in due_chamas(today, lookback_days):
+        groups[(chama.contribution_frequency, period_start)].append(chama)
+
+    for (_, period_start), chamas in groups.items():
+        for i in range(0, len(chamas), chunk_size):
+            chunk = {c.id: c for c in chamas[i:i + chunk_size]}
+            members = list(member_pairs(chunk))
+            statuses = {
+                (chama_id, user_id): status
+                for chama_id, user_id, status in ContributionObligation.objects.filter(
+                    chama_id__in=list(chunk), period_start=period_start
+                ).values_list('chama_id', 'user_id', 'status')
+            }
+            already = set(
+                Penalty.objects.filter(chama_id__in=list(chunk), period=period_start)
+                .values_list('chama_id', 'user_id')
+            )
+            penalties = [
+                Penalty(
+                    user_id=user_id,
+                    chama_id=chama_id,
+                    amount=chunk[chama_id].penalty_amount,
+                    reason=period_reason(chunk[chama_id], period_start),
+                    period=period_start,
+                )
+                for chama_id, user_id in members
+                if statuses.get((chama_id, user_id), 'DUE') == 'DUE' and (chama_id, user_id) not in already
+            ]
+            stats['chamas'] += len(chunk)
+            stats['members'] += len(members)
+            stats['penalties'] += len(penalties)
+            if not dry_run:
+                ensure_obligations(
+                    (chunk[c], u, period_start) for c, u in members if (c, u) not in statuses
+                )
+                # ignore_conflicts covers a concurrent lazy assessment in initiate_contribution
+                Penalty.objects.bulk_create(penalties, batch_size=1000, ignore_conflicts=True)
+    return stats
@@ -0,0 +1,305 @@
+# chama/search.py
+"""
+Full-text and faceted search over the public chama directory.
+
+Public, active chamas are matched on name, excerpt and description (in
+that order of weight) and faceted on county, constituency, contribution
+frequency and contribution range. The full-text index depends on the
+database:
+
+- PostgreSQL: a generated `search_vector` tsvector column on chama_chama
+  with a GIN index (migration 0011); Postgres keeps it current itself.
+- SQLite: the FTS5 shadow table chama_chama_fts, holding the public active
+  chamas only, rewritten by index_chamas() when a chama is saved or
+  deleted. Bulk loads that bypass save() call rebuild_index() (or
+  `manage.py rebuild_search_index`).
+- Anything else: unranked LIKE matching.
+
+Counts (the total and every facet) are cached per query and filters under
+the `directory` namespace, which moves whenever a public chama changes.
+"""
+import hashlib
+import json
+import re
+import uuid
+from collections import Counter
+from django.db import connection
+from .caching import DIRECTORY_TIMEOUT, directory
+from .models import Chama
+
+FTS_TABLE = 'chama_chama_fts'
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+MAX_TERMS = 8
+FACET_LIMIT = 50  # values per facet, most common first
+RANKED = 500  # ids of the first results kept per query, so its pages are served from the cache
+# bm25() weights of the FTS columns: chama_id (not indexed), name, excerpt, description
+FTS_WEIGHTS = '0.0, 10.0, 4.0, 1.0'
+
+# (min, max) of each contribution range facet, KSh; max is exclusive
+CONTRIBUTION_RANGES = [(0, 500), (500, 2000), (2000, 5000), (5000, 10000), (10000, None)]
+LIST_FILTERS = {
+    'county': 'county',
+    'constituency': 'constituency',
+    'frequency': 'contribution_frequency',
+}
+# Saves touching none of these leave the index and the counts alone
+DIRECTORY_FIELDS = {
+    'name', 'slug', 'excerpt', 'description', 'county', 'constituency', 'contribution_frequency',
+    'monthly_contribution', 'is_public', 'is_active',
+}
+RESULT_FIELDS = [
+    'id', 'name', 'slug', 'excerpt', 'county', 'constituency', 'contribution_frequency', 'monthly_contribution',
+]
+
+_TOKEN = re.compile(r'\w+')
+_TABLE = Chama._meta.db_table
+
+
+def terms(query):
+    """Lowercased words of a free-text query; operators and punctuation are dropped"""
+    return _TOKEN.findall((query or '').lower())[:MAX_TERMS]
+
+
+def parse_filters(params):
+    """
+    Filters from a QueryDict: repeatable county, constituency and frequency,
+    and one contribution range as `MIN-MAX`, one of CONTRIBUTION_RANGES
+    (e.g. 500-2000, or 10000- for the open-ended one). Raises ValueError on
+    any other range.
+    """
+    filters = {name: sorted(set(v for v in params.getlist(name) if v)) for name in LIST_FILTERS}
+    contribution = params.get('contribution')
+    if contribution:
+        ranges = {_range_value(low, high): [low, high] for low, high in CONTRIBUTION_RANGES}
+        if contribution not in ranges:
+            raise ValueError(f"Invalid contribution range: {contribution!r}, expected one of {', '.join(ranges)}")
+        filters['contribution'] = ranges[contribution]
+    return {name: value for name, value in filters.items() if value}
+
+
+def _rowid(chama_id):
+    # FTS5 rows need an integer key: 60 bits of the UUID are stable and, in practice, unique
+    return int(chama_id.hex[:15], 16)
+
+
+def _match(words):
+    """(join, where, params, rank expression, rank params) restricting to chamas matching every word"""
+    if connection.vendor == 'sqlite':
+        # Every word must appear; the last may be a prefix, for search-as-you-type
+        query = ' '.join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*'
+        return (
+            f'JOIN {FTS_TABLE} ON {FTS_TABLE}.chama_id = {_TABLE}.id', f'{FTS_TABLE} MATCH %s', [query.strip()],
+            f'bm25({FTS_TABLE}, {FTS_WEIGHTS})', [],  # lower is better
+        )
+    if connection.vendor == 'postgresql':
+        query = ' & '.join([*words[:-1], f'{words[-1]}:*'])
+        return (
+            '', f"{_TABLE}.search_vector @@ to_tsquery('english', %s)", [query],
+            f"-ts_rank({_TABLE}.search_vector, to_tsquery('english', %s))", [query],
+        )
+    like = ' AND '.join(f'({_TABLE}.name LIKE %s OR {_TABLE}.excerpt LIKE %s OR {_TABLE}.description LIKE %s)'
+                        for _ in words)
+    return '', like, [f'%{word}%' for word in words for _ in range(3)], None, []
+
+
+def _where(words, filters):
+    """FROM ... WHERE ... and its params for the public directory"""
+    # Spelled like the partial indexes' condition, so SQLite knows it can use them
+    join, conditions, params = '', [f'{_TABLE}.is_active', f'{_TABLE}.is_public'], []
+    if words:
+        join, where, match_params, _, _ = _match(words)
+        conditions.append(where)
+        params += match_params
+    for name, column in LIST_FILTERS.items():
+        values = filters.get(name)
+        if values:
+            conditions.append(f"{_TABLE}.{column} IN ({', '.join(['%s'] * len(values))})")
+            params += values
+    contribution = filters.get('contribution')
+    if contribution:
+        low, high = contribution
+        conditions.append(f'{_TABLE}.monthly_contribution >= %s')
+        params.append(low)
+        if high is not None:
+            conditions.append(f'{_TABLE}.monthly_contribution < %s')
+            params.append(high)
+    return f"FROM {_TABLE} {join} WHERE {' AND '.join(conditions)}", params
+
+
+def _key(kind, words, filters):
+    digest = hashlib.sha1(json.dumps([words, filters], sort_keys=True).encode()).hexdigest()
+    return directory.key(kind, digest)
+
+
+def _fetch(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _bucket_sql():
+    whens = ' '.join(
+        f"WHEN {_TABLE}.monthly_contribution < {high} THEN {i}"
+        for i, (_, high) in enumerate(CONTRIBUTION_RANGES) if high is not None
+    )
+    return f"CASE {whens} ELSE {len(CONTRIBUTION_RANGES) - 1} END"
+
+
+def _range_value(low, high):
+    return f"{low}-{'' if high is None else high}"
+
+
+def counts(words, filters):
+    """
+    {'total', 'facets'} for the query. Each facet is counted with every
+    filter but its own applied, so the other values of a facet stay
+    selectable. One grouped query over the text matches gives every
+    combination of facet values; the filters are applied to those here.
+    Cached until a public chama changes.
+    """
+    key = _key('counts', words, filters)
+    cached = directory.cache.get(key)
+    if cached is not None:
+        return cached
+
+    columns = [f'{_TABLE}.{column}' for column in LIST_FILTERS.values()]
+    from_where, params = _where(words, {})
+    rows = _fetch(
+        f"SELECT {', '.join(columns)}, {_bucket_sql()}, COUNT(*) {from_where} GROUP BY {', '.join(columns)}, 4",
+        params,
+    )
+    wanted = {name: set(filters[name]) for name in LIST_FILTERS if filters.get(name)}
+    if filters.get('contribution'):
+        wanted['contribution'] = {CONTRIBUTION_RANGES.index(tuple(filters['contribution']))}
+
+    total = 0
+    tallies = {name: Counter() for name in [*LIST_FILTERS, 'contribution']}
+    for *values, count in rows:
+        row = dict(zip(tallies, values))
+        misses = [name for name, allowed in wanted.items() if row[name] not in allowed]
+        if not misses:
+            total += count
+            for name, value in row.items():
+                tallies[name][value] += count
+        elif len(misses) == 1:
+            # Filtered out by this facet alone: still a choice within it
+            tallies[misses[0]][row[misses[0]]] += count
+
+    facets = {
+        name: [
+            {'value': value, 'count': count, 'selected': value in wanted.get(name, ())}
+            for value, count in sorted(
+                ((value, count) for value, count in tallies[name].items() if value), key=lambda item: (-item[1], item[0])
+            )[:FACET_LIMIT]
+        ]
+        for name in LIST_FILTERS
+    }
+    facets['contribution'] = [
+        {'value': _range_value(low, high), 'min': low, 'max': high, 'count': tallies['contribution'][i],
+         'selected': i in wanted.get('contribution', ())}
+        for i, (low, high) in enumerate(CONTRIBUTION_RANGES)
+    ]
+
+    result = {'total': total, 'facets': facets}
+    directory.cache.set(key, result, DIRECTORY_TIMEOUT)
+    return result
+
+
+def _ranked_ids(words, filters, offset, limit):
+    """Ids of results offset to offset + limit, in order; the first RANKED come from the cache"""
+    if offset + limit <= RANKED:
+        key = _key('ranked', words, filters)
+        ids = directory.cache.get(key)
+        if ids is None:
+            ids = _ranked_ids(words, filters, 0, RANKED + 1)
+            directory.cache.set(key, ids, DIRECTORY_TIMEOUT)
+        return ids[offset:offset + limit]
+
+    if words and not filters and connection.vendor == 'sqlite':
+        # The FTS table only holds public, active chamas: rank it alone, without the join
+        _, where, params, rank, _ = _match(words)
+        sql = f'SELECT chama_id FROM {FTS_TABLE} WHERE {where} ORDER BY {rank} LIMIT %s OFFSET %s'
+    else:
+        from_where, params = _where(words, filters)
+        # created_at, id: read backwards off chama_directory_recent_idx when browsing
+        order, rank_params = f'{_TABLE}.created_at DESC, {_TABLE}.id DESC', []
+        if words:
+            _, _, _, rank, rank_params = _match(words)
+            if rank:
+                order = f'{rank}, {order}'
+        sql = f'SELECT {_TABLE}.id {from_where} ORDER BY {order} LIMIT %s OFFSET %s'
+        params = [*params, *rank_params]
+    return [str(row[0]) for row in _fetch(sql, [*params, limit, offset])]
+
+
+def search(query='', filters=None, page=1, page_size=PAGE_SIZE):
+    """
+    One page of public, active chamas matching `query` and `filters` (see
+    parse_filters), best match first, or newest first without a query,
+    with the total and facet counts: {'results', 'total', 'page', 'pages', 'facets'}.
+    """
+    words = terms(query)
+    filters = filters or {}
+    page_size = min(max(page_size, 1), MAX_PAGE_SIZE)
+    page = max(page, 1)
+    summary = counts(words, filters)
+
+    ids = [uuid.UUID(pk) for pk in _ranked_ids(words, filters, (page - 1) * page_size, page_size)]
+    chamas = Chama.objects.only(*RESULT_FIELDS).in_bulk(ids)
+    return {
+        'results': [chamas[pk] for pk in ids if pk in chamas],
+        'total': summary['total'],
+        'page': page,
+        'pages': max(-(-summary['total'] // page_size), 1),
+        'facets': summary['facets'],
+    }
+
+
+def index_chamas(chamas):
+    """Rewrite the SQLite full-text rows of `chamas`: public, active ones are (re)added, the rest dropped"""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(_rowid(c.pk),) for c in chamas])
+        cursor.executemany(
+            f'INSERT INTO {FTS_TABLE} (rowid, chama_id, name, excerpt, description) VALUES (%s, %s, %s, %s, %s)',
+            [(_rowid(c.pk), c.pk.hex, c.name, c.excerpt, c.description)
+             for c in chamas if c.is_public and c.is_active],
+        )
+
+
+def unindex_chamas(chama_ids):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(_rowid(pk),) for pk in chama_ids])
+
+
+def rebuild_index(batch_size=5000):
+    """Refill the SQLite full-text table from scratch; returns the number of chamas indexed"""
+    if connection.vendor != 'sqlite':
+        return Chama.objects.filter(is_public=True, is_active=True).count()
+    indexed = 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        rows = Chama.objects.filter(is_public=True, is_active=True).values_list(
+            'id', 'name', 'excerpt', 'description'
+        ).iterator(chunk_size=batch_size)
+        batch = []
+        for pk, name, excerpt, description in rows:
+            batch.append((_rowid(pk), pk.hex, name, excerpt, description))
+            if len(batch) >= batch_size:
+                indexed += _insert(cursor, batch)
+                batch = []
+        indexed += _insert(cursor, batch)
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    directory.invalidate()
+    return indexed
+
+
+def _insert(cursor, batch):
+    cursor.executemany(
+        f'INSERT INTO {FTS_TABLE} (rowid, chama_id, name, excerpt, description) VALUES (%s, %s, %s, %s, %s)', batch
+    )
+    return len(batch)
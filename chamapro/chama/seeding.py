@@ -0,0 +1,360 @@
+"""
+Deterministic production-scale data for load tests (see `manage.py seed_scale`).
+
+Users and chamas are generated in shards. Every chama draws from its own
+random stream (seed, chama number), so the data depends on the seed and
+the end date only, never on how many shards or worker processes made it.
+Rows, memberships included (straight into the M2M through table), go in
+as multi-row INSERTs of up to `batch_size` rows, each batch committed on
+its own so parallel shards interleave even on SQLite.
+"""
+import multiprocessing
+import random
+import uuid
+from datetime import datetime, time as dt_time, timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX
+from django.core.management.color import no_style
+from django.db import connection, connections, transaction as db_transaction
+from django.db.models import Max
+from django.utils import timezone
+from payments.models import MpesaTransaction
+from .models import Chama, Investment, LedgerEntry, Loan, Penalty
+
+User = get_user_model()
+Membership = Chama.members.through
+
+COUNTIES = [
+    'Nairobi', 'Mombasa', 'Kisumu', 'Nakuru', 'Kiambu', 'Machakos', 'Uasin Gishu', 'Kakamega',
+    'Meru', 'Nyeri', 'Kilifi', 'Kisii', 'Bungoma', 'Kajiado', 'Murang\'a', 'Embu',
+]
+NAME_WORDS = [
+    'Umoja', 'Tujenge', 'Imara', 'Baraka', 'Amani', 'Neema', 'Faida', 'Jamii', 'Maendeleo', 'Upendo',
+    'Harambee', 'Tumaini', 'Mwangaza', 'Ushindi', 'Pamoja', 'Heshima',
+]
+GROUP_WORDS = ['Women Group', 'Investment Club', 'Savings Group', 'Welfare', 'Youth Group', 'Self Help Group']
+CONTRIBUTIONS = [200, 500, 1000, 2000, 5000]
+INVESTMENTS = ['Land', 'T-Bills', 'SACCO shares', 'Matatu']
+# Loan status and how often it occurs
+LOAN_STATUSES = [('PENDING', 2), ('APPROVED', 1), ('DISBURSED', 4), ('PAID', 6), ('REJECTED', 2), ('FAILED', 1)]
+RESERVING = {'APPROVED', 'DISBURSED', 'PAID', 'FAILED'}
+LOANS_PER_CHAMA = 4
+LOAN_ID_STRIDE = 8  # loan ids reserved per chama, so shards assign them without coordinating
+INVESTMENTS_PER_CHAMA = 2  # also the investment ids reserved per chama
+PASSWORD = UNUSABLE_PASSWORD_PREFIX + 'seed_scale'
+# Parents before children
+WRITE_ORDER = [User, Chama, Membership, Loan, MpesaTransaction, LedgerEntry, Penalty, Investment]
+
+def make_config(seed=1, users=50_000, chamas=10_000, months=12, members=(5, 40), weekly_share=0.3,
+                until=None, batch_size=5000):
+    """Everything a shard needs, picklable. Ids are allocated above what the database already holds."""
+    prefix = f"s{seed}-"
+    return {
+        'seed': seed,
+        'prefix': prefix,
+        'users': users,
+        'chamas': chamas,
+        'months': months,
+        'members': members,
+        'weekly_share': weekly_share,
+        'until': until or timezone.localdate(),
+        'batch_size': batch_size,
+        'user_base': (User.objects.aggregate(m=Max('id'))['m'] or 0) + 1,
+        'loan_base': (Loan.objects.aggregate(m=Max('id'))['m'] or 0) + 1,
+        'investment_base': (Investment.objects.aggregate(m=Max('id'))['m'] or 0) + 1,
+    }
+
+
+def already_seeded(config):
+    return User.objects.filter(username__startswith=config['prefix']).exists()
+
+
+def shard_ranges(total, shards):
+    """`shards` contiguous (start, stop) ranges covering range(total)"""
+    step, extra = divmod(total, shards)
+    start = 0
+    for shard in range(shards):
+        stop = start + step + (shard < extra)
+        if stop > start:
+            yield start, stop
+        start = stop
+
+
+class _Table:
+    """
+    One model's multi-row INSERT, built once. Rows are dicts of attnames;
+    missing fields take the model default, as bulk_create would give them,
+    and values are adapted for the database the way the fields would.
+    """
+
+    def __init__(self, model, given):
+        now = timezone.now()
+        ops = connection.ops
+        self.columns = []
+        for field in model._meta.concrete_fields:
+            if field.primary_key and field.attname not in given:
+                continue
+            default = now if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False) else field.get_default()
+            kind = (field.target_field if field.is_relation else field).get_internal_type()
+            convert = None
+            if kind == 'DateTimeField':
+                convert = ops.adapt_datetimefield_value
+            elif kind == 'DateField':
+                convert = ops.adapt_datefield_value
+            elif kind == 'UUIDField' and not connection.features.has_native_uuid_field:
+                convert = lambda value: value.hex if value is not None else None  # noqa: E731
+            self.columns.append((field.attname, default, convert, field.column))
+        self.head = 'INSERT INTO {} ({}) VALUES '.format(
+            ops.quote_name(model._meta.db_table), ', '.join(ops.quote_name(c[3]) for c in self.columns)
+        )
+        self.placeholder = '(' + ', '.join(['%s'] * len(self.columns)) + ')'
+        max_params = connection.features.max_query_params or 10 ** 6
+        self.rows_per_statement = max(1, max_params // len(self.columns))
+
+    def values(self, row):
+        for attname, default, convert, _ in self.columns:
+            value = row.get(attname, default)
+            yield convert(value) if convert is not None and value is not None else value
+
+    def insert(self, cursor, rows, batch_size):
+        step = min(batch_size, self.rows_per_statement)
+        for i in range(0, len(rows), step):
+            chunk = rows[i:i + step]
+            params = [value for row in chunk for value in self.values(row)]
+            # The driver-level cursor: DEBUG query logging would copy every parameter
+            cursor.cursor.execute(self.head + ', '.join([self.placeholder] * len(chunk)), params)
+
+
+class _Writer:
+    """
+    Buffers rows per model and inserts them, each batch in its own
+    transaction. A full buffer flushes every buffer, parents first, so
+    foreign keys always point at rows already written.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.rows = {}
+        self.tables = {}
+        self.counts = {}
+
+    def add(self, model, **row):
+        rows = self.rows.setdefault(model, [])
+        rows.append(row)
+        if model not in self.tables:
+            self.tables[model] = _Table(model, row)
+        if len(rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for model in sorted(self.rows, key=WRITE_ORDER.index):
+            rows = self.rows.pop(model)
+            with db_transaction.atomic(), connection.cursor() as cursor:
+                self.tables[model].insert(cursor, rows, self.batch_size)
+            name = 'memberships' if model is Membership else model._meta.label
+            self.counts[name] = self.counts.get(name, 0) + len(rows)
+
+
+def _prepare_connection():
+    # SQLite refuses to change these inside a transaction (a caller's atomic block, or a TestCase)
+    if connection.vendor == 'sqlite' and not connection.in_atomic_block:
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous=OFF')
+            cursor.execute('PRAGMA busy_timeout=60000')  # shards take turns to write
+
+
+def seed_users(config, start, stop):
+    """Users `start` to `stop` (numbers, not ids). Returns row counts."""
+    _prepare_connection()
+    writer = _Writer(config['batch_size'])
+    joined = timezone.make_aware(datetime.combine(config['until'], dt_time(9)))
+    for n in range(start, stop):
+        username = f"{config['prefix']}u{n:07d}"
+        writer.add(
+            User, id=config['user_base'] + n, username=username, email=f"{username}@load.example",
+            password=PASSWORD, phone_number=_phone(n), date_joined=joined,
+            first_name=NAME_WORDS[n % len(NAME_WORDS)],
+        )
+    writer.flush()
+    return writer.counts
+
+
+def _periods(chama, start, until):
+    """Due dates from `start` to `until` on the chama's schedule"""
+    if chama.contribution_frequency == 'WEEKLY':
+        day = start + timedelta(days=(chama.contribution_weekday - start.weekday()) % 7)
+        while day <= until:
+            yield day
+            day += timedelta(days=7)
+        return
+    year, month = start.year, start.month
+    while True:
+        day = start.replace(year=year, month=month, day=chama.contribution_day)
+        if day > until:
+            return
+        if day >= start:
+            yield day
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _phone(number):
+    return f"2547{number % 10 ** 8:08d}"
+
+
+def _at(day, rng):
+    moment = datetime.combine(day, dt_time(rng.randrange(6, 22), rng.randrange(60)))
+    return timezone.make_aware(moment, timezone.get_default_timezone())
+
+
+def seed_chamas(config, start, stop):
+    """Chamas `start` to `stop` with their members, contributions, loans, investments and penalties"""
+    _prepare_connection()
+    writer = _Writer(config['batch_size'])
+    until = config['until']
+    history_start = (until - timedelta(days=31 * config['months'])).replace(day=1)
+    user_column = f"{Chama.members.field.m2m_reverse_field_name()}_id"
+    for n in range(start, stop):
+        rng = random.Random(f"{config['seed']}:chama:{n}")
+        weekly = rng.random() < config['weekly_share']
+        name = f"{rng.choice(NAME_WORDS)} {rng.choice(GROUP_WORDS)} {n}"
+        member_numbers = rng.sample(range(config['users']), min(rng.randint(*config['members']), config['users']))
+        members = [config['user_base'] + m for m in member_numbers]
+        contribution = Decimal(rng.choice(CONTRIBUTIONS))
+        created = history_start + timedelta(days=rng.randrange(28))
+        county = rng.choice(COUNTIES)
+        values = dict(
+            id=uuid.UUID(int=rng.getrandbits(128), version=4),
+            name=name, slug=f"{config['prefix']}c{n:07d}", county=county,
+            phone=_phone(member_numbers[0]), created_by_id=members[0],
+            contribution_frequency='WEEKLY' if weekly else 'MONTHLY',
+            contribution_day=None if weekly else rng.randint(1, 28),
+            contribution_weekday=rng.randrange(7) if weekly else None,
+            monthly_contribution=contribution,
+            penalty_amount=Decimal(rng.choice([0, 50, 100, 200])),
+            is_public=rng.random() < 0.6,
+            description=f"{name} is a chama in {county} saving together since {created:%B %Y}.",
+            created_at=timezone.make_aware(datetime.combine(created, dt_time(12))),
+            # What Chama.save() fills in
+            meta_title=f"{name} - ChamaPro Investment Group"[:60],
+            meta_description=f"Join {name} chama in {county}. Monthly contribution: KSh {contribution}"[:160],
+            meta_keywords=f"chama, investment group, {county}, savings, Kenya",
+        )
+        writer.add(Chama, **values)
+        chama = Chama(**values)
+        for user_id in members:
+            writer.add(Membership, chama_id=chama.id, **{user_column: user_id})
+        _contributions(writer, rng, config, n, chama, members, created, until)
+        _loans(writer, rng, config, n, chama, members, until)
+        for i in range(rng.randint(0, INVESTMENTS_PER_CHAMA)):
+            investment_id = config['investment_base'] + n * INVESTMENTS_PER_CHAMA + i
+            invested = created + timedelta(days=rng.randrange(max((until - created).days, 1)))
+            amount = contribution * rng.randint(5, 50)
+            writer.add(
+                Investment, id=investment_id, chama_id=chama.id, name=f"{rng.choice(INVESTMENTS)} {i + 1}",
+                amount=amount, date_invested=invested, expected_return_date=invested + timedelta(days=365),
+                expected_return_amount=amount * Decimal('1.12'),
+                status=rng.choice(['active', 'active', 'matured', 'liquidated']), created_at=_at(invested, rng),
+            )
+            writer.add(
+                LedgerEntry, chama_id=chama.id, kind='INVESTMENT', amount=-amount,
+                reference=f"investment:{investment_id}:1", created_at=_at(invested, rng),
+            )
+    writer.flush()
+    return writer.counts
+
+
+def _contributions(writer, rng, config, n, chama, members, created, until):
+    """One payment attempt per member per due date; most succeed, missed ones may be penalised"""
+    amount = chama.monthly_contribution
+    for p, due in enumerate(_periods(chama, created, until)):
+        recent = (until - due).days < 3
+        for m, user_id in enumerate(members):
+            reference = f"{config['prefix']}{n}-{p}-{m}"
+            roll = rng.random()
+            if roll < 0.9:
+                status = 'PENDING' if recent and roll < 0.05 else ('FAILED' if roll < 0.04 else 'SUCCESS')
+                paid_at = _at(due - timedelta(days=rng.randrange(3)), rng)
+                writer.add(
+                    MpesaTransaction, user_id=user_id, chama_id=chama.id, amount=amount,
+                    merchant_request_id=reference, checkout_request_id=reference,
+                    phone_number=_phone(user_id - config['user_base']), status=status, transaction_date=paid_at,
+                    receipt_number=reference.upper() if status == 'SUCCESS' else None,
+                    description='Payment Successful' if status == 'SUCCESS' else None,
+                )
+                if status == 'SUCCESS':
+                    writer.add(
+                        LedgerEntry, chama_id=chama.id, kind='CONTRIBUTION', amount=amount,
+                        reference=f"mpesa:{reference}", created_at=paid_at,
+                    )
+            elif chama.penalty_amount and not recent:
+                paid = rng.random() < 0.5
+                writer.add(
+                    Penalty, user_id=user_id, chama_id=chama.id, amount=chama.penalty_amount, period=due,
+                    reason=f"Late contribution for {due:%d %b %Y}", date_assessed=due + timedelta(days=7),
+                    is_paid=paid, paid_at=_at(due + timedelta(days=10), rng) if paid else None,
+                )
+
+
+def _loans(writer, rng, config, n, chama, members, until):
+    """A few loans per chama in every status, with the ledger entries each status implies"""
+    statuses = [status for status, weight in LOAN_STATUSES for _ in range(weight)]
+    for j in range(rng.randint(0, LOANS_PER_CHAMA)):
+        loan_id = config['loan_base'] + n * LOAN_ID_STRIDE + j
+        status = rng.choice(statuses)
+        requested = _at(until - timedelta(days=rng.randrange(1, 30 * config['months'])), rng)
+        acted = requested + timedelta(days=rng.randrange(1, 5)) if status != 'PENDING' else None
+        paid_out = status in ('DISBURSED', 'PAID')
+        amount = chama.monthly_contribution * rng.randint(1, 6)
+        writer.add(
+            Loan, id=loan_id, chama_id=chama.id, borrower_id=rng.choice(members), amount=amount,
+            duration_months=rng.choice([1, 3, 6]), status=status, request_date=requested,
+            action_date=acted, action_by_id=members[0] if acted else None,
+            conversation_id=f"AG_{config['prefix']}{loan_id}" if paid_out or status == 'FAILED' else '',
+            receipt_number=f"L{config['prefix']}{loan_id}".upper() if paid_out else '',
+            disbursed_at=acted + timedelta(minutes=1) if paid_out else None,
+            failure_reason='The initiator information is invalid.' if status == 'FAILED' else '',
+        )
+        if status in RESERVING:
+            writer.add(
+                LedgerEntry, chama_id=chama.id, kind='DISBURSEMENT', amount=-amount,
+                reference=f"loan:{loan_id}", created_at=acted,
+            )
+        if status == 'FAILED':
+            writer.add(
+                LedgerEntry, chama_id=chama.id, kind='REFUND', amount=amount,
+                reference=f"loan:{loan_id}", created_at=acted + timedelta(minutes=5),
+            )
+
+
+def _merge(results):
+    totals = {}
+    for counts in results:
+        for name, count in counts.items():
+            totals[name] = totals.get(name, 0) + count
+    return totals
+
+
+def generate(config, shards=8, workers=1):
+    """
+    Seed users, then chamas, each phase split into `shards`. With `workers`
+    above one the shards run in a pool of forked processes that is reused
+    for both phases. Returns row counts per model.
+    """
+    user_jobs = [(config, *r) for r in shard_ranges(config['users'], shards)]
+    chama_jobs = [(config, *r) for r in shard_ranges(config['chamas'], shards)]
+    if workers <= 1:
+        counts = _merge(
+            [seed_users(*job) for job in user_jobs] + [seed_chamas(*job) for job in chama_jobs]
+        )
+    else:
+        # Children must open their own connections, not share the parent's
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            counts = _merge(pool.starmap(seed_users, user_jobs) + pool.starmap(seed_chamas, chama_jobs))
+
+    # Explicit ids leave Postgres sequences behind
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [User, Loan, Investment]):
+            cursor.execute(sql)
+    return counts
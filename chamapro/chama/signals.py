@@ -0,0 +1,50 @@
+# chama/signals.py
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from . import search
+from .caching import invalidate_dashboards, invalidate_directory
+from .models import Chama
+from .obligations import member_pairs
+
+
+@receiver(m2m_changed, sender=Chama.members.through)
+def membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Joining or leaving a chama changes every affected member's dashboard"""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # user.chamas.add(...): the instance is the user
+        user_ids = {instance.pk}
+        chama_ids = set(pk_set or instance.chamas.values_list('id', flat=True))
+    else:
+        user_ids = set(pk_set or [])
+        chama_ids = {instance.pk}
+    # Member counts change for everyone else in those chamas too
+    user_ids |= {user_id for _, user_id in member_pairs(chama_ids)}
+    transaction.on_commit(lambda: invalidate_dashboards(user_ids))
+
+
+@receiver(post_save, sender=Chama)
+def chama_saved(sender, instance, created, **kwargs):
+    if not created:
+        user_ids = {user_id for _, user_id in member_pairs([instance.pk])}
+        transaction.on_commit(lambda: invalidate_dashboards(user_ids))
+
+
+@receiver(post_save, sender=Chama)
+def chama_search_sync(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    """Keep the full-text index in the same transaction as the save; counts are recomputed after commit"""
+    if raw or (update_fields is not None and not search.DIRECTORY_FIELDS & set(update_fields)):
+        return
+    search.index_chamas([instance])
+    # An existing chama may just have been made private
+    if instance.is_public or not created:
+        transaction.on_commit(invalidate_directory)
+
+
+@receiver(post_delete, sender=Chama)
+def chama_search_remove(sender, instance, **kwargs):
+    search.unindex_chamas([instance.pk])
+    if instance.is_public:
+        transaction.on_commit(invalidate_directory)
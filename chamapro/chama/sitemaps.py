@@ -0,0 +1,116 @@
+# chama/sitemaps.py
+"""
+sitemap.xml for the public chama directory: an index pointing at numbered
+pages of PAGE_SIZE chamas each, oldest first so pages only grow at the end.
+
+Pages are rendered from values_list rows (no model instances) and kept in
+the shared cache under the `directory` namespace, so they are rebuilt only
+after a public chama changes. Each worker also keeps the pages it served,
+re-reading the namespace version at most every LOCAL_TTL seconds: with the
+database cache backend a crawler polling the sitemap would otherwise cost a
+query per request.
+"""
+import hashlib
+import threading
+import time
+from datetime import timezone
+from django.conf import settings
+from django.urls import reverse
+from xml.sax.saxutils import escape
+from .caching import SITEMAP_TIMEOUT, directory
+from .models import Chama
+
+PAGE_SIZE = 10000  # the protocol allows 50,000 URLs per file
+LOCAL_TTL = 30
+MAX_AGE = 60 * 60  # Cache-Control for crawlers and proxies
+
+XMLNS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+_lock = threading.Lock()
+_local = {'version': None, 'checked': 0.0, 'pages': {}}
+
+
+def reset():
+    """Forget this worker's copies (tests, or after a bulk load)"""
+    with _lock:
+        _local.update(version=None, checked=0.0, pages={})
+
+
+def get(page=None):
+    """
+    {'body', 'etag', 'last_modified', 'pages'} for the index (page None) or
+    a page of chamas; None when there is no such page.
+    """
+    pages = _local_pages()
+    if page not in pages:
+        # Checked against the index so probing past the end stores nothing
+        if page is not None and not 1 <= page <= get()['pages']:
+            return None
+        key = directory.key('sitemap', 'index' if page is None else page)
+        entry = directory.cache.get(key)
+        if entry is None:
+            entry = _build(page)
+            directory.cache.set(key, entry, SITEMAP_TIMEOUT)
+        pages[page] = entry
+    return pages[page]
+
+
+def _local_pages():
+    now = time.monotonic()
+    with _lock:
+        if now - _local['checked'] >= LOCAL_TTL:
+            version = directory.version()
+            if version != _local['version']:
+                _local.update(version=version, pages={})
+            _local['checked'] = now
+        return _local['pages']
+
+
+def _public():
+    # Ordered along chama_directory_recent_idx
+    return Chama.objects.filter(is_active=True, is_public=True).order_by('created_at', 'id')
+
+
+def _build(page):
+    if page is None:
+        return _build_index()
+    rows = _public().values_list('id', 'slug', 'updated_at')[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+    parts, last_modified = [], None
+    for pk, slug, updated_at in rows.iterator(chunk_size=2000):
+        url = reverse('chama:chama_detail', kwargs={'slug': slug, 'pk': pk})
+        parts.append(f"<url><loc>{escape(_absolute(url))}</loc><lastmod>{_w3c(updated_at)}</lastmod></url>")
+        last_modified = max(last_modified or updated_at, updated_at)
+    return _entry('urlset', parts, last_modified)
+
+
+def _build_index():
+    """One pass over the directory's update times, split into pages"""
+    latest = []
+    for n, updated_at in enumerate(_public().values_list('updated_at', flat=True).iterator(chunk_size=5000)):
+        if n % PAGE_SIZE == 0:
+            latest.append(updated_at)
+        elif updated_at > latest[-1]:
+            latest[-1] = updated_at
+    parts = [
+        f"<sitemap><loc>{escape(_absolute(reverse('sitemap_page', kwargs={'page': n})))}</loc>"
+        f"<lastmod>{_w3c(updated_at)}</lastmod></sitemap>"
+        for n, updated_at in enumerate(latest, start=1)
+    ]
+    return _entry('sitemapindex', parts, max(latest, default=None), pages=len(latest))
+
+
+def _entry(root, parts, last_modified, pages=None):
+    body = (
+        f'<?xml version="1.0" encoding="UTF-8"?>\n<{root} xmlns="{XMLNS}">\n'
+        + ''.join(f"{part}\n" for part in parts)
+        + f"</{root}>\n"
+    ).encode()
+    return {'body': body, 'etag': hashlib.md5(body).hexdigest(), 'last_modified': last_modified, 'pages': pages}
+
+
+def _absolute(path):
+    return settings.SITE_URL.rstrip('/') + path
+
+
+def _w3c(value):
+    return value.astimezone(timezone.utc).isoformat(timespec='seconds')
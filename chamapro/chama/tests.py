@@ -1,3 +1,650 @@
-from django.test import TestCase
+import io
+import json
+import os
+import subprocess
+import tempfile
+import time
+from unittest import mock
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+from django.urls import reverse
+from chamapro.cache import CacheNamespace, reset_stats, stats
+from chamapro import metrics, profiling
+from chamapro.metrics import registry
+from payments.drift import verify_balances
+from payments.models import MpesaTransaction
+from . import benchmarks, ledger, search, seeding, sitemaps
+from .obligations import generate_obligations, record_contributions
+from .penalties import assess_penalties, due_chamas
+from .caching import invalidate_dashboards
+from .membership import ADMIN, MEMBER, resolve_chama
+from .models import BalanceSnapshot, Chama, ContributionObligation, LedgerEntry, Penalty, RequestProfile
 
-# Create your tests here.
+User = get_user_model()
+
+
+class DashboardQueryCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='member', email='member@example.com', password='pw')
+        self.others = [
+            User.objects.create_user(username=f'other{i}', email=f'other{i}@example.com', password='pw')
+            for i in range(3)
+        ]
+        self.client.force_login(self.user)
+        self.url = reverse('chama:dashboard')
+
+    def add_chamas(self, count):
+        for i in range(Chama.objects.count(), Chama.objects.count() + count):
+            chama = Chama.objects.create(
+                name=f'Chama {i}', county='Nairobi', phone='254700000000',
+                monthly_contribution=500, created_by=self.user,
+            )
+            chama.members.add(self.user, *self.others)
+
+    def cold_dashboard_queries(self):
+        invalidate_dashboards([self.user.pk])
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_chamas(self):
+        self.add_chamas(1)
+        self.client.get(self.url)  # warm the session cache
+        one = self.cold_dashboard_queries()
+        self.add_chamas(29)
+        thirty = self.cold_dashboard_queries()
+        self.assertEqual(one, thirty)
+
+    def test_cached_fragment_is_reused_until_membership_changes(self):
+        self.add_chamas(2)
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(self.url)
+        self.assertFalse(any('chama_chama' in q['sql'] for q in ctx.captured_queries))
+
+        newcomer = User.objects.create_user(username='newcomer', email='new@example.com', password='pw')
+        with self.captureOnCommitCallbacks(execute=True):
+            Chama.objects.first().members.add(newcomer)
+        response = self.client.get(self.url)
+        self.assertContains(response, '5 Members')
+
+
+class MembershipAccessTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', email='owner@example.com', password='pw')
+        self.member = User.objects.create_user(username='member', email='member@example.com', password='pw')
+        self.outsider = User.objects.create_user(username='outsider', email='outsider@example.com', password='pw')
+        self.chama = Chama.objects.create(
+            name='Access Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.owner,
+        )
+        self.chama.members.add(self.owner, self.member)
+        self.members_url = reverse('chama:members_list', kwargs={'slug': self.chama.slug, 'pk': self.chama.pk})
+
+    def test_roles(self):
+        for user, expected in ((self.owner, ADMIN), (self.member, MEMBER), (self.outsider, None)):
+            request = RequestFactory().get('/')
+            request.user = user
+            with self.assertNumQueries(1):
+                _, role = resolve_chama(request, id=self.chama.pk)
+            self.assertEqual(role, expected)
+
+    def test_member_views_reject_outsiders(self):
+        self.client.force_login(self.outsider)
+        self.assertRedirects(self.client.get(self.members_url), reverse('chama:dashboard'))
+        self.client.force_login(self.member)
+        self.assertEqual(self.client.get(self.members_url).status_code, 200)
+
+    def test_admin_views_reject_members(self):
+        url = reverse('chama:add_investment', kwargs={'slug': self.chama.slug, 'pk': self.chama.pk})
+        self.client.force_login(self.member)
+        self.assertRedirects(self.client.get(url), reverse('chama:dashboard'))
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class SharedCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_stats()
+
+    def test_namespace_invalidation_orphans_old_keys(self):
+        reports = CacheNamespace('reports')
+        cache.set(reports.key('summary'), 'old')
+        reports.invalidate()
+        self.assertIsNone(cache.get(reports.key('summary')))
+
+    def test_hits_and_misses_are_counted_by_namespace(self):
+        cache.get('reports:missing')
+        cache.set('reports:present', 1)
+        cache.get_many(['reports:present', 'other:missing'])
+        self.assertEqual(stats()['reports'], {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+        self.assertEqual(stats()['other']['misses'], 1)
+
+
+@override_settings(METRICS_SAMPLE_RATE=1.0, METRICS_TOKEN='scrape-token')
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.enterContext(override_settings(METRICS_DIR=self.enterContext(tempfile.TemporaryDirectory())))
+        metrics._new_worker()
+        registry.reset()
+        self.user = User.objects.create_user(username='member', email='member@example.com', password='pw')
+
+    def scrape(self, **headers):
+        return self.client.get(reverse('metrics'), **headers)
+
+    def test_metrics_need_the_token_or_staff(self):
+        self.assertEqual(self.scrape().status_code, 401)
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        self.client.force_login(self.user)
+        self.assertEqual(self.scrape().status_code, 401)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(self.scrape().status_code, 200)
+
+    def test_requests_queries_and_callbacks_are_exported(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('chama:dashboard'))
+        self.client.post(reverse('payments:callback'), data='not json', content_type='application/json')
+        self.client.logout()
+
+        response = self.scrape(HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        body = response.content.decode()
+        self.assertIn('chamapro_http_requests_total{view="chama:dashboard",method="GET",status="200"} 1', body)
+        self.assertIn('chamapro_http_request_duration_seconds_count{view="chama:dashboard"} 1', body)
+        self.assertIn('chamapro_sampled_requests_total{view="chama:dashboard"} 1', body)
+        queries = [line for line in body.splitlines() if line.startswith('chamapro_db_queries_total{view="chama:dashboard"}')]
+        self.assertGreater(int(queries[0].split()[-1]), 0)
+        self.assertIn('chamapro_mpesa_callbacks_total{kind="stk",outcome="invalid"} 1', body)
+        self.assertIn('chamapro_mpesa_breaker_state{state="closed"} 1', body)
+
+    def test_scrapes_add_up_every_worker(self):
+        dashboard = 'chamapro_http_requests_total{view="chama:dashboard",method="GET",status="200"}'
+        self.client.force_login(self.user)
+        self.client.get(reverse('chama:dashboard'))
+        self.client.get(reverse('chama:dashboard'))
+        metrics.flush(force=True)
+        # The next requests are served by another worker, which has counted nothing yet
+        metrics._forked()
+        self.client.get(reverse('chama:dashboard'))
+        self.client.logout()
+
+        totals = []
+        for _ in range(2):
+            body = self.scrape(HTTP_AUTHORIZATION='Bearer scrape-token').content.decode()
+            totals.append(next(line for line in body.splitlines() if line.startswith(dashboard)))
+        self.assertEqual(totals, [f'{dashboard} 3'] * 2)
+        self.assertEqual(len(os.listdir(settings.METRICS_DIR)), 2)
+
+        with override_settings(METRICS_DIR=''):
+            self.assertEqual(metrics.collect()['requests'][('chama:dashboard', 'GET', 200)], 1)
+
+    def test_exited_workers_are_folded_into_one_file(self):
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        figures = {**metrics._figures(), 'requests': [['chama:dashboard', 'GET', 200, 4]]}
+        for n in range(2):
+            with open(os.path.join(settings.METRICS_DIR, f'{exited.pid}-{n}.json'), 'w') as f:
+                json.dump(figures, f)
+
+        for _ in range(2):
+            self.assertEqual(metrics.collect()['requests'][('chama:dashboard', 'GET', 200)], 8)
+        self.assertEqual(
+            sorted(os.listdir(settings.METRICS_DIR)), sorted(['.lock', metrics.RETIRED, f"{metrics._worker['id']}.json"]),
+        )
+
+    @override_settings(METRICS_SAMPLE_RATE=0.0)
+    def test_no_queries_are_counted_with_sampling_off(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('chama:dashboard'))
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['requests'][('chama:dashboard', 'GET', 200)], 1)
+        self.assertEqual(snapshot['sampled'], {})
+
+
+class ProfilerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='staff', email='staff@example.com', password='pw', is_staff=True, is_superuser=True)
+        chama = Chama.objects.create(
+            name='Profiled', county='Nairobi', phone='254700000000', monthly_contribution=500, created_by=self.user,
+        )
+        chama.members.add(self.user)
+        self.client.force_login(self.user)
+
+    def test_staff_flag_profiles_the_request(self):
+        response = self.client.get(reverse('chama:dashboard'), {'_profile': '1'})
+        profile = RequestProfile.objects.get()
+        self.assertEqual(response['X-Profile'], reverse('admin:chama_requestprofile_change', args=[profile.pk]))
+        self.assertEqual((profile.view_name, profile.trigger, profile.status_code), ('chama:dashboard', 'flag', 200))
+        self.assertGreater(profile.sql_count, 0)
+        self.assertEqual(len(profile.report['sql']['queries']), profile.sql_count)
+        self.assertGreater(profile.template_ms, 0)
+        self.assertIn('chama/dashboard.html', [t['name'] for t in profile.report['templates'] if t['depth'] == 0])
+
+        self.assertEqual(self.client.get(response['X-Profile']).status_code, 200)
+        collapsed = self.client.get(reverse('admin:chama_requestprofile_collapsed', args=[profile.pk]))
+        self.assertEqual(collapsed.content.decode(), profile.collapsed)
+        report = self.client.get(reverse('admin:chama_requestprofile_report', args=[profile.pk]))
+        self.assertEqual(report.json()['sql']['count'], profile.sql_count)
+
+    def test_flag_is_ignored_for_members(self):
+        self.user.is_staff = False
+        self.user.save()
+        response = self.client.get(reverse('chama:dashboard'), HTTP_X_PROFILE='1')
+        self.assertNotIn('X-Profile', response)
+        self.assertFalse(RequestProfile.objects.exists())
+
+    @override_settings(PROFILER_SAMPLE_RATE=1.0, PROFILER_KEEP=2)
+    def test_sampled_requests_are_profiled_and_pruned(self):
+        self.client.logout()
+        for _ in range(3):
+            self.client.get(reverse('home'))
+        self.assertEqual(list(RequestProfile.objects.values_list('trigger', flat=True)), ['sample', 'sample'])
+
+    def test_stacks_and_gateway_calls_are_collected(self):
+        profile = profiling.Profile(interval=0.001)
+        profile.start()
+        try:
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                pass
+            profiling.record_call('stk_push', 0.2, 200)
+        finally:
+            profile.stop()
+        profiling.record_call('stk_push', 0.1, 200)  # no profile running: ignored
+        self.assertGreater(profile.samples, 0)
+        self.assertIn('chama/tests.py:test_stacks_and_gateway_calls_are_collected', profile.collapsed())
+        self.assertEqual(profile.calls, [{'endpoint': 'stk_push', 'ms': 200.0, 'outcome': '200'}])
+
+
+class ViewBudgetTests(TestCase):
+    """The committed query budgets of chama/benchmarks.json, on the small fixture"""
+
+    def test_views_stay_within_their_query_budgets(self):
+        fixture = benchmarks.build_fixture('small')
+        results = benchmarks.measure(fixture, iterations=1)
+        self.assertEqual(benchmarks.over_budget('small', results, benchmarks.load_baselines()), [])
+
+    def test_an_extra_query_is_over_budget(self):
+        budget = benchmarks.load_baselines()['small']['profile_view']
+        result = {'profile_view': {'queries': budget['queries'] + 1, 'p95_ms': budget['p95_ms']}}
+        problems = benchmarks.over_budget('small', result, benchmarks.load_baselines())
+        self.assertEqual(problems, [f"small/profile_view: {budget['queries'] + 1} queries, budget {budget['queries']}"])
+
+
+class ObligationTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', email='o@example.com', password='pw')
+        self.member = User.objects.create_user(username='member', email='m@example.com', password='pw')
+        self.monthly = Chama.objects.create(
+            name='Monthly Chama', county='Nairobi', phone='254700000000', monthly_contribution=500,
+            contribution_day=10, created_by=self.owner,
+        )
+        self.weekly = Chama.objects.create(
+            name='Weekly Chama', county='Nairobi', phone='254700000000', monthly_contribution=100,
+            contribution_frequency='WEEKLY', contribution_weekday=4, created_by=self.owner,
+        )
+        Chama.objects.create(
+            name='Closed Chama', county='Nairobi', phone='254700000000', monthly_contribution=100,
+            is_active=False, created_by=self.owner,
+        ).members.add(self.member)
+        self.monthly.members.add(self.owner, self.member)
+        self.weekly.members.add(self.member)
+
+    def test_current_periods_are_opened_once(self):
+        self.assertEqual(generate_obligations(today=date(2026, 10, 14), chunk_size=1), 3)
+        self.assertEqual(generate_obligations(today=date(2026, 10, 14)), 3)
+        rows = set(ContributionObligation.objects.values_list('chama__name', 'user__username', 'period_start', 'due_date', 'expected_amount', 'status'))
+        self.assertEqual(rows, {
+            ('Monthly Chama', 'owner', date(2026, 10, 1), date(2026, 10, 10), 500, 'DUE'),
+            ('Monthly Chama', 'member', date(2026, 10, 1), date(2026, 10, 10), 500, 'DUE'),
+            ('Weekly Chama', 'member', date(2026, 10, 12), date(2026, 10, 16), 100, 'DUE'),
+        })
+        # A new period opens new obligations next to the old ones
+        generate_obligations(today=date(2026, 11, 2))
+        self.assertEqual(ContributionObligation.objects.count(), 6)
+
+    def test_partial_then_full_payment_settles_the_obligation(self):
+        generate_obligations(today=date(2026, 10, 14))
+        paid_on = timezone.make_aware(datetime(2026, 10, 14, 12))
+
+        def pay(amount):
+            # As the callback worker passes them: settled, dated when the member paid
+            record_contributions([MpesaTransaction(
+                user=self.member, chama=self.monthly, amount=amount, status='SUCCESS', transaction_date=paid_on,
+            )])
+            return ContributionObligation.objects.get(chama=self.monthly, user=self.member)
+
+        obligation = pay(200)
+        self.assertEqual((obligation.paid_amount, obligation.status), (200, 'PARTIAL'))
+        obligation = pay(300)
+        self.assertEqual((obligation.paid_amount, obligation.status), (500, 'PAID'))
+        self.assertEqual(ContributionObligation.objects.get(chama=self.monthly, user=self.owner).status, 'DUE')
+
+
+class PenaltyScheduleTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', email='o@example.com', password='pw')
+
+    def chama(self, **fields):
+        return Chama.objects.create(
+            name='Schedule Chama', county='Nairobi', phone='254700000000', monthly_contribution=500,
+            penalty_amount=100, created_by=self.owner, **fields,
+        )
+
+    def test_monthly_due_dates_end_of_month(self):
+        chama = self.chama(contribution_day=31)
+        self.assertEqual(chama.contribution_period(date(2025, 2, 14)), (date(2025, 2, 1), date(2025, 3, 1)))
+        self.assertEqual(chama.contribution_period(date(2025, 12, 31)), (date(2025, 12, 1), date(2026, 1, 1)))
+        self.assertEqual(chama.contribution_due_date(date(2025, 2, 1)), date(2025, 2, 28))
+        self.assertEqual(chama.contribution_due_date(date(2024, 2, 1)), date(2024, 2, 29))
+        self.assertEqual(chama.contribution_due_date(date(2025, 4, 1)), date(2025, 4, 30))
+        for day in (29, 30):
+            chama.contribution_day = day
+            self.assertEqual(chama.contribution_due_date(date(2025, 2, 1)), date(2025, 2, 28))
+            self.assertEqual(chama.contribution_due_date(date(2024, 2, 1)), date(2024, 2, 29))
+        chama.contribution_day = None
+        self.assertIsNone(chama.penalty_cutoff(date(2025, 2, 1)))
+        self.assertIsNone(chama.assessable_period(date(2025, 2, 14)))
+
+    def test_weekly_periods_start_on_monday(self):
+        chama = self.chama(contribution_frequency='WEEKLY', contribution_weekday=2, penalty_grace_period=1)
+        self.assertEqual(chama.contribution_period(date(2026, 10, 18)), (date(2026, 10, 12), date(2026, 10, 19)))
+        self.assertEqual(chama.contribution_due_date(date(2026, 10, 12)), date(2026, 10, 14))
+        self.assertEqual(chama.penalty_cutoff(date(2026, 10, 12)), date(2026, 10, 15))
+        # Before this week's cutoff has passed, last week is the one to assess
+        self.assertEqual(chama.assessable_period(date(2026, 10, 15)), date(2026, 10, 5))
+        self.assertEqual(chama.assessable_period(date(2026, 10, 16)), date(2026, 10, 12))
+
+    def test_grace_cutoff_boundary_and_lookback(self):
+        chama = self.chama(contribution_day=31, penalty_grace_period=3)
+        self.assertEqual(chama.penalty_cutoff(date(2025, 2, 1)), date(2025, 3, 3))
+        # Paying on the cutoff day is still on time
+        self.assertEqual(chama.assessable_period(date(2025, 3, 3)), date(2025, 1, 1))
+        self.assertEqual(chama.assessable_period(date(2025, 3, 4)), date(2025, 2, 1))
+
+        self.assertEqual(list(due_chamas(date(2025, 3, 4))), [(chama, date(2025, 2, 1))])
+        self.assertEqual(list(due_chamas(date(2025, 3, 6))), [])
+        self.assertEqual(list(due_chamas(date(2025, 3, 6), lookback_days=3)), [(chama, date(2025, 2, 1))])
+
+    def test_rerunning_the_assessment_creates_no_duplicates(self):
+        chama = self.chama(contribution_day=5, penalty_grace_period=2)
+        late, paid, partial = [
+            User.objects.create_user(username=name, email=f'{name}@example.com', password='pw')
+            for name in ('late', 'paid', 'partial')
+        ]
+        chama.members.add(late, paid, partial)
+        for user, amount, status in ((paid, 500, 'PAID'), (partial, 200, 'PARTIAL')):
+            ContributionObligation.objects.create(
+                chama=chama, user=user, period_start=date(2025, 3, 1), due_date=date(2025, 3, 5),
+                expected_amount=500, paid_amount=amount, status=status,
+            )
+
+        stats = assess_penalties(today=date(2025, 3, 8))
+        self.assertEqual(stats, {'chamas': 1, 'members': 3, 'penalties': 1})
+        self.assertEqual(assess_penalties(today=date(2025, 3, 8))['penalties'], 0)
+        self.assertEqual(assess_penalties(today=date(2025, 3, 9), lookback_days=2)['penalties'], 0)
+        penalty = Penalty.objects.get()
+        self.assertEqual((penalty.user, penalty.period, penalty.amount), (late, date(2025, 3, 1), 100))
+        self.assertEqual(penalty.reason, 'Late Contribution: March 2025')
+        # The late member's obligation was opened on the way
+        self.assertEqual(ContributionObligation.objects.get(user=late).status, 'DUE')
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='ledger', email='ledger@example.com', password='pw')
+        self.chama = Chama.objects.create(
+            name='Ledger Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.user,
+        )
+        self.start = timezone.now() - timedelta(days=10)
+
+    def add(self, days, amount, kind='CONTRIBUTION'):
+        LedgerEntry.objects.create(
+            chama=self.chama, kind=kind, amount=amount, created_at=self.start + timedelta(days=days)
+        )
+
+    def test_point_in_time_balances_with_and_without_snapshots(self):
+        for day, amount in [(0, 500), (1, 300), (3, -200), (5, 100), (8, 50)]:
+            self.add(day, amount)
+        expected = {2: 800, 4: 600, 9: 750}
+        for day, value in expected.items():
+            self.assertEqual(ledger.balance(self.chama.id, self.start + timedelta(days=day)), value)
+
+        # Snapshot as of day 4, then day 6: answers do not change, and the tail is short
+        ledger.take_snapshots(lag=timedelta(0), now=self.start + timedelta(days=4))
+        ledger.take_snapshots(lag=timedelta(0), now=self.start + timedelta(days=6))
+        self.assertEqual(list(BalanceSnapshot.objects.order_by('as_of').values_list('balance', 'entry_count')), [(600, 3), (700, 1)])
+        for day, value in expected.items():
+            self.assertEqual(ledger.balance(self.chama.id, self.start + timedelta(days=day)), value)
+        self.assertEqual(ledger.balance(self.chama.id), 750)
+
+        self.chama.refresh_from_db()
+        self.assertEqual(self.chama.total_balance, 700)
+        annotated = Chama.objects.annotate(balance=ledger.balance_expression()).get(pk=self.chama.pk)
+        self.assertEqual(annotated.balance, 750)
+
+    def test_snapshotting_again_without_new_entries_writes_nothing(self):
+        self.add(0, 500)
+        annotated = Chama.objects.annotate(balance=ledger.balance_expression()).get(pk=self.chama.pk)
+        self.assertEqual(annotated.balance, 500)
+        self.assertEqual(ledger.take_snapshots(lag=timedelta(0)), 1)
+        self.assertEqual(ledger.take_snapshots(lag=timedelta(0)), 0)
+        self.assertEqual(ledger.balance(self.chama.id), 500)
+
+    def test_an_entry_committed_after_a_snapshot_it_predates_is_kept(self):
+        self.add(0, 500)
+        ledger.take_snapshots(lag=timedelta(0), now=self.start + timedelta(days=2))
+        # Stamped on day 1 by its writer, but committed after the day-2 snapshot
+        self.add(1, 300)
+        self.assertEqual(ledger.balance(self.chama.id), 800)
+        self.assertEqual(ledger.take_snapshots(lag=timedelta(0)), 1)
+        self.assertEqual(BalanceSnapshot.objects.order_by('-as_of').first().balance, 800)
+        self.assertEqual(ledger.balance(self.chama.id), 800)
+
+    def test_investments_are_recorded_as_they_are_edited(self):
+        self.add(0, 5000)
+        self.chama.members.add(self.user)
+        self.client.force_login(self.user)
+        kwargs = {'slug': self.chama.slug, 'pk': self.chama.pk}
+        form = {'name': 'T-bill', 'amount': '2000', 'date_invested': '2026-01-05', 'status': 'active'}
+        self.client.post(reverse('chama:add_investment', kwargs=kwargs), form)
+        investment = self.chama.investments.get()
+        self.assertEqual(ledger.balance(self.chama.id), 3000)
+
+        edit = reverse('chama:edit_investment', kwargs={**kwargs, 'investment_id': investment.id})
+        self.client.post(edit, {**form, 'amount': '2500'})
+        self.client.post(edit, {**form, 'amount': '2500', 'status': 'matured'})
+        self.assertEqual(ledger.balance(self.chama.id), 2500)
+
+        self.client.post(reverse('chama:delete_investment', kwargs={**kwargs, 'investment_id': investment.id}))
+        self.assertEqual(ledger.balance(self.chama.id), 5000)
+        self.assertEqual(
+            list(LedgerEntry.objects.filter(kind='INVESTMENT').order_by('id').values_list('amount', 'reference')),
+            [(-2000, f'investment:{investment.id}:1'), (-500, f'investment:{investment.id}:2'), (2500, f'investment:{investment.id}:3')],
+        )
+
+
+class SeedScaleTests(TestCase):
+    options = {'users': 60, 'chamas': 6, 'months': 2, 'until': date(2026, 6, 30), 'workers': 1}
+
+    def fingerprint(self, shards):
+        with transaction.atomic():
+            config = seeding.make_config(seed=3, users=60, chamas=6, months=2, until=date(2026, 6, 30))
+            seeding.generate(config, shards=shards)
+            rows = list(
+                MpesaTransaction.objects.order_by('checkout_request_id')
+                .values_list('checkout_request_id', 'chama_id', 'user__username', 'amount', 'status', 'transaction_date')
+            )
+            transaction.set_rollback(True)
+        return rows
+
+    def test_same_seed_same_data_whatever_the_sharding(self):
+        one = self.fingerprint(shards=1)
+        self.assertTrue(one)
+        self.assertEqual(one, self.fingerprint(shards=4))
+
+    def test_seeded_ledgers_are_consistent(self):
+        out = io.StringIO()
+        call_command('seed_scale', shards=3, stdout=out, **self.options)
+        self.assertIn('Seed 1 loaded', out.getvalue())
+        self.assertEqual(Chama.objects.count(), 6)
+        self.assertEqual(User.objects.filter(username__startswith='s1-').count(), 60)
+        self.assertTrue(Chama.members.through.objects.exists())
+        self.assertEqual(verify_balances()['drifting'], 0)
+        with self.assertRaises(CommandError):
+            call_command('seed_scale', stdout=io.StringIO(), **self.options)
+
+
+class DirectorySearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(username='owner', email='o@example.com', password='pw')
+        self.umoja = self.add('Umoja Women Group', 'Nairobi', 'Westlands', excerpt='Table banking in Westlands')
+        self.youth = self.add('Umoja Youth', 'Kisumu', 'Kisumu Central', frequency='WEEKLY', amount=200,
+                              excerpt='Poultry farming')
+        self.baraka = self.add('Baraka Investment Club', 'Nairobi', 'Langata', amount=5000,
+                               description='Started by former Umoja members to buy land.')
+        self.add('Secret Umoja', 'Nairobi', 'Westlands', public=False)
+        self.add('Dormant Umoja', 'Nairobi', 'Westlands', active=False)
+
+    def add(self, name, county, constituency, frequency='MONTHLY', amount=500, public=True, active=True, **fields):
+        return Chama.objects.create(
+            name=name, county=county, constituency=constituency, contribution_frequency=frequency,
+            monthly_contribution=amount, is_public=public, is_active=active, phone='254700000000',
+            created_by=self.owner, **fields,
+        )
+
+    def names(self, query='', **filters):
+        return [chama.name for chama in search.search(query, filters)['results']]
+
+    def test_ranks_name_matches_first_and_hides_private_and_inactive_chamas(self):
+        found = search.search('umoja')
+        self.assertEqual(found['total'], 3)
+        self.assertEqual([c.name for c in found['results']][-1], 'Baraka Investment Club')
+        self.assertEqual(self.names('UMOJA women!'), ['Umoja Women Group'])
+        self.assertEqual(self.names('bara'), ['Baraka Investment Club'])  # last word as a prefix
+        self.assertEqual(self.names('farms'), ['Umoja Youth'])  # stemmed
+        self.assertEqual(self.names(), ['Baraka Investment Club', 'Umoja Youth', 'Umoja Women Group'])
+
+    def test_facets_leave_out_their_own_filter(self):
+        found = search.search('', {'county': ['Nairobi']})
+        self.assertEqual(found['total'], 2)
+        facets = found['facets']
+        self.assertEqual(
+            [(f['value'], f['count'], f['selected']) for f in facets['county']], [('Nairobi', 2, True), ('Kisumu', 1, False)]
+        )
+        self.assertEqual([(f['value'], f['count']) for f in facets['frequency']], [('MONTHLY', 2)])
+        self.assertEqual({f['value']: f['count'] for f in facets['contribution'] if f['count']}, {'500-2000': 1, '5000-10000': 1})
+
+        found = search.search('', {'county': ['Nairobi'], 'contribution': [5000, 10000]})
+        self.assertEqual([c.name for c in found['results']], ['Baraka Investment Club'])
+        self.assertEqual([(f['value'], f['count']) for f in found['facets']['county']], [('Nairobi', 1)])
+
+    def test_index_and_counts_follow_saves_and_deletes(self):
+        self.assertEqual(search.search('')['total'], 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.youth.name = 'Tumaini Youth'
+            self.youth.save()
+            self.baraka.is_public = False
+            self.baraka.save()
+        self.assertEqual(self.names('tumaini'), ['Tumaini Youth'])
+        self.assertEqual(self.names('umoja'), ['Umoja Women Group'])
+        self.assertEqual(search.search('')['total'], 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.umoja.delete()
+        self.assertEqual(self.names('umoja'), [])
+        self.assertEqual(search.search('')['total'], 1)
+
+    def test_public_endpoint(self):
+        url = reverse('api:chama_search')
+        response = self.client.get(url, {'q': 'umoja', 'county': 'Nairobi', 'contribution': '500-2000'})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([r['name'] for r in data['results']], ['Umoja Women Group'])
+        self.assertEqual(data['results'][0]['url'], self.umoja.get_absolute_url())
+        self.assertEqual((data['total'], data['page'], data['pages']), (1, 1, 1))
+        self.assertEqual(self.client.get(url, {'contribution': '1-2'}).status_code, 400)
+
+
+@override_settings(SITE_URL='https://chamapro.test')
+@mock.patch.object(sitemaps, 'PAGE_SIZE', 2)
+class SitemapTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        sitemaps.reset()
+        self.owner = User.objects.create_user(username='owner', email='o@example.com', password='pw')
+        now = timezone.now()
+        self.chamas = [self.add(f'Public {i}', created_at=now - timedelta(days=5 - i)) for i in range(3)]
+        self.add('Private', is_public=False)
+        self.add('Dormant', is_active=False)
+
+    def add(self, name, **fields):
+        return Chama.objects.create(
+            name=name, county='Nairobi', phone='254700000000', monthly_contribution=500,
+            created_by=self.owner, **{'is_public': True, **fields},
+        )
+
+    def test_index_pages_public_active_chamas_oldest_first(self):
+        response = self.client.get('/sitemap.xml')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/xml')
+        body = response.content.decode()
+        self.assertIn('<loc>https://chamapro.test/sitemap-chamas-1.xml</loc>', body)
+        self.assertIn('<loc>https://chamapro.test/sitemap-chamas-2.xml</loc>', body)
+        self.assertNotIn('sitemap-chamas-3.xml', body)
+
+        first = self.client.get(reverse('sitemap_page', kwargs={'page': 1})).content.decode()
+        second = self.client.get(reverse('sitemap_page', kwargs={'page': 2})).content.decode()
+        for chama, page in zip(self.chamas, [first, first, second]):
+            self.assertIn(f'<loc>https://chamapro.test{chama.get_absolute_url()}</loc>', page)
+        self.assertIn(f'<lastmod>{self.chamas[2].updated_at.astimezone(dt_timezone.utc).isoformat(timespec="seconds")}', second)
+        self.assertEqual(first.count('<url>') + second.count('<url>'), 3)
+        self.assertEqual(self.client.get('/sitemap-chamas-3.xml').status_code, 404)
+
+    def test_repeat_and_conditional_requests_skip_the_database(self):
+        response = self.client.get('/sitemap-chamas-1.xml')
+        self.assertIn('public', response['Cache-Control'])
+        self.assertEqual(response['Last-Modified'], http_date(self.chamas[1].updated_at.timestamp()))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/sitemap-chamas-1.xml').content, response.content)
+            self.assertEqual(self.client.get('/sitemap-chamas-1.xml', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            self.assertEqual(
+                self.client.get('/sitemap-chamas-1.xml', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304
+            )
+            self.assertEqual(self.client.get('/sitemap-chamas-9.xml').status_code, 404)
+        self.assertEqual(len(queries), 0)
+
+        # Another worker reuses the shared cache instead of querying the chamas
+        sitemaps.reset()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/sitemap-chamas-1.xml')
+        self.assertFalse([q for q in queries if 'chama_chama' in q['sql']])
+
+    @mock.patch.object(sitemaps, 'LOCAL_TTL', 0)
+    def test_rebuilt_when_a_public_chama_changes(self):
+        etag = self.client.get('/sitemap-chamas-2.xml')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chamas[2].slug = 'renamed'
+            self.chamas[2].save()
+        response = self.client.get('/sitemap-chamas-2.xml', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('/renamed/', response.content.decode())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chamas[0].is_public = False
+            self.chamas[0].save()
+        self.assertEqual(self.client.get('/sitemap-chamas-2.xml').status_code, 404)
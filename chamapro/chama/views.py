@@ -1,23 +1,32 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.conf import settings
 from django.contrib import messages
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition, require_safe
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import get_user_model
 from django.contrib.auth import update_session_auth_hash
 from django.contrib.auth.forms import PasswordChangeForm
-from django.db.models import Sum
-from django.db.models.functions import TruncMonth
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from .models import Chama, Loan, Investment
 from .forms import ChamaForm
 from .forms_invite import InviteMemberForm
 from .forms_loan import LoanRequestForm
 from .forms_create import CreateChamaForm
-from payments.models import MpesaTransaction
+from payments.models import MpesaTransaction, TransactionRollup
 from .forms import InvestmentForm
 from .forms_profile import EditProfileForm
-from payments.utils import MpesaGateWay
+from payments.disbursements import approve_and_reserve
+from payments.history import contribution_page
+from . import ledger, sitemaps
+from .obligations import get_obligation, member_pairs
+from .caching import dashboard_version, invalidate_dashboards, DASHBOARD_TIMEOUT
+from .membership import ADMIN, MEMBER, chama_access, is_member
 
 User = get_user_model()
 
@@ -51,8 +60,21 @@ def pricing_view(request):
 @login_required
 def dashboard_view(request):
     """User Dashboard showing their Chamas"""
-    # Fetch all chamas the user is a member of (including ones they created)
-    my_chamas = request.user.chamas.all()
+    # Fetch all chamas the user is a member of (including ones they created),
+    # with member counts and the user's own paid-to-date in the same query.
+    # Lazy: a cached fragment means it never runs.
+    Membership = Chama.members.through
+    member_count = Membership.objects.filter(
+        chama_id=OuterRef('pk')
+    ).values('chama_id').annotate(c=Count('*')).values('c')
+    my_paid = TransactionRollup.objects.filter(
+        chama_id=OuterRef('pk'), user=request.user
+    ).values('chama_id').annotate(total=Sum('contribution_total')).values('total')
+    my_chamas = request.user.chamas.annotate(
+        member_count=Coalesce(Subquery(member_count), 0),
+        my_paid=Coalesce(Subquery(my_paid), Value(Decimal('0'))),
+        balance=ledger.balance_expression(),
+    )
     
     # Check if user has a valid M-Pesa number (starts with 254)
     # This helps users who might have signed up before strict validation or have invalid numbers
@@ -63,44 +85,80 @@ def dashboard_view(request):
     context = {
         'title': 'Dashboard',
         'my_chamas': my_chamas,
+        'dashboard_version': dashboard_version(request.user.pk),
+        'dashboard_timeout': DASHBOARD_TIMEOUT,
     }
     return render(request, 'chama/dashboard.html', context)
 
 @login_required
+@chama_access
 def chama_detail_view(request, slug, pk):
     """Detailed view of a specific Chama"""
-    chama = get_object_or_404(Chama, id=pk, slug=slug)
+    chama = request.chama
     
     # Check if user is a member or the creator
-    is_member = request.user == chama.created_by or request.user in chama.members.all()
+    is_member = request.chama_role is not None
     
-    context = {'chama': chama, 'is_member': is_member}
+    context = {'chama': chama, 'is_member': is_member, 'balance': ledger.balance(chama.id)}
     
     if is_member:
-        # Calculate total collected (Real-time aggregation for accuracy)
-        total_collected = MpesaTransaction.objects.filter(
-            chama=chama,
-            status='SUCCESS',
-            transaction_type='CONTRIBUTION'
-        ).aggregate(Sum('amount'))['amount__sum'] or 0
+        # Total collected, read once from the monthly rollup
+        total_collected = TransactionRollup.objects.filter(
+            chama=chama
+        ).aggregate(total=Sum('contribution_total'))['total'] or 0
         
-        # Get all contributions for transparency
-        contributions = MpesaTransaction.objects.filter(
-            chama=chama,
-            status='SUCCESS',
-            transaction_type='CONTRIBUTION'
-        ).select_related('user').order_by('-transaction_date')
+        # First page of contributions for transparency; the rest load on scroll
+        contributions, next_cursor = contribution_page(chama)
         
         context.update({
             'total_collected': total_collected,
-            'contributions': contributions
+            'contributions': contributions,
+            'next_cursor': next_cursor,
+            'my_obligation': get_obligation(chama, request.user),
         })
+        if request.chama_role == ADMIN:
+            context.update({
+                'is_admin': True,
+                'latest_campaign': chama.campaigns.order_by('-created_at').first(),
+            })
     elif not chama.is_public:
         messages.error(request, "You must be a member to view this private group.")
         return redirect('chama:dashboard')
         
     return render(request, 'chama/chama_detail.html', context)
 
+def _sitemap(request, page=None):
+    # Looked up once for the ETag, Last-Modified and the body
+    if not hasattr(request, '_sitemap'):
+        request._sitemap = sitemaps.get(page)
+    return request._sitemap
+
+
+def _sitemap_etag(request, page=None):
+    entry = _sitemap(request, page)
+    return entry and entry['etag']
+
+
+def _sitemap_last_modified(request, page=None):
+    entry = _sitemap(request, page)
+    return entry and entry['last_modified']
+
+
+@require_safe
+@condition(etag_func=_sitemap_etag, last_modified_func=_sitemap_last_modified)
+def sitemap_view(request, page=None):
+    """
+    sitemap.xml (page None) and its pages of public chamas. Served from
+    memory or the cache until a public chama changes; crawlers revalidate
+    with If-None-Match or If-Modified-Since and get a 304.
+    """
+    entry = _sitemap(request, page)
+    if entry is None:
+        raise Http404("No such sitemap page")
+    response = HttpResponse(entry['body'], content_type='application/xml')
+    patch_cache_control(response, public=True, max_age=sitemaps.MAX_AGE)
+    return response
+
 # Temporary placeholder views
 def privacy_view(request):
     return HttpResponse("Privacy Policy - Coming Soon")
@@ -139,20 +197,17 @@ def create_chama(request):
     return render(request, 'chama/create_chama.html', {'form': form, 'title': 'Create New Chama'})
 
 @login_required
+@chama_access(role=MEMBER)  # Allow members and creator to view member list
 def list_members(request, slug, pk):
-    chama = get_object_or_404(Chama, id=pk, slug=slug)
-    # Allow members and creator to view member list
-    if request.user != chama.created_by and request.user not in chama.members.all():
-        return redirect('chama:dashboard')
-        
-    return render(request, 'chama/members_list.html', {'chama': chama})
+    return render(request, 'chama/members_list.html', {'chama': request.chama})
 
 @login_required
+@chama_access
 def invite_member(request, slug, pk):
-    chama = get_object_or_404(Chama, id=pk, slug=slug)
+    chama = request.chama
     
     # Only creator can invite (for now)
-    if request.user != chama.created_by:
+    if request.chama_role != ADMIN:
         return redirect('chama:chama_detail', slug=slug, pk=pk)
 
     if request.method == 'POST':
@@ -161,9 +216,9 @@ def invite_member(request, slug, pk):
             email = form.cleaned_data['email']
             user_to_add = User.objects.get(email=email)
             
-            if user_to_add == chama.created_by:
+            if user_to_add.pk == chama.created_by_id:
                  form.add_error('email', 'You are already the owner of this Chama.')
-            elif user_to_add in chama.members.all():
+            elif is_member(chama, user_to_add):
                 form.add_error('email', 'User is already a member.')
             else:
                 chama.members.add(user_to_add)
@@ -174,18 +229,19 @@ def invite_member(request, slug, pk):
     return render(request, 'chama/invite_member.html', {'form': form, 'chama': chama})
 
 @login_required
+@chama_access
 def remove_member(request, slug, pk, member_id):
     """View to remove a member from a Chama"""
-    chama = get_object_or_404(Chama, id=pk, slug=slug)
+    chama = request.chama
     
     # Authorization: Only the creator (admin) can remove members
-    if request.user != chama.created_by:
+    if request.chama_role != ADMIN:
         messages.error(request, "Access denied. Only the group admin can remove members.")
         return redirect('chama:members_list', slug=slug, pk=pk)
 
     member_to_remove = get_object_or_404(User, id=member_id)
     
-    if member_to_remove == chama.created_by:
+    if member_to_remove.pk == chama.created_by_id:
         messages.error(request, "You cannot remove yourself as the admin.")
     else:
         chama.members.remove(member_to_remove)
@@ -194,13 +250,10 @@ def remove_member(request, slug, pk, member_id):
     return redirect('chama:members_list', slug=slug, pk=pk)
 
 @login_required
+@chama_access(role=MEMBER)
 def loan_list(request, slug, pk):
     """View to list loans and handle loan requests"""
-    chama = get_object_or_404(Chama, id=pk, slug=slug)
-    
-    # Check membership
-    if request.user != chama.created_by and request.user not in chama.members.all():
-        return redirect('chama:dashboard')
+    chama = request.chama
 
     loans = chama.loans.all()
     
@@ -223,68 +276,39 @@ def loan_list(request, slug, pk):
     })
 
 @login_required
+@chama_access
 def approve_loan(request, slug, pk, loan_id):
     """Admin action to approve a loan"""
-    chama = get_object_or_404(Chama, id=pk, slug=slug)
+    chama = request.chama
     loan = get_object_or_404(Loan, id=loan_id, chama=chama)
     
-    if request.user != chama.created_by:
+    if request.chama_role != ADMIN:
         messages.error(request, "Only the admin can approve loans.")
+    elif loan.status != 'PENDING':
+        messages.info(request, "This loan has already been handled.")
+    elif approve_and_reserve(loan, request.user):
+        # The disburse_loans worker sends the B2C payment; its result arrives on /payments/b2c/result/
+        messages.success(request, f"Loan approved. KES {loan.amount} is being sent to {loan.borrower.first_name or loan.borrower.username}.")
     else:
-        # Check if Chama has enough balance
-        if chama.total_balance < loan.amount:
-            messages.error(request, f"Insufficient Chama balance (KES {chama.total_balance}) to disburse KES {loan.amount}.")
-            return redirect('chama:loan_list', slug=slug, pk=pk)
-
-        # Initiate B2C Payment
-        gateway = MpesaGateWay()
-        # Ensure phone number is in 254 format
-        phone = loan.borrower.phone_number
-        if phone and phone.startswith('0'):
-            phone = '254' + phone[1:]
-            
-        response = gateway.disburse_funds(phone, loan.amount, remarks=f"Loan for {loan.borrower.username}")
-        
-        if response.get('ResponseCode') == '0':
-            loan.status = 'DISBURSED' # Update status to disbursed immediately for now
-            loan.action_by = request.user
-            loan.action_date = timezone.now()
-            loan.save()
-            
-            # Deduct from Chama Balance
-            chama.total_balance -= loan.amount
-            chama.save()
-            
-            messages.success(request, f"Loan approved and KES {loan.amount} sent to {loan.borrower.first_name}.")
-        else:
-            # FALLBACK FOR TESTING: Allow approval even if M-Pesa fails (e.g. invalid B2C creds)
-            loan.status = 'DISBURSED'
-            loan.action_by = request.user
-            loan.action_date = timezone.now()
-            loan.save()
-            
-            # Deduct from Chama Balance locally
-            chama.total_balance -= loan.amount
-            chama.save()
-            
-            messages.warning(request, f"Loan marked DISBURSED (Test Mode). M-Pesa API Error: {response.get('ResponseDescription')}")
+        messages.error(request, f"Insufficient Chama balance (KES {ledger.balance(chama.id)}) to disburse KES {loan.amount}.")
         
     return redirect('chama:loan_list', slug=slug, pk=pk)
 
 @login_required
+@chama_access
 def reject_loan(request, slug, pk, loan_id):
     """Admin action to reject a loan"""
-    chama = get_object_or_404(Chama, id=pk, slug=slug)
+    chama = request.chama
     loan = get_object_or_404(Loan, id=loan_id, chama=chama)
     
-    if request.user != chama.created_by:
+    if request.chama_role != ADMIN:
         messages.error(request, "Only the admin can reject loans.")
-    else:
-        loan.status = 'REJECTED'
-        loan.action_by = request.user
-        loan.action_date = timezone.now()
-        loan.save()
+    elif Loan.objects.filter(id=loan.id, status='PENDING').update(
+        status='REJECTED', action_by=request.user, action_date=timezone.now()
+    ):
         messages.warning(request, "Loan request rejected.")
+    else:
+        messages.info(request, "This loan has already been handled.")
         
     return redirect('chama:loan_list', slug=slug, pk=pk)
 
@@ -347,19 +371,16 @@ def reports_view(request):
     """View for financial reports and contribution trends"""
     user = request.user
     
-    # Calculate monthly contribution trend
-    trend_data = MpesaTransaction.objects.filter(
+    # Calculate monthly contribution trend (from the monthly rollup)
+    trend_data = TransactionRollup.objects.filter(
         user=user,
-        status='SUCCESS',
-        transaction_type='CONTRIBUTION'
-    ).annotate(
-        month=TruncMonth('transaction_date')
+        contribution_count__gt=0
     ).values('month').annotate(
-        total=Sum('amount')
+        total=Sum('contribution_total')
     ).order_by('month')
     
-    months = [entry['month'].strftime('%B %Y') for entry in trend_data if entry['month']]
-    amounts = [float(entry['total']) for entry in trend_data if entry['month']]
+    months = [entry['month'].strftime('%B %Y') for entry in trend_data]
+    amounts = [float(entry['total']) for entry in trend_data]
 
     context = {
         'title': 'Reports',
@@ -372,42 +393,64 @@ def features_view(request):
     context = {'title': 'Features'}
     return render(request, 'features.html', context)
 
+@login_required
+@chama_access(role=MEMBER)
 def investment_list(request, slug, pk):
-    chama = get_object_or_404(Chama, slug=slug, pk=pk)
+    chama = request.chama
     investments = chama.investments.all().order_by('-date_invested')
     return render(request, 'chama/investment_list.html', {'chama': chama, 'investments': investments})
 
+def _save_investment(investment, delete=False):
+    """Save or delete the investment together with its ledger entry, then refresh the members' dashboards"""
+    with transaction.atomic():
+        # Serialised with loan approvals, which check the balance under the same lock
+        Chama.objects.select_for_update().only('id').get(id=investment.chama_id)
+        if delete:
+            ledger.record_investment(investment, deleted=True)
+            investment.delete()
+        else:
+            investment.save()
+            ledger.record_investment(investment)
+        user_ids = {user_id for _, user_id in member_pairs([investment.chama_id])}
+        transaction.on_commit(lambda: invalidate_dashboards(user_ids))
+
+@login_required
+@chama_access(role=ADMIN)
 def add_investment(request, slug, pk):
-    chama = get_object_or_404(Chama, slug=slug, pk=pk)
+    chama = request.chama
     if request.method == 'POST':
         form = InvestmentForm(request.POST)
         if form.is_valid():
             investment = form.save(commit=False)
             investment.chama = chama
-            investment.save()
+            _save_investment(investment)
             messages.success(request, 'Investment added successfully!')
             return redirect('chama:investment_list', slug=slug, pk=pk)
     else:
         form = InvestmentForm()
     return render(request, 'chama/investment_form.html', {'chama': chama, 'form': form, 'action': 'Add'})
 
+@login_required
+@chama_access(role=ADMIN)
 def edit_investment(request, slug, pk, investment_id):
-    chama = get_object_or_404(Chama, slug=slug, pk=pk)
+    chama = request.chama
     investment = get_object_or_404(Investment, id=investment_id, chama=chama)
     if request.method == 'POST':
         form = InvestmentForm(request.POST, instance=investment)
         if form.is_valid():
-            form.save()
+            _save_investment(form.save(commit=False))
             messages.success(request, 'Investment updated successfully!')
             return redirect('chama:investment_list', slug=slug, pk=pk)
     else:
         form = InvestmentForm(instance=investment)
     return render(request, 'chama/investment_form.html', {'chama': chama, 'form': form, 'action': 'Edit'})
 
+@login_required
+@chama_access(role=ADMIN)
 def delete_investment(request, slug, pk, investment_id):
-    chama = get_object_or_404(Chama, slug=slug, pk=pk)
+    chama = request.chama
     investment = get_object_or_404(Investment, id=investment_id, chama=chama)
     if request.method == 'POST':
-        investment.delete()
+        _save_investment(investment, delete=True)
         messages.success(request, 'Investment deleted successfully!')
     return redirect('chama:investment_list', slug=slug, pk=pk)
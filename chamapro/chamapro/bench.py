@@ -0,0 +1,33 @@
+# chamapro/bench.py
+"""Shared helpers for the bench_* management commands"""
+from contextlib import contextmanager
+from django.db import connection
+
+
+@contextmanager
+def temporary_database(verbosity=0, sqlite_file=None):
+    """
+    Run the block against a throwaway test copy of the default database.
+    On SQLite the copy lives in memory unless `sqlite_file` is given, which
+    forked worker processes need in order to share it.
+    """
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_test_name = test_settings.get('NAME')
+    if sqlite_file and connection.vendor == 'sqlite':
+        test_settings['NAME'] = sqlite_file
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+        test_settings['NAME'] = old_test_name
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(int(round(pct / 100 * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
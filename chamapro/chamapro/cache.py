@@ -0,0 +1,155 @@
+# chamapro/cache.py
+"""
+Cache backends shared by every worker, with per-namespace hit/miss counters,
+and versioned key namespaces.
+
+settings.CACHES picks one of the classes below from the CACHE_BACKEND
+environment variable. The database and filesystem backends need no extra
+service; the Redis and Memcached ones are ready for when one is added
+(install `redis` or `pymemcache` and set CACHE_URL).
+"""
+import threading
+import time
+from collections import defaultdict
+from django.core.cache import cache as default_cache
+from django.core.cache.backends import db, filebased, locmem, memcached, redis
+
+# Key prefixes Django and this project write under, mapped to a namespace label
+NAMESPACE_PREFIXES = [
+    ('django.contrib.sessions.cache', 'sessions'),  # also matches cached_db
+    ('template.cache.', 'template'),
+]
+
+_counters = defaultdict(lambda: {'hits': 0, 'misses': 0})
+_counters_lock = threading.Lock()
+_local = threading.local()
+
+
+def namespace_of(key):
+    for prefix, namespace in NAMESPACE_PREFIXES:
+        if key.startswith(prefix):
+            return namespace
+    return key.split(':', 1)[0]
+
+
+def record(key, hit):
+    with _counters_lock:
+        _counters[namespace_of(key)]['hits' if hit else 'misses'] += 1
+
+
+def stats():
+    """{namespace: {'hits', 'misses', 'hit_rate'}} for this process"""
+    with _counters_lock:
+        snapshot = {ns: dict(c) for ns, c in _counters.items()}
+    for c in snapshot.values():
+        total = c['hits'] + c['misses']
+        c['hit_rate'] = c['hits'] / total if total else 0.0
+    return snapshot
+
+
+def reset_stats():
+    with _counters_lock:
+        _counters.clear()
+
+
+class CountingCacheMixin:
+    """Count hits and misses of get()/get_many() by key namespace"""
+    _missing = object()
+
+    def get(self, key, default=None, version=None):
+        if getattr(_local, 'counting', False):
+            return super().get(key, default, version)
+        _local.counting = True
+        try:
+            value = super().get(key, self._missing, version)
+        finally:
+            _local.counting = False
+        record(key, value is not self._missing)
+        return default if value is self._missing else value
+
+    def get_many(self, keys, version=None):
+        if getattr(_local, 'counting', False):
+            return super().get_many(keys, version)
+        keys = list(keys)
+        _local.counting = True
+        try:
+            found = super().get_many(keys, version)
+        finally:
+            _local.counting = False
+        for key in keys:
+            record(key, key in found)
+        return found
+
+
+class DatabaseCache(CountingCacheMixin, db.DatabaseCache):
+    pass
+
+
+class FileBasedCache(CountingCacheMixin, filebased.FileBasedCache):
+    pass
+
+
+class LocMemCache(CountingCacheMixin, locmem.LocMemCache):
+    pass
+
+
+class RedisCache(CountingCacheMixin, redis.RedisCache):
+    pass
+
+
+class PyMemcacheCache(CountingCacheMixin, memcached.PyMemcacheCache):
+    pass
+
+
+def _initial_version():
+    # Not 1: if a version key is evicted, the restarted counter must not line
+    # up with values still cached under the old one
+    return time.time_ns() // 1000
+
+
+class CacheNamespace:
+    """
+    Keys under `name:<version>:`. invalidate() bumps the version, which
+    orphans every key in the namespace at once; they then expire normally.
+    Items in the namespace (e.g. one user's data) can carry their own
+    version too, bumped with touch().
+    """
+
+    def __init__(self, name, cache=None):
+        self.name = name
+        self._cache = cache
+
+    @property
+    def cache(self):
+        return self._cache or default_cache
+
+    def _version_key(self):
+        return f"{self.name}:version"
+
+    def version(self):
+        return self.cache.get_or_set(self._version_key(), _initial_version, timeout=None)
+
+    def key(self, *parts):
+        return ':'.join([self.name, str(self.version()), *map(str, parts)])
+
+    def invalidate(self):
+        try:
+            return self.cache.incr(self._version_key())
+        except ValueError:
+            # Never used: nothing to orphan
+            return self.version()
+
+    def _item_key(self, item):
+        return f"{self.name}:version:{item}"
+
+    def item_version(self, item):
+        return self.cache.get_or_set(self._item_key(item), _initial_version, timeout=None)
+
+    def touch(self, items):
+        """Bump the version of each item so values cached under the old one are skipped"""
+        for item in set(items):
+            try:
+                self.cache.incr(self._item_key(item))
+            except ValueError:
+                # No version yet: nothing cached under it either
+                pass
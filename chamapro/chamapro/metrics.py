@@ -0,0 +1,441 @@
+# chamapro/metrics.py
+"""
+Request, database, cache and Daraja metrics, exported in Prometheus text
+format at /metrics.
+
+MetricsMiddleware times every request into a per-view histogram. A sampled
+fraction of requests (METRICS_SAMPLE_RATE) also count their SQL queries and
+the time spent in them; with sampling off that costs nothing, and
+METRICS_ENABLED=False removes the middleware altogether.
+
+With several gunicorn workers, set METRICS_DIR: each process then writes
+its figures there, at most every METRICS_FLUSH_INTERVAL seconds, and a
+scrape adds up every file. So whichever worker serves /metrics, counters
+cover all of them and never go backwards. Files of workers that have
+exited are folded into one, keeping their counts. Without METRICS_DIR
+(the default) figures are this process's only.
+"""
+import atexit
+import fcntl
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from chamapro import cache as shared_cache
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Figures of exited processes, folded together by collect()
+RETIRED = 'retired.json'
+
+
+class QueryTimer:
+    """connection.execute_wrapper() that counts queries and the time spent in them"""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.queries += 1
+
+
+class Registry:
+    """This process's request counts, latency histograms, sampled query figures and events"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = defaultdict(int)  # (view, method, status) -> count
+            # view -> [count per bucket..., +Inf, sum of seconds]
+            self.latency = defaultdict(lambda: [0] * (len(BUCKETS) + 1) + [0.0])
+            self.sampled = defaultdict(lambda: [0, 0, 0.0])  # view -> [requests, queries, db seconds]
+            self.events = defaultdict(int)  # (name, ((label, value), ...)) -> count
+
+    def observe_request(self, view, method, status, seconds, timer=None):
+        bucket = next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+        with self._lock:
+            self.requests[(view, method, status)] += 1
+            histogram = self.latency[view]
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+            if timer is not None:
+                sampled = self.sampled[view]
+                sampled[0] += 1
+                sampled[1] += timer.queries
+                sampled[2] += timer.seconds
+
+    def event(self, name, **labels):
+        """Count one occurrence of `name`, exported as chamapro_<name>_total{labels}"""
+        with self._lock:
+            self.events[(name, tuple(sorted(labels.items())))] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': dict(self.requests),
+                'latency': {view: list(values) for view, values in self.latency.items()},
+                'sampled': {view: list(values) for view, values in self.sampled.items()},
+                'events': dict(self.events),
+            }
+
+
+registry = Registry()
+
+_flush_lock = threading.Lock()
+_worker = {}
+
+
+def _new_worker():
+    # Not the bare pid: a later process reusing it must not overwrite an exited worker's file
+    _worker.update(id=f"{os.getpid()}-{time.time_ns()}", flushed=0.0)
+
+
+def _forked():
+    """A forked worker starts from zero, under its own file"""
+    registry.reset()
+    shared_cache.reset_stats()
+    _new_worker()
+
+
+_new_worker()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forked)
+
+
+def _figures():
+    """This process's counters, in the JSON shape of a METRICS_DIR file"""
+    from payments.resilience import metrics as upstream
+
+    snapshot = registry.snapshot()
+    return {
+        'requests': [[*key, count] for key, count in snapshot['requests'].items()],
+        'latency': snapshot['latency'],
+        'sampled': snapshot['sampled'],
+        'events': [[name, labels, count] for (name, labels), count in snapshot['events'].items()],
+        'cache': {namespace: [c['hits'], c['misses']] for namespace, c in shared_cache.stats().items()},
+        'mpesa': upstream.snapshot()['counters'],
+    }
+
+
+def flush(force=False):
+    """Write this process's figures to METRICS_DIR, unless it was done less than METRICS_FLUSH_INTERVAL ago"""
+    directory = getattr(settings, 'METRICS_DIR', '')
+    now = time.monotonic()
+    if not directory or (not force and now - _worker['flushed'] < getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)):
+        return
+    # One writer per process, so an older snapshot never replaces a newer one
+    with _flush_lock:
+        _worker['flushed'] = now
+        path = os.path.join(directory, f"{_worker['id']}.json")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(f"{path}.tmp", 'w') as f:
+                json.dump(_figures(), f)
+            os.replace(f"{path}.tmp", path)
+        except OSError:
+            pass  # metrics must never fail a request
+
+
+atexit.register(flush, force=True)
+
+
+def _empty():
+    return {
+        'requests': defaultdict(int),
+        'latency': defaultdict(lambda: [0] * (len(BUCKETS) + 1) + [0.0]),
+        'sampled': defaultdict(lambda: [0, 0, 0.0]),
+        'events': defaultdict(int),
+        'cache': defaultdict(lambda: [0, 0]),
+        'mpesa': defaultdict(int),
+    }
+
+
+def _add(totals, figures):
+    """Add one METRICS_DIR file's figures to totals from _empty()"""
+    for *key, count in figures['requests']:
+        totals['requests'][tuple(key)] += count
+    for family in ('latency', 'sampled', 'cache'):
+        for name, values in figures[family].items():
+            totals[family][name] = [a + b for a, b in zip(totals[family][name], values)]
+    for name, labels, count in figures['events']:
+        totals['events'][(name, tuple(map(tuple, labels)))] += count
+    for name, count in figures['mpesa'].items():
+        totals['mpesa'][name] += count
+
+
+def _as_figures(totals):
+    return {
+        'requests': [[*key, count] for key, count in totals['requests'].items()],
+        'latency': dict(totals['latency']),
+        'sampled': dict(totals['sampled']),
+        'events': [[name, labels, count] for (name, labels), count in totals['events'].items()],
+        'cache': dict(totals['cache']),
+        'mpesa': dict(totals['mpesa']),
+    }
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None  # removed, or replaced mid-read: counted next scrape
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _retire(directory):
+    """
+    Fold the files of processes that have exited into retired.json: their
+    counts stay in the totals, and recycled workers do not pile up files.
+    Serialised between processes with a lock file, so none is folded twice.
+    """
+    names = [name for name in os.listdir(directory) if name.endswith('.json') and name != RETIRED]
+    dead = [name for name in names if name.split('-', 1)[0].isdigit() and not _alive(int(name.split('-', 1)[0]))]
+    if not dead:
+        return
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retired_path = os.path.join(directory, RETIRED)
+        retired = _read(retired_path) or {'folded': []}
+        totals = _empty()
+        if 'requests' in retired:
+            _add(totals, retired)
+        # Folded last time but not deleted (the process stopped in between): already counted
+        folded = set(retired['folded'])
+        for name in dead:
+            figures = None if name in folded else _read(os.path.join(directory, name))
+            if figures is not None:
+                _add(totals, figures)
+        with open(f"{retired_path}.tmp", 'w') as f:
+            json.dump({**_as_figures(totals), 'folded': dead}, f)
+        os.replace(f"{retired_path}.tmp", retired_path)
+        for name in dead:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+def collect():
+    """Figures of every process that wrote to METRICS_DIR (this one's first refreshed), added up"""
+    directory = getattr(settings, 'METRICS_DIR', '')
+    totals = _empty()
+    if directory:
+        flush(force=True)
+        if os.path.isdir(directory):
+            _retire(directory)
+            for name in os.listdir(directory):
+                figures = _read(os.path.join(directory, name)) if name.endswith('.json') else None
+                if figures is not None:
+                    _add(totals, figures)
+    else:
+        _add(totals, _figures())
+    totals['cache'] = {
+        namespace: {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+        for namespace, (hits, misses) in totals['cache'].items()
+    }
+    return totals
+
+
+class MetricsMiddleware:
+    """Time every request per view; count SQL queries for a sample of them"""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'METRICS_SAMPLE_RATE', 0.0)
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        timer = None
+        if self.sample_rate and random.random() < self.sample_rate:
+            timer = QueryTimer()
+            with connection.execute_wrapper(timer):
+                response = self.get_response(request)
+        else:
+            response = self.get_response(request)
+        match = request.resolver_match
+        registry.observe_request(
+            match.view_name if match else 'unresolved', request.method, response.status_code,
+            time.perf_counter() - start, timer,
+        )
+        flush()
+        return response
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Exposition:
+    """Prometheus text format, one metric family at a time"""
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, kind, help_text):
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {kind}')
+
+    def sample(self, name, value, **labels):
+        self.lines.append(f'{name}{_labels(**labels)} {_number(value)}')
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def _requests(out, snapshot):
+    out.family('chamapro_http_requests_total', 'counter', 'Requests served, by view, method and status.')
+    for (view, method, status), count in sorted(snapshot['requests'].items()):
+        out.sample('chamapro_http_requests_total', count, view=view, method=method, status=status)
+
+    out.family('chamapro_http_request_duration_seconds', 'histogram', 'Request latency by view.')
+    for view, values in sorted(snapshot['latency'].items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, values):
+            cumulative += count
+            out.sample('chamapro_http_request_duration_seconds_bucket', cumulative, view=view, le=bound)
+        cumulative += values[len(BUCKETS)]
+        out.sample('chamapro_http_request_duration_seconds_bucket', cumulative, view=view, le='+Inf')
+        out.sample('chamapro_http_request_duration_seconds_sum', values[-1], view=view)
+        out.sample('chamapro_http_request_duration_seconds_count', cumulative, view=view)
+
+    sampled = sorted(snapshot['sampled'].items())
+    out.family('chamapro_sampled_requests_total', 'counter', 'Requests whose SQL queries were counted.')
+    for view, (requests, _, _) in sampled:
+        out.sample('chamapro_sampled_requests_total', requests, view=view)
+    out.family('chamapro_db_queries_total', 'counter', 'SQL queries run by sampled requests.')
+    for view, (_, queries, _) in sampled:
+        out.sample('chamapro_db_queries_total', queries, view=view)
+    out.family('chamapro_db_query_duration_seconds_total', 'counter', 'Time sampled requests spent in SQL.')
+    for view, (_, _, seconds) in sampled:
+        out.sample('chamapro_db_query_duration_seconds_total', seconds, view=view)
+
+
+def _events(out, snapshot):
+    by_name = defaultdict(list)
+    for (name, labels), count in snapshot['events'].items():
+        by_name[name].append((labels, count))
+    for name, samples in sorted(by_name.items()):
+        metric = f'chamapro_{name}_total'
+        out.family(metric, 'counter', f'{name.replace("_", " ").capitalize()}.')
+        for labels, count in sorted(samples):
+            out.sample(metric, count, **dict(labels))
+
+
+def _cache(out, totals):
+    stats = sorted(totals['cache'].items())
+    out.family('chamapro_cache_hits_total', 'counter', 'Cache hits by key namespace.')
+    for namespace, counts in stats:
+        out.sample('chamapro_cache_hits_total', counts['hits'], namespace=namespace)
+    out.family('chamapro_cache_misses_total', 'counter', 'Cache misses by key namespace.')
+    for namespace, counts in stats:
+        out.sample('chamapro_cache_misses_total', counts['misses'], namespace=namespace)
+    out.family('chamapro_cache_hit_ratio', 'gauge', 'Share of cache reads that hit, by key namespace.')
+    for namespace, counts in stats:
+        out.sample('chamapro_cache_hit_ratio', counts['hit_rate'], namespace=namespace)
+
+
+def _daraja(out, totals):
+    from payments.resilience import metrics as upstream
+    from payments.utils import MpesaGateWay
+
+    # Quantiles cannot be added up across processes: these are the serving worker's
+    snapshot = upstream.snapshot()
+    endpoints = sorted(snapshot['endpoints'].items())
+    out.family(
+        'chamapro_mpesa_request_duration_seconds', 'summary', "Daraja call latency over this worker's recent calls."
+    )
+    for endpoint, figures in endpoints:
+        for quantile in ('p50', 'p95', 'p99'):
+            out.sample(
+                'chamapro_mpesa_request_duration_seconds', figures[quantile],
+                endpoint=endpoint, quantile=int(quantile[1:]) / 100,
+            )
+        out.sample('chamapro_mpesa_request_duration_seconds_count', figures['count'], endpoint=endpoint)
+
+    # Per-endpoint counters are named '<endpoint>.<outcome>'; the rest are global
+    counters = totals['mpesa']
+    for outcome in ('timeouts', 'retries', 'errors'):
+        metric = f'chamapro_mpesa_{outcome}_total'
+        out.family(metric, 'counter', f'Daraja call {outcome} by endpoint.')
+        for name, count in sorted(counters.items()):
+            endpoint, _, kind = name.rpartition('.')
+            if kind == outcome:
+                out.sample(metric, count, endpoint=endpoint)
+    out.family('chamapro_mpesa_short_circuited_total', 'counter', 'Daraja calls refused by the open circuit breaker.')
+    out.sample('chamapro_mpesa_short_circuited_total', counters.get('short_circuited', 0))
+
+    gateway = MpesaGateWay()
+    state = gateway.breaker.state()
+    out.family('chamapro_mpesa_breaker_state', 'gauge', 'Circuit breaker state shared by all workers (1 = current).')
+    for name in ('closed', 'open', 'half-open'):
+        out.sample('chamapro_mpesa_breaker_state', int(state['state'] == name), state=name)
+    out.family('chamapro_mpesa_breaker_failures', 'gauge', 'Failures counted towards tripping the breaker.')
+    out.sample('chamapro_mpesa_breaker_failures', state['failures'])
+    out.family('chamapro_mpesa_breaker_trips_total', 'counter', 'Times the breaker has opened, across all workers.')
+    out.sample('chamapro_mpesa_breaker_trips_total', state['trips'])
+
+
+def render():
+    """Every metric, added up over the workers, in Prometheus text format"""
+    out = _Exposition()
+    totals = collect()
+    _requests(out, totals)
+    _events(out, totals)
+    _cache(out, totals)
+    _daraja(out, totals)
+    return out.text()
+
+
+def _authorized(request):
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    return request.user.is_authenticated and request.user.is_staff
+
+
+def metrics_view(request):
+    """Prometheus scrape target: needs `Authorization: Bearer <METRICS_TOKEN>` or a staff login"""
+    if not _authorized(request):
+        response = HttpResponse('Unauthorized\n', status=401, content_type='text/plain')
+        response['WWW-Authenticate'] = 'Bearer realm="metrics"'
+        return response
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
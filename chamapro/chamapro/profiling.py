@@ -0,0 +1,243 @@
+# chamapro/profiling.py
+"""
+On-demand request profiling.
+
+A staff user adds `?_profile=1` or an `X-Profile: 1` header to any page, or
+PROFILER_SAMPLE_RATE picks a share of all requests at random. The request
+then runs under a sampling profiler (a thread reading the request thread's
+stack every PROFILER_INTERVAL seconds) while its SQL queries, template
+renders and Daraja calls are timed. The result is stored as a
+RequestProfile, with the stacks in collapsed format for flame graphs, and
+can be browsed under /admin/chama/requestprofile/.
+
+Requests that are not profiled pay for a header lookup and a substring
+test, nothing else: the user is only loaded when a flag is present, and
+template timing is only hooked in once a first profile has been taken.
+"""
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError, connection
+from django.template import base as template_base
+from django.urls import reverse
+
+FLAG = '_profile'
+MAX_SAMPLES = 20000
+MAX_QUERIES = 500  # kept individually; all are counted
+MAX_SQL_LENGTH = 2000
+
+_local = threading.local()
+_labels = {}
+_hook_lock = threading.Lock()
+_original_render = None
+
+
+def _label(code):
+    """'path/to/module.py:function' for a code object, relative to the project or site-packages"""
+    label = _labels.get(code)
+    if label is None:
+        filename = code.co_filename
+        base = str(settings.BASE_DIR) + '/'
+        if filename.startswith(base):
+            filename = filename[len(base):]
+        elif 'site-packages/' in filename:
+            filename = filename.split('site-packages/', 1)[1]
+        label = _labels[code] = f"{filename}:{code.co_name}"
+    return label
+
+
+class Profile:
+    """Everything recorded about one request while it runs"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.samples = 0
+        self.queries = []
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.templates = []
+        self.template_depth = 0
+        self.calls = []
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name='request-profiler', daemon=True)
+
+    def _sample(self):
+        frames = sys._current_frames
+        while not self._stop.wait(self.interval) and self.samples < MAX_SAMPLES:
+            frame = frames().get(self.thread_id)
+            stack = []
+            # Leaf to root, stopping at the middleware that started the profile
+            while frame is not None and frame.f_code is not _ROOT_CODE:
+                stack.append(_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def __call__(self, execute, sql, params, many, context):
+        """connection.execute_wrapper(): time every query"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.sql_count += 1
+            self.sql_seconds += elapsed
+            if len(self.queries) < MAX_QUERIES:
+                self.queries.append({'sql': sql[:MAX_SQL_LENGTH], 'ms': round(elapsed * 1000, 3), 'many': many})
+
+    def start(self):
+        _local.profile = self
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        _local.profile = None
+
+    def collapsed(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def report(self):
+        repeated = Counter(query['sql'] for query in self.queries)
+        return {
+            'interval_ms': self.interval * 1000,
+            'samples': self.samples,
+            'sql': {
+                'count': self.sql_count,
+                'ms': round(self.sql_seconds * 1000, 3),
+                'queries': self.queries,
+                'truncated': self.sql_count > len(self.queries),
+                # Same statement run more than once: the usual N+1 signature
+                'repeated': [{'sql': sql, 'times': times} for sql, times in repeated.most_common(10) if times > 1],
+            },
+            'templates': self.templates,
+            'gateway': self.calls,
+            'top_frames': [
+                {'frame': frame, 'samples': samples} for frame, samples in self._self_time().most_common(25)
+            ],
+        }
+
+    def _self_time(self):
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves
+
+
+def record_call(endpoint, seconds, outcome):
+    """Note an upstream call made by the profiled request, if there is one"""
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.calls.append({'endpoint': endpoint, 'ms': round(seconds * 1000, 3), 'outcome': str(outcome)})
+
+
+def _timed_render(self, context):
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return _original_render(self, context)
+    start = time.perf_counter()
+    profile.template_depth += 1
+    try:
+        return _original_render(self, context)
+    finally:
+        profile.template_depth -= 1
+        profile.templates.append({
+            'name': getattr(self.origin, 'template_name', None) or self.name or '<string>',
+            'ms': round((time.perf_counter() - start) * 1000, 3),
+            'depth': profile.template_depth,  # 0 for the page, more for {% include %}s
+        })
+
+
+def _hook_templates():
+    """Time Template.render() on profiled threads; installed on first use"""
+    global _original_render
+    with _hook_lock:
+        if _original_render is None:
+            _original_render = template_base.Template.render
+            template_base.Template.render = _timed_render
+
+
+class ProfilerMiddleware:
+    """Profile flagged requests from staff, and a random PROFILER_SAMPLE_RATE share of all requests"""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILER_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILER_SAMPLE_RATE', 0.0)
+        self.interval = getattr(settings, 'PROFILER_INTERVAL', 0.005)
+
+    def _trigger(self, request):
+        flagged = request.META.get('HTTP_X_PROFILE') or (
+            FLAG in request.META.get('QUERY_STRING', '') and request.GET.get(FLAG)
+        )
+        if flagged and request.user.is_staff:
+            return 'flag'
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'sample'
+        return None
+
+    def __call__(self, request):
+        trigger = self._trigger(request)
+        if trigger is None:
+            return self.get_response(request)
+        return self._profile(request, trigger)
+
+    def _profile(self, request, trigger):
+        _hook_templates()
+        profile = Profile(self.interval)
+        start = time.perf_counter()
+        profile.start()
+        try:
+            with connection.execute_wrapper(profile):
+                response = self.get_response(request)
+        finally:
+            profile.stop()
+        elapsed = time.perf_counter() - start
+        saved = save(request, response, profile, elapsed, trigger)
+        if saved is not None and trigger == 'flag':
+            response['X-Profile'] = reverse('admin:chama_requestprofile_change', args=[saved.pk])
+        return response
+
+
+_ROOT_CODE = ProfilerMiddleware._profile.__code__
+
+
+def save(request, response, profile, elapsed, trigger):
+    """Store the profile and drop the oldest beyond PROFILER_KEEP; None if the database refused it"""
+    from chama.models import RequestProfile
+
+    match = request.resolver_match
+    report = profile.report()
+    user = getattr(request, 'user', None)
+    try:
+        saved = RequestProfile.objects.create(
+            user=user if user is not None and user.is_authenticated else None,
+            method=request.method,
+            path=request.get_full_path()[:500],
+            view_name=(match.view_name if match else '')[:200],
+            status_code=response.status_code,
+            trigger=trigger,
+            duration_ms=round(elapsed * 1000, 3),
+            sql_count=profile.sql_count,
+            sql_ms=report['sql']['ms'],
+            template_ms=round(sum(t['ms'] for t in profile.templates if t['depth'] == 0), 3),
+            gateway_ms=round(sum(call['ms'] for call in profile.calls), 3),
+            samples=profile.samples,
+            collapsed=profile.collapsed(),
+            report=report,
+        )
+        keep = getattr(settings, 'PROFILER_KEEP', 500)
+        stale = list(RequestProfile.objects.order_by('-created_at').values_list('id', flat=True)[keep:keep + 100])
+        if stale:
+            RequestProfile.objects.filter(id__in=stale).delete()
+    except DatabaseError:
+        return None
+    return saved
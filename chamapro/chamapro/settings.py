@@ -1,5 +1,6 @@
 # chamapro/settings.py
 import os
+import tempfile
 from pathlib import Path
 from decouple import config
 import dj_database_url
@@ -99,6 +100,8 @@ ACCOUNT_FORMS = {
 }
 
 MIDDLEWARE = [
+    # First, so its timings cover every other middleware too
+    'chamapro.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # Add Whitenoise here
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -110,6 +113,8 @@ MIDDLEWARE = [
     'allauth.account.middleware.AccountMiddleware',
     # SEO: Locale middleware for multilingual support
     'django.middleware.locale.LocaleMiddleware',
+    # Last, so a profile covers the view and little else (see chamapro.profiling)
+    'chamapro.profiling.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'chamapro.urls'
@@ -216,19 +221,89 @@ EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD', default='')
 DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL', default='noreply@chamapro.co.ke')
 
 # SEO: Cache settings for performance
+# One cache shared by every gunicorn worker (and the background workers), picked by
+# CACHE_BACKEND: 'db' (table made by `manage.py createcachetable`), 'file', 'redis' or
+# 'memcached' (set CACHE_URL), or 'locmem' for a per-process cache.
+CACHE_BACKEND = config('CACHE_BACKEND', default='file' if DEBUG else 'db')
+CACHE_BACKENDS = {
+    'locmem': ('chamapro.cache.LocMemCache', 'chamapro'),
+    'file': ('chamapro.cache.FileBasedCache', config('CACHE_DIR', default=os.path.join(tempfile.gettempdir(), 'chamapro_cache'))),
+    'db': ('chamapro.cache.DatabaseCache', 'chamapro_cache'),
+    'redis': ('chamapro.cache.RedisCache', config('CACHE_URL', default='redis://127.0.0.1:6379/0')),
+    'memcached': ('chamapro.cache.PyMemcacheCache', config('CACHE_URL', default='127.0.0.1:11211')),
+}
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
-    }
+        'BACKEND': CACHE_BACKENDS[CACHE_BACKEND][0],
+        'LOCATION': CACHE_BACKENDS[CACHE_BACKEND][1],
+        'KEY_PREFIX': config('CACHE_KEY_PREFIX', default='chamapro'),
+        # Bump CACHE_VERSION to drop every cached value at once, e.g. on a deploy that changes their shape
+        'VERSION': config('CACHE_VERSION', default=1, cast=int),
+    },
+    # M-Pesa OAuth token and circuit breaker when 'default' is per-process: must be shared by every gunicorn worker
+    'mpesa': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': config('MPESA_CACHE_DIR', default=os.path.join(tempfile.gettempdir(), 'chamapro_mpesa_cache')),
+    },
 }
 
+if CACHE_BACKEND in ('locmem', 'file', 'db'):
+    # Networked backends evict on their own and reject this option
+    CACHES['default']['OPTIONS'] = {'MAX_ENTRIES': config('CACHE_MAX_ENTRIES', default=50000, cast=int)}
+
 # SEO: Session settings
 SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 
+# Request metrics, scraped at /metrics (see chamapro.metrics)
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+METRICS_SAMPLE_RATE = config('METRICS_SAMPLE_RATE', default=0.1, cast=float)  # share of requests whose SQL is counted
+METRICS_TOKEN = config('METRICS_TOKEN', default='')  # Bearer token for the scraper; staff can always read it
+# Where each process leaves its figures for the scrape to add up, e.g. /tmp/chamapro_metrics with several
+# gunicorn workers; '' keeps them per process
+METRICS_DIR = config('METRICS_DIR', default='')
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', default=5, cast=float)  # seconds
+
+# Gives the test run its own METRICS_DIR and cache directories
+TEST_RUNNER = 'chamapro.test_runner.TestRunner'
+
+# On-demand profiling: staff add ?_profile=1 or an X-Profile header; reports under /admin/
+PROFILER_ENABLED = config('PROFILER_ENABLED', default=True, cast=bool)
+PROFILER_SAMPLE_RATE = config('PROFILER_SAMPLE_RATE', default=0.0, cast=float)  # share of all requests profiled
+PROFILER_INTERVAL = config('PROFILER_INTERVAL', default=0.005, cast=float)  # seconds between stack samples
+PROFILER_KEEP = config('PROFILER_KEEP', default=500, cast=int)  # newest profiles kept
+
 # M-Pesa Configuration
 MPESA_CONSUMER_KEY = config('MPESA_CONSUMER_KEY', default='')
 MPESA_CONSUMER_SECRET = config('MPESA_CONSUMER_SECRET', default='')
 MPESA_SHORTCODE = config('MPESA_SHORTCODE', default='')
 MPESA_PASSKEY = config('MPESA_PASSKEY', default='')
-MPESA_CALLBACK_URL = config('MPESA_CALLBACK_URL', default='')
\ No newline at end of file
+MPESA_CALLBACK_URL = config('MPESA_CALLBACK_URL', default='')
+# B2C loan disbursements
+MPESA_INITIATOR_NAME = config('MPESA_INITIATOR_NAME', default='testapi')
+MPESA_SECURITY_CREDENTIAL = config('MPESA_SECURITY_CREDENTIAL', default='')
+
+# Leave blank to use the Safaricom sandbox (DEBUG) or production host
+MPESA_BASE_URL = config('MPESA_BASE_URL', default='')
+MPESA_TOKEN_CACHE = 'mpesa' if CACHE_BACKEND == 'locmem' else 'default'  # also holds the breaker state
+MPESA_TOKEN_REFRESH_MARGIN = config('MPESA_TOKEN_REFRESH_MARGIN', default=300, cast=int)  # seconds
+MPESA_HTTP_POOL_SIZE = config('MPESA_HTTP_POOL_SIZE', default=20, cast=int)
+# Fail fast when Safaricom is slow instead of tying up every web worker.
+# Read timeouts per endpoint (oauth, stk_push, stk_query, b2c) can be overridden with MPESA_READ_TIMEOUTS.
+MPESA_CONNECT_TIMEOUT = config('MPESA_CONNECT_TIMEOUT', default=3.05, cast=float)  # seconds
+MPESA_RETRIES = config('MPESA_RETRIES', default=2, cast=int)  # extra attempts, idempotent calls only
+MPESA_RETRY_BACKOFF = config('MPESA_RETRY_BACKOFF', default=0.25, cast=float)  # seconds, doubled per attempt
+# The breaker opens after THRESHOLD failures within WINDOW seconds, for COOLDOWN seconds
+MPESA_BREAKER_THRESHOLD = config('MPESA_BREAKER_THRESHOLD', default=5, cast=int)
+MPESA_BREAKER_WINDOW = config('MPESA_BREAKER_WINDOW', default=30, cast=int)
+MPESA_BREAKER_COOLDOWN = config('MPESA_BREAKER_COOLDOWN', default=30, cast=int)
+# Bulk "request contributions" campaigns: concurrent pushes, and the pace the Daraja app's quota allows
+MPESA_CAMPAIGN_WORKERS = config('MPESA_CAMPAIGN_WORKERS', default=8, cast=int)
+MPESA_STK_RATE_LIMIT = config('MPESA_STK_RATE_LIMIT', default=10, cast=float)  # pushes per second
+# A RUNNING campaign with no progress for this many seconds lost its runner and is claimed again
+MPESA_CAMPAIGN_STALE_AFTER = config('MPESA_CAMPAIGN_STALE_AFTER', default=300, cast=int)
+MPESA_STK_QUERY_RATE_LIMIT = config('MPESA_STK_QUERY_RATE_LIMIT', default=10, cast=float)  # reconciliation queries per second
+# A transaction still PENDING this many seconds after its push, which M-Pesa has no result for, is marked FAILED
+MPESA_PENDING_EXPIRE_AFTER = config('MPESA_PENDING_EXPIRE_AFTER', default=24 * 60 * 60, cast=int)
+
+# Balance snapshots stay this many seconds behind now, so entries of still-open transactions are not skipped
+LEDGER_SNAPSHOT_LAG = config('LEDGER_SNAPSHOT_LAG', default=60, cast=int)
@@ -0,0 +1,29 @@
+# chamapro/test_runner.py
+"""
+The test runner (settings.TEST_RUNNER): the whole run writes its metrics
+files and filesystem caches under one temporary directory, removed at the
+end, instead of the shared /tmp locations a running server uses.
+"""
+import copy
+import os
+import tempfile
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._scratch = tempfile.TemporaryDirectory(prefix='chamapro_tests_')
+        caches = copy.deepcopy(settings.CACHES)
+        for alias, options in caches.items():
+            if options['BACKEND'].endswith('FileBasedCache'):
+                options['LOCATION'] = os.path.join(self._scratch.name, f'cache_{alias}')
+        self._settings = override_settings(METRICS_DIR=os.path.join(self._scratch.name, 'metrics'), CACHES=caches)
+        self._settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._settings.disable()
+        self._scratch.cleanup()
+        super().teardown_test_environment(**kwargs)
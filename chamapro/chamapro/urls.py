@@ -3,9 +3,11 @@ from django.contrib import admin
 from django.urls import path, include
 from chama import views as chama_views
 from django.views.generic import RedirectView
+from chamapro.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     
     # Allauth URLs
     path('users/', include('allauth.urls')),
@@ -34,6 +36,10 @@ urlpatterns = [
     path('privacy/', chama_views.privacy_view, name='privacy'),
     path('terms/', chama_views.terms_view, name='terms'),
     path('cookies/', chama_views.cookies_view, name='cookies'),
+
+    # SEO: sitemap index and its pages of public chamas
+    path('sitemap.xml', chama_views.sitemap_view, name='sitemap'),
+    path('sitemap-chamas-<int:page>.xml', chama_views.sitemap_view, name='sitemap_page'),
     
     # App URLs (comment these out if they're causing errors)
     path('chama/', include('chama.urls', namespace='chama')),
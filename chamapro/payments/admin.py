@@ -1,5 +1,26 @@
 from django.contrib import admin
-from .models import MpesaTransaction
+from .models import MpesaTransaction, CallbackInbox, ContributionCampaign
+from .callbacks import inbox_stats
 
 # Register your models here.
-admin.site.register(MpesaTransaction)
\ No newline at end of file
+admin.site.register(MpesaTransaction)
+
+
+@admin.register(CallbackInbox)
+class CallbackInboxAdmin(admin.ModelAdmin):
+    list_display = ['id', 'checkout_request_id', 'received_at', 'processed_at', 'error']
+    list_filter = [('processed_at', admin.EmptyFieldListFilter)]
+    search_fields = ['checkout_request_id']
+    readonly_fields = ['checkout_request_id', 'payload', 'received_at', 'processed_at', 'error']
+
+    def changelist_view(self, request, extra_context=None):
+        stats = inbox_stats()
+        self.message_user(request, f"Inbox depth: {stats['depth']} unprocessed, oldest waiting {stats['lag_seconds']:.0f}s")
+        return super().changelist_view(request, extra_context)
+
+
+@admin.register(ContributionCampaign)
+class ContributionCampaignAdmin(admin.ModelAdmin):
+    list_display = ['chama', 'status', 'total', 'sent', 'failed', 'skipped', 'created_at', 'finished_at']
+    list_filter = ['status']
+    readonly_fields = ['total', 'sent', 'failed', 'skipped', 'last_error', 'started_at', 'finished_at']
@@ -0,0 +1,228 @@
+import json
+from decimal import Decimal
+from datetime import timedelta
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+from django.db import transaction as db_transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+from chama.models import Chama, Penalty
+from chama import ledger
+from chama.caching import invalidate_dashboards
+from chama.obligations import member_pairs, record_contributions
+from .models import MpesaTransaction, CallbackInbox
+from .rollups import record_settled
+
+SETTLE_FIELDS = ['status', 'description', 'receipt_number', 'phone_number']
+# Passes a callback whose settlement keeps raising gets before it is set aside
+# (processed, error kept); reconcile_pending settles its transaction instead
+MAX_ATTEMPTS = 5
+# Seconds a failed callback waits before its next pass, doubling after each failure
+RETRY_AFTER = 30
+
+
+def stk_callback_of(data):
+    """The stkCallback object of a decoded callback body; None if it is not shaped like one"""
+    body = data.get('Body') if isinstance(data, dict) else None
+    stk_callback = body.get('stkCallback') if isinstance(body, dict) else None
+    return stk_callback if isinstance(stk_callback, dict) else None
+
+
+def parse_stk_callback(data):
+    """Turn an stkCallback payload into (checkout_request_id, field updates)"""
+    stk_callback = stk_callback_of(data) or {}
+    checkout_request_id = stk_callback.get('CheckoutRequestID')
+    result_code = stk_callback.get('ResultCode')
+
+    if result_code == 0:
+        updates = {'status': 'SUCCESS', 'description': "Payment Successful"}
+        items = (stk_callback.get('CallbackMetadata') or {}).get('Item') or []
+        for item in items:
+            if item.get('Name') == 'MpesaReceiptNumber':
+                updates['receipt_number'] = item.get('Value')
+            elif item.get('Name') == 'PhoneNumber':
+                updates['phone_number'] = str(item.get('Value'))
+    else:
+        # Save the failure reason (e.g., Cancelled by user)
+        updates = {'status': 'FAILED', 'description': stk_callback.get('ResultDesc')}
+    return checkout_request_id, updates
+
+
+def settle_transactions(results):
+    """
+    Move PENDING transactions to SUCCESS/FAILED in bulk and apply side effects.
+
+    `results` maps checkout_request_id -> updates from parse_stk_callback().
+    Transactions that are no longer PENDING are skipped, so replays are no-ops,
+    except that a SUCCESS settled by reconcile_pending (STK Query has no
+    receipt) takes the receipt of a late successful callback.
+    Must run inside a transaction. Returns the transactions that were settled.
+    """
+    if not results:
+        return []
+    rows = list(
+        MpesaTransaction.objects.select_for_update()
+        .filter(checkout_request_id__in=list(results))
+        .filter(Q(status='PENDING') | Q(status='SUCCESS', receipt_number__isnull=True))
+    )
+
+    # A receipt already on another row means this callback is a duplicate
+    receipts = [results[t.checkout_request_id].get('receipt_number') for t in rows]
+    taken = set(
+        MpesaTransaction.objects.filter(receipt_number__in=[r for r in receipts if r])
+        .values_list('receipt_number', flat=True)
+    )
+    settled, receipted = [], []
+    for t in rows:
+        updates = results[t.checkout_request_id]
+        receipt = updates.get('receipt_number')
+        if receipt and receipt in taken:
+            continue
+        if t.status == 'SUCCESS':
+            # Already applied: only the receipt (and paying phone) were missing
+            if updates['status'] != 'SUCCESS' or not receipt:
+                continue
+            t.receipt_number = receipt
+            t.phone_number = updates.get('phone_number', t.phone_number)
+            receipted.append(t)
+        else:
+            for field, value in updates.items():
+                setattr(t, field, value)
+            settled.append(t)
+        if receipt:
+            taken.add(receipt)
+
+    MpesaTransaction.objects.bulk_update(settled + receipted, SETTLE_FIELDS, batch_size=500)
+    record_settled(settled)
+    _apply_successful_payments([t for t in settled if t.status == 'SUCCESS'])
+    return settled
+
+
+def _apply_successful_payments(transactions):
+    """Side effects of transactions that have just moved to SUCCESS"""
+    now = timezone.now()
+    renewals = defaultdict(int)
+    balances = defaultdict(Decimal)
+    payers = set()
+    contributions = []
+    entries = []
+    for t in transactions:
+        if not t.chama_id:
+            continue
+        if t.transaction_type == 'SUBSCRIPTION':
+            renewals[t.chama_id] += 1
+        elif t.transaction_type == 'CONTRIBUTION' and t.user_id:
+            balances[t.chama_id] += Decimal(t.amount)
+            payers.add((t.user_id, t.chama_id))
+            contributions.append(t)
+            entries.append((t.chama_id, 'CONTRIBUTION', t.amount, f"mpesa:{t.checkout_request_id}"))
+
+    # --- HANDLE SUBSCRIPTION RENEWAL ---
+    # Extend expiry by 30 days per payment from now (or from current expiry if valid)
+    for chama in Chama.objects.filter(id__in=list(renewals)):
+        base = chama.subscription_expiry if chama.subscription_expiry and chama.subscription_expiry > now else now
+        chama.subscription_expiry = base + timedelta(days=30 * renewals[chama.id])
+        chama.subscription_status = 'ACTIVE'
+        chama.save(update_fields=['subscription_expiry', 'subscription_status', 'updated_at'])
+
+    # Append to the chama ledgers in one INSERT; no balance row is locked
+    ledger.record(entries)
+
+    # Balances and paid-to-date changed on these members' dashboards
+    if balances:
+        user_ids = {user_id for _, user_id in member_pairs(balances)}
+        db_transaction.on_commit(lambda: invalidate_dashboards(user_ids))
+
+    # Credit the member's obligation for the period the payment falls in
+    if contributions:
+        record_contributions(contributions)
+
+    # --- AUTO-CLEAR PENALTIES ---
+    # Simple logic: If they paid enough, assume they cleared the penalty
+    payers = list(payers)
+    for i in range(0, len(payers), 200):
+        match = reduce(or_, (Q(user_id=u, chama_id=c) for u, c in payers[i:i + 200]))
+        Penalty.objects.filter(match, is_paid=False).update(is_paid=True, paid_at=now)
+
+
+def drain_inbox(batch_size=500):
+    """
+    Process one batch of unprocessed callbacks atomically.
+    Returns (callbacks processed, transactions settled).
+
+    The batch is settled in one go. If that raises, each transaction is
+    settled in its own savepoint instead, so one bad callback cannot hold
+    back the rest: its rows stay in the inbox with the error and an attempt
+    count, are not retried for RETRY_AFTER seconds (doubled after each
+    failure), and are set aside after MAX_ATTEMPTS passes.
+    """
+    with db_transaction.atomic():
+        rows = list(
+            CallbackInbox.objects.select_for_update(skip_locked=True)
+            .filter(processed_at__isnull=True)
+            .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now()))
+            .order_by('id')[:batch_size]
+        )
+        if not rows:
+            return 0, 0
+
+        results = {}
+        row_ids = defaultdict(list)
+        errors = {}
+        for row in rows:
+            try:
+                checkout_request_id, updates = parse_stk_callback(json.loads(row.payload))
+            except (ValueError, AttributeError):
+                errors[row.id] = 'Invalid payload'
+                continue
+            if not checkout_request_id:
+                errors[row.id] = 'Missing CheckoutRequestID'
+                continue
+            # The first delivery wins; later ones in the batch are replays
+            results.setdefault(checkout_request_id, updates)
+            row_ids[checkout_request_id].append(row.id)
+
+        try:
+            with db_transaction.atomic():
+                settled = settle_transactions(results)
+            failures = {}
+        except Exception:
+            settled, failures = _settle_one_by_one(results)
+
+        failed_rows = {row_id: error for checkout_request_id, error in failures.items() for row_id in row_ids[checkout_request_id]}
+        now = timezone.now()
+        CallbackInbox.objects.filter(id__in=[row.id for row in rows if row.id not in failed_rows]).update(processed_at=now)
+        for row_id, error in errors.items():
+            CallbackInbox.objects.filter(id=row_id).update(error=error)
+        for row in rows:
+            if row.id in failed_rows:
+                attempts = row.attempts + 1
+                CallbackInbox.objects.filter(id=row.id).update(
+                    attempts=attempts, error=failed_rows[row.id][:200],
+                    processed_at=now if attempts >= MAX_ATTEMPTS else None,
+                    next_attempt_at=now + timedelta(seconds=RETRY_AFTER * 2 ** (attempts - 1)),
+                )
+    return len(rows), len(settled)
+
+
+def _settle_one_by_one(results):
+    """(settled transactions, {checkout_request_id: error}) settling each callback in its own savepoint"""
+    settled, failures = [], {}
+    for checkout_request_id, updates in results.items():
+        try:
+            with db_transaction.atomic():
+                settled += settle_transactions({checkout_request_id: updates})
+        except Exception as e:
+            failures[checkout_request_id] = f"{type(e).__name__}: {e}"
+    return settled, failures
+
+
+def inbox_stats():
+    """Depth of the unprocessed inbox and age in seconds of its oldest entry"""
+    stats = CallbackInbox.objects.filter(processed_at__isnull=True).aggregate(
+        depth=Count('id'), oldest=Min('received_at')
+    )
+    lag = (timezone.now() - stats['oldest']).total_seconds() if stats['oldest'] else 0.0
+    return {'depth': stats['depth'], 'lag_seconds': lag}
+
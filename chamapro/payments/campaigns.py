@@ -0,0 +1,128 @@
+"""Fan-out STK pushes asking every member of a chama for their contribution"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
+from chama.models import ContributionObligation
+from chama.obligations import ensure_obligations, member_pairs
+from .models import ContributionCampaign, MpesaTransaction
+from .rollups import record_created
+from .utils import MpesaGateWay, RateLimiter, normalize_phone
+
+
+def campaign_targets(chama, today=None):
+    """
+    (user_id, phone, amount) for every member who still owes for the current
+    period, and the number of members skipped (paid up, or no phone number).
+    """
+    period_start, _ = chama.contribution_period(today or timezone.localdate())
+    user_ids = [user_id for _, user_id in member_pairs([chama.id])]
+    ensure_obligations((chama, user_id, period_start) for user_id in user_ids)
+    owed = {
+        user_id: expected - paid
+        for user_id, expected, paid in ContributionObligation.objects.filter(
+            chama=chama, period_start=period_start, user_id__in=user_ids
+        ).exclude(status='PAID').values_list('user_id', 'expected_amount', 'paid_amount')
+    }
+    phones = get_user_model().objects.filter(id__in=list(owed)).exclude(phone_number='').values_list('id', 'phone_number')
+    targets = [(user_id, normalize_phone(phone), owed[user_id]) for user_id, phone in phones]
+    return targets, len(user_ids) - len(targets)
+
+
+def claim_next_campaign():
+    """
+    Atomically move the oldest queued campaign to RUNNING; None if there is
+    none. A RUNNING campaign whose runner stopped sending heartbeats (it
+    crashed or was killed) is claimed again, so its chama is not blocked for
+    good; members who paid meanwhile are skipped by the new run.
+    """
+    stale = timezone.now() - timedelta(seconds=getattr(settings, 'MPESA_CAMPAIGN_STALE_AFTER', 300))
+    candidates = ContributionCampaign.objects.filter(
+        Q(status='QUEUED') | Q(status='RUNNING', heartbeat_at__lt=stale)
+    ).order_by('created_at').values_list('id', 'status', 'heartbeat_at')[:10]
+    for campaign_id, status, heartbeat_at in candidates:
+        now = timezone.now()
+        # Compare-and-set on the heartbeat too, so two runners cannot take over the same stale campaign
+        claimed = ContributionCampaign.objects.filter(id=campaign_id, status=status, heartbeat_at=heartbeat_at).update(
+            status='RUNNING', started_at=now, heartbeat_at=now, sent=0, failed=0
+        )
+        if claimed:
+            return ContributionCampaign.objects.select_related('chama').get(id=campaign_id)
+    return None
+
+
+def run_campaign(campaign, workers=None, rate=None, flush_every=50, gateway=None, progress=None):
+    """
+    Send one STK push per target through a pool of `workers` threads, paced
+    by a RateLimiter at `rate` pushes per second (defaults: the
+    MPESA_CAMPAIGN_WORKERS and MPESA_STK_RATE_LIMIT settings).
+
+    Only the HTTP calls run in the pool. Accepted pushes are saved from this
+    thread with bulk_create every `flush_every` results, when the campaign's
+    progress counters are updated and `progress(campaign)` is called.
+    """
+    workers = workers or getattr(settings, 'MPESA_CAMPAIGN_WORKERS', 8)
+    rate = getattr(settings, 'MPESA_STK_RATE_LIMIT', 10) if rate is None else rate
+    gateway = gateway or MpesaGateWay()
+    limiter = RateLimiter(rate)
+    chama = campaign.chama
+
+    targets, skipped = campaign_targets(chama)
+    campaign.total, campaign.skipped = len(targets), skipped
+    campaign.save(update_fields=['total', 'skipped'])
+
+    # Use Chama Name as reference (truncated to 12 chars for API limits)
+    account_ref = chama.name[:12].replace(" ", "")
+
+    def push(target):
+        user_id, phone, amount = target
+        limiter.acquire()
+        return target, gateway.stk_push(phone, amount, account_reference=account_ref)
+
+    accepted = []
+    failed = 0
+    last_error = ''
+
+    def flush():
+        nonlocal accepted, failed
+        with db_transaction.atomic():
+            created = MpesaTransaction.objects.bulk_create(accepted)
+            record_created(created)
+            campaign.sent += len(created)
+            campaign.failed += failed
+            campaign.last_error = last_error[:200]
+            campaign.heartbeat_at = timezone.now()
+            campaign.save(update_fields=['sent', 'failed', 'last_error', 'heartbeat_at'])
+        accepted, failed = [], 0
+        if progress:
+            progress(campaign)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(push, target) for target in targets]
+        for done, future in enumerate(as_completed(futures), 1):
+            (user_id, phone, amount), response = future.result()
+            if response.get('ResponseCode') == '0':
+                accepted.append(MpesaTransaction(
+                    user_id=user_id,
+                    chama=chama,
+                    transaction_type='CONTRIBUTION',
+                    merchant_request_id=response.get('MerchantRequestID'),
+                    checkout_request_id=response.get('CheckoutRequestID'),
+                    amount=amount,
+                    phone_number=phone,
+                    status='PENDING'
+                ))
+            else:
+                failed += 1
+                last_error = response.get('ResponseDescription') or response.get('errorMessage') or 'STK push failed'
+            if done % flush_every == 0:
+                flush()
+    flush()
+
+    campaign.status = 'COMPLETED'
+    campaign.finished_at = timezone.now()
+    campaign.save(update_fields=['status', 'finished_at'])
+    return campaign
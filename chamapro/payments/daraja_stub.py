@@ -0,0 +1,360 @@
+"""
+Local stand-in for the Safaricom Daraja API.
+
+Used by benchmarks, tests and `manage.py daraja_simulator` so the payment
+path can be exercised without sandbox access. Run it in-process:
+
+    with DarajaStub(connect_latency=0.03) as stub:
+        settings.MPESA_BASE_URL = stub.url
+
+With a CallbackSender it also answers accepted STK pushes the way
+Safaricom does, by posting an stkCallback to the push's CallBackURL:
+
+    with DarajaStub(callbacks=CallbackSender(delay=2, rate=50, concurrency=8)) as stub:
+        ...
+"""
+import json
+import queue
+import random
+import sys
+import time
+import uuid
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from .utils import RateLimiter
+
+
+# ResultCode -> ResultDesc for STK Query answers
+QUERY_RESULTS = {
+    '0': 'The service request is processed successfully.',
+    '1': 'The balance is insufficient for the transaction.',
+    '1032': 'Request cancelled by user',
+    '1037': 'DS timeout user cannot be reached',
+}
+
+# ResultCode -> share of stkCallbacks sent with it, unless told otherwise
+CALLBACK_RESULTS = {'0': 0.85, '1032': 0.1, '1': 0.03, '1037': 0.02}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        # A new TCP connection: emulate the TLS handshake cost
+        self.server.stub.count('connections')
+        if self.server.stub.connect_latency:
+            time.sleep(self.server.stub.connect_latency)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(raw or b'{}')
+        except ValueError:
+            return {}
+
+    def do_GET(self):
+        stub = self.server.stub
+        if self.path.startswith('/oauth/v1/generate'):
+            status = stub.serve('tokens')
+            if status:
+                return self._send(status, {'errorMessage': 'Service Unavailable'})
+            return self._send(200, {'access_token': uuid.uuid4().hex, 'expires_in': str(stub.token_ttl)})
+        self._send(404, {'errorMessage': 'Not Found'})
+
+    def do_POST(self):
+        stub = self.server.stub
+        payload = self._read_json()  # always drained, so the connection can be reused
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self._send(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+
+        if self.path == '/mpesa/stkpush/v1/processrequest':
+            status = stub.serve('stk_push')
+            if status:
+                return self._send(status, {'errorMessage': 'Service Unavailable'})
+            merchant_request_id = uuid.uuid4().hex[:20]
+            checkout_request_id = f"ws_CO_{uuid.uuid4().hex[:24]}"
+            if stub.callbacks is not None:
+                # STK Query must tell the same story as the callback
+                stub.query_results[checkout_request_id] = stub.callbacks.schedule(
+                    payload, merchant_request_id, checkout_request_id
+                )
+            return self._send(200, {
+                'MerchantRequestID': merchant_request_id,
+                'CheckoutRequestID': checkout_request_id,
+                'ResponseCode': '0',
+                'ResponseDescription': 'Success. Request accepted for processing',
+                'CustomerMessage': 'Success. Request accepted for processing',
+            })
+        if self.path == '/mpesa/stkpushquery/v1/query':
+            status = stub.serve('stk_query')
+            if status:
+                return self._send(status, {'errorMessage': 'Service Unavailable'})
+            checkout_id = payload.get('CheckoutRequestID', '')
+            result_code = stub.query_results.get(checkout_id, stub.default_query_result)
+            if result_code is None:
+                return self._send(500, {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'})
+            return self._send(200, {
+                'ResponseCode': '0',
+                'ResponseDescription': 'The service request has been accepted successsfully',
+                'MerchantRequestID': uuid.uuid4().hex[:20],
+                'CheckoutRequestID': checkout_id,
+                'ResultCode': result_code,
+                'ResultDesc': QUERY_RESULTS.get(result_code, 'The service request failed'),
+            })
+        if self.path == '/mpesa/b2c/v1/paymentrequest':
+            status = stub.serve('b2c')
+            if status:
+                return self._send(status, {'errorMessage': 'Service Unavailable'})
+            return self._send(200, {
+                'ConversationID': f"AG_{uuid.uuid4().hex[:20]}",
+                'OriginatorConversationID': uuid.uuid4().hex[:20],
+                'ResponseCode': '0',
+                'ResponseDescription': 'Accept the service request successfully.',
+            })
+        self._send(404, {'errorMessage': 'Not Found'})
+
+
+class _Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients that timed out hang up before the delayed answer: expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class CallbackSender:
+    """
+    Posts the stkCallback of every accepted STK push, as Safaricom does once
+    the customer has answered the prompt: `delay` seconds after the push, at
+    most `rate` per second (0 for no limit), from `concurrency` threads.
+
+    `results` maps ResultCode -> weight (default CALLBACK_RESULTS); `url`
+    replaces the push's CallBackURL. The round trip of every delivery is
+    kept in `latencies` (seconds) and its HTTP status, or 'error', counted
+    in `statuses`.
+    """
+
+    def __init__(self, delay=0.0, rate=0, concurrency=4, results=None, url=None, seed=None, timeout=30):
+        self.delay = delay
+        self.limiter = RateLimiter(rate)
+        self.concurrency = max(concurrency, 1)
+        results = results or CALLBACK_RESULTS
+        self.codes, self.weights = list(results), list(results.values())
+        self.url = url
+        self.timeout = timeout
+        self.latencies = []
+        self.statuses = Counter()
+        self._random = random.Random(seed)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def schedule(self, push, merchant_request_id, checkout_request_id):
+        """Queue the callback for an accepted push payload; returns its ResultCode"""
+        with self._lock:
+            result_code = self._random.choices(self.codes, self.weights)[0]
+            receipt = ''.join(self._random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=10))
+        callback = {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': int(result_code),
+            'ResultDesc': QUERY_RESULTS.get(result_code, 'The service request failed'),
+        }
+        if result_code == '0':
+            callback['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': push.get('Amount')},
+                {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+                {'Name': 'TransactionDate', 'Value': int(time.strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': int(push.get('PhoneNumber') or 0)},
+            ]}
+        body = json.dumps({'Body': {'stkCallback': callback}})
+        self._queue.put((time.monotonic() + self.delay, self.url or push.get('CallBackURL'), body))
+        return result_code
+
+    def _deliver(self):
+        session = requests.Session()
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                due, url, body = item
+                # One delay for every push, so the queue is in due order
+                wait = due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                self.limiter.acquire()
+                start = time.perf_counter()
+                try:
+                    status = session.post(
+                        url, data=body, headers={'Content-Type': 'application/json'}, timeout=self.timeout
+                    ).status_code
+                except requests.RequestException:
+                    status = 'error'
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.latencies.append(elapsed)
+                    self.statuses[status] += 1
+            finally:
+                self._queue.task_done()
+
+    def pending(self):
+        """Callbacks scheduled but not delivered yet"""
+        return self._queue.unfinished_tasks
+
+    def wait(self, timeout=None):
+        """Block until every scheduled callback is delivered; False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def start(self):
+        self._threads = [
+            threading.Thread(target=self._deliver, name=f'daraja-callbacks-{i}', daemon=True)
+            for i in range(self.concurrency)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+class DarajaStub:
+    """
+    Threaded local Daraja server. `url` is usable as MPESA_BASE_URL.
+
+    STK Query answers `query_results[checkout_request_id]`, else
+    `default_query_result`: a ResultCode string, or None for "still being
+    processed".
+
+    `latencies` overrides `latency` per endpoint (tokens, stk_push,
+    stk_query, b2c), each call taking up to `jitter` (a fraction) more or
+    less. `failure_rate`, or `failure_rates` per endpoint, is the share of
+    calls answered with a 503; while `fail_status` is set every call answers
+    with that HTTP status instead, to exercise timeouts, retries and the
+    breaker. `callbacks` is an optional CallbackSender.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, connect_latency=0.0, latency=0.0, token_ttl=3599,
+                 default_query_result='0', latencies=None, fail_status=None, jitter=0.0,
+                 failure_rate=0.0, failure_rates=None, callbacks=None, seed=None):
+        self.connect_latency = connect_latency
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.jitter = jitter
+        self.fail_status = fail_status
+        self.failure_rate = failure_rate
+        self.failure_rates = failure_rates or {}
+        self.callbacks = callbacks
+        self._random = random.Random(seed)
+        self.token_ttl = token_ttl
+        self.query_results = {}
+        self.default_query_result = default_query_result
+        self.counters = {}
+        self._counter_lock = threading.Lock()
+        self.server = _Server((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self._counter_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def serve(self, name):
+        """Count a call to `name` and wait out its latency; the HTTP status to fail it with, or None"""
+        self.count(name)
+        latency = self.latencies.get(name, self.latency)
+        if latency and self.jitter:
+            latency *= self._random.uniform(1 - self.jitter, 1 + self.jitter)
+        if latency:
+            time.sleep(latency)
+        if self.fail_status is not None:
+            return self.fail_status
+        if self._random.random() < self.failure_rates.get(name, self.failure_rate):
+            self.count(f'{name}.failed')
+            return 503
+        return None
+
+    def reset(self):
+        with self._counter_lock:
+            self.counters = {}
+
+    def start(self):
+        if self.callbacks is not None:
+            self.callbacks.start()
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.callbacks is not None:
+            self.callbacks.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def add_simulator_arguments(parser):
+    """Options shared by the daraja_simulator and bench_payments commands"""
+    parser.add_argument('--latency', type=float, default=200.0, help='Milliseconds every Daraja call takes')
+    parser.add_argument('--jitter', type=float, default=0.5, help='Latency varies by up to this fraction')
+    parser.add_argument('--connect-latency', type=float, default=0.0, help='Milliseconds added per new connection')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of Daraja calls answered with a 503')
+    parser.add_argument('--callback-delay', type=float, default=2.0, help='Seconds between a push and its callback')
+    parser.add_argument('--callback-rate', type=float, default=0, help='Callbacks posted per second (0: no limit)')
+    parser.add_argument('--callback-concurrency', type=int, default=8, help='Callbacks in flight at once')
+    parser.add_argument('--results', default=','.join(f'{code}={weight}' for code, weight in CALLBACK_RESULTS.items()),
+                        help='Callback ResultCodes and their weights, as CODE=WEIGHT,...')
+    parser.add_argument('--seed', type=int, help='Seed for latencies, failures and results')
+
+
+def simulator_from_options(options, **overrides):
+    """A DarajaStub (with a CallbackSender) configured from add_simulator_arguments() options"""
+    results = {}
+    for pair in options['results'].split(','):
+        code, _, weight = pair.partition('=')
+        results[code.strip()] = float(weight or 1)
+    sender = CallbackSender(
+        delay=options['callback_delay'], rate=options['callback_rate'],
+        concurrency=options['callback_concurrency'], results=results,
+        url=overrides.pop('callback_url', None), seed=options['seed'],
+    )
+    return DarajaStub(
+        latency=options['latency'] / 1000, jitter=options['jitter'],
+        connect_latency=options['connect_latency'] / 1000, failure_rate=options['failure_rate'],
+        callbacks=sender, seed=options['seed'], **overrides,
+    )
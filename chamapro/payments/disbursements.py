@@ -0,0 +1,147 @@
+"""
+Loan disbursement over M-Pesa B2C, off the request path.
+
+approve_and_reserve() takes the amount out of the chama ledger and marks the
+loan APPROVED. The `disburse_loans` worker claims APPROVED loans (-> DISBURSING)
+and sends the B2C request; Daraja later posts the outcome to the result or
+queue-timeout endpoint, which moves the loan to DISBURSED or FAILED. A failed
+loan's reservation goes back to the chama as a REFUND entry.
+"""
+from django.db import transaction as db_transaction
+from django.utils import timezone
+from chama import ledger
+from chama.caching import invalidate_dashboards
+from chama.models import Chama, Loan
+from chama.obligations import member_pairs
+from .utils import MpesaGateWay, normalize_phone
+
+
+def _invalidate_members(chama_id):
+    """The chama balance moved: refresh its members' dashboards once committed"""
+    user_ids = {user_id for _, user_id in member_pairs([chama_id])}
+    db_transaction.on_commit(lambda: invalidate_dashboards(user_ids))
+
+
+def approve_and_reserve(loan, approved_by):
+    """
+    PENDING -> APPROVED, reserving the amount with a DISBURSEMENT ledger
+    entry. Approvals of the same chama are serialised on its row so two
+    cannot both pass the balance check; contribution callbacks only append
+    to the ledger and never wait on that lock.
+    Returns False, changing nothing, if the loan is no longer pending or the
+    balance is too low.
+    """
+    with db_transaction.atomic():
+        Chama.objects.select_for_update().only('id').get(id=loan.chama_id)
+        if ledger.balance(loan.chama_id) < loan.amount:
+            return False
+        now = timezone.now()
+        approved = Loan.objects.filter(id=loan.id, status='PENDING').update(
+            status='APPROVED', action_by=approved_by, action_date=now
+        )
+        if not approved:
+            return False
+        ledger.record([(loan.chama_id, 'DISBURSEMENT', -loan.amount, f"loan:{loan.id}")])
+        _invalidate_members(loan.chama_id)
+    loan.status, loan.action_by, loan.action_date = 'APPROVED', approved_by, now
+    return True
+
+
+def fail_loan(loan_id, reason, statuses=('DISBURSING',)):
+    """Move the loan to FAILED and give its reservation back; False if it was not in `statuses`"""
+    with db_transaction.atomic():
+        loan = Loan.objects.select_for_update().filter(id=loan_id, status__in=statuses).first()
+        if loan is None:
+            return False
+        loan.status = 'FAILED'
+        loan.failure_reason = (reason or 'Disbursement failed')[:200]
+        loan.save(update_fields=['status', 'failure_reason'])
+        ledger.record([(loan.chama_id, 'REFUND', loan.amount, f"loan:{loan.id}")])
+        _invalidate_members(loan.chama_id)
+    return True
+
+
+def claim_approved_loans(limit=20):
+    """Atomically move up to `limit` APPROVED loans to DISBURSING and return them"""
+    claimed = []
+    for loan_id in Loan.objects.filter(status='APPROVED').order_by('action_date').values_list('id', flat=True)[:limit]:
+        if Loan.objects.filter(id=loan_id, status='APPROVED').update(
+            status='DISBURSING', disbursement_started_at=timezone.now()
+        ):
+            claimed.append(loan_id)
+    return list(Loan.objects.filter(id__in=claimed).select_related('borrower'))
+
+
+def disburse(loan, gateway=None):
+    """
+    Send the B2C request for a claimed (DISBURSING) loan. An accepted request
+    waits for its result callback; one Daraja answered with a rejection
+    fails the loan. If Daraja never saw the request the loan goes back to
+    APPROVED for the next pass. Otherwise (timeout after sending, unreadable
+    answer) it may have been paid: it stays DISBURSING without a
+    conversation id for an admin to check, and is neither refunded nor sent
+    again.
+    """
+    gateway = gateway or MpesaGateWay()
+    phone = normalize_phone(loan.borrower.phone_number or '')
+    if not phone:
+        fail_loan(loan.id, "Borrower has no M-Pesa phone number")
+        return 'FAILED'
+
+    response = gateway.disburse_funds(
+        phone, loan.amount, remarks=f"Loan for {loan.borrower.username}", occasion=f"Loan {loan.id}"
+    )
+    if response.get('ResponseCode') == '0':
+        Loan.objects.filter(id=loan.id, status='DISBURSING').update(
+            conversation_id=response.get('ConversationID') or ''
+        )
+        return 'DISBURSING'
+    if response.get('RequestSent') is False:
+        Loan.objects.filter(id=loan.id, status='DISBURSING').update(status='APPROVED', disbursement_started_at=None)
+        return 'APPROVED'
+    if response.get('Answered'):
+        fail_loan(loan.id, response.get('ResponseDescription') or response.get('errorMessage'))
+        return 'FAILED'
+    Loan.objects.filter(id=loan.id).update(failure_reason=(response.get('ResponseDescription') or '')[:200])
+    return 'UNKNOWN'
+
+
+def disburse_loans(limit=20, gateway=None):
+    """One worker pass: claim APPROVED loans and disburse them. Returns {outcome: count}"""
+    gateway = gateway or MpesaGateWay()
+    outcomes = {}
+    for loan in claim_approved_loans(limit):
+        outcome = disburse(loan, gateway)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return outcomes
+
+
+def parse_b2c_result(data):
+    """Turn a B2C Result (or queue timeout) payload into (conversation_id, result_code, result_desc, receipt)"""
+    result = data.get('Result', {})
+    return (
+        result.get('ConversationID') or '',
+        result.get('ResultCode'),
+        result.get('ResultDesc') or '',
+        result.get('TransactionID') or '',
+    )
+
+
+def apply_b2c_result(data, timed_out=False):
+    """
+    Settle the DISBURSING loan a B2C result (or, with `timed_out`, a queue
+    timeout) refers to. Replays, and results for loans already settled,
+    change nothing. Returns the new status or None.
+    """
+    conversation_id, result_code, result_desc, receipt = parse_b2c_result(data)
+    if not conversation_id:
+        return None
+    loan_id = Loan.objects.filter(conversation_id=conversation_id).values_list('id', flat=True).first()
+    if loan_id is None:
+        return None
+    if str(result_code) == '0' and not timed_out:
+        settled = Loan.objects.filter(id=loan_id, status='DISBURSING').update(
+            status='DISBURSED', receipt_number=receipt[:50], disbursed_at=timezone.now(), failure_reason=''
+        )
+        return 'DISBURSED' if settled else None
+    return 'FAILED' if fail_loan(loan_id, result_desc or 'B2C request timed out') else None
@@ -0,0 +1,139 @@
+"""
+Check chama ledgers against the records they summarise.
+
+A chama's ledger balance should equal its successful M-Pesa contributions,
+minus the loans holding a reservation and the amounts of its investments,
+plus the PENALTY entries that have no other source. OPENING and ADJUSTMENT
+entries are exactly the part nothing explains, so they count as drift until
+an ADJUSTMENT cancels what the rest gets wrong. Everything is computed with
+grouped aggregates over a chunk of chamas at a time, so memory stays flat
+however many transactions there are.
+"""
+from collections import defaultdict
+from decimal import Decimal
+from django.db import connection, transaction as db_transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+from chama import ledger
+from chama.models import Chama, Investment, LedgerEntry, Loan
+from .models import MpesaTransaction
+
+ZERO = Decimal('0')
+# Loans whose amount has left (or is reserved to leave) the chama
+RESERVED_LOAN_STATUSES = ['APPROVED', 'DISBURSING', 'DISBURSED', 'PAID']
+UNEXPLAINED_KINDS = ['OPENING', 'ADJUSTMENT']
+
+
+def _grouped(queryset, value, chama_ids):
+    return dict(
+        queryset.filter(chama_id__in=chama_ids).values('chama_id').annotate(v=value).values_list('chama_id', 'v')
+    )
+
+
+def check_chunk(chama_ids):
+    """
+    One row per chama in `chama_ids`: ledger balance, expected balance, the
+    components of the difference, the snapshot copy in Chama.total_balance
+    and DISBURSED loans with no B2C conversation (paid out without M-Pesa).
+    Six grouped queries, read from one consistent snapshot of the database.
+    """
+    with db_transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        entries = defaultdict(dict)
+        for chama_id, kind, total in (
+            LedgerEntry.objects.filter(chama_id__in=chama_ids)
+            .values('chama_id', 'kind').annotate(total=Sum('amount')).values_list('chama_id', 'kind', 'total')
+        ):
+            entries[chama_id][kind] = total
+        contributions = _grouped(
+            MpesaTransaction.objects.filter(transaction_type='CONTRIBUTION', status='SUCCESS', user__isnull=False),
+            Sum('amount'), chama_ids,
+        )
+        loans = _grouped(Loan.objects.filter(status__in=RESERVED_LOAN_STATUSES), Sum('amount'), chama_ids)
+        investments = _grouped(Investment.objects.all(), Sum('amount'), chama_ids)
+        unverified = _grouped(Loan.objects.filter(status='DISBURSED', conversation_id=''), Count('id'), chama_ids)
+        chamas = {c: (name, copy) for c, name, copy in Chama.objects.filter(id__in=chama_ids).values_list('id', 'name', 'total_balance')}
+
+    rows = []
+    for chama_id in chama_ids:
+        kinds = entries.get(chama_id, {})
+        ledger_balance = sum(kinds.values(), ZERO)
+        contribution_drift = kinds.get('CONTRIBUTION', ZERO) - contributions.get(chama_id, ZERO)
+        loan_drift = kinds.get('DISBURSEMENT', ZERO) + kinds.get('REFUND', ZERO) + loans.get(chama_id, ZERO)
+        investment_drift = kinds.get('INVESTMENT', ZERO) + investments.get(chama_id, ZERO)
+        unexplained = sum((kinds.get(kind, ZERO) for kind in UNEXPLAINED_KINDS), ZERO)
+        drift = contribution_drift + loan_drift + investment_drift + unexplained
+        name, copy = chamas.get(chama_id, ('', ZERO))
+        rows.append({
+            'chama_id': chama_id,
+            'name': name,
+            'ledger': ledger_balance,
+            'expected': ledger_balance - drift,
+            'contribution_drift': contribution_drift,
+            'loan_drift': loan_drift,
+            'investment_drift': investment_drift,
+            'unexplained': unexplained,
+            'drift': drift,
+            'total_balance': copy,
+            'unverified_disbursements': unverified.get(chama_id, 0),
+        })
+    return rows
+
+
+def chama_chunks(chunk_size=500):
+    """Chama ids, `chunk_size` at a time, by keyset so no chunk gets slower"""
+    last = None
+    while True:
+        chamas = Chama.objects.order_by('id')
+        if last is not None:
+            chamas = chamas.filter(id__gt=last)
+        ids = list(chamas.values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return
+        yield ids
+        last = ids[-1]
+
+
+def fix_drift(rows):
+    """
+    Bring drifting ledgers back to their expected balance with one ADJUSTMENT
+    entry each (the ledger is append-only), and set Chama.total_balance to the
+    corrected figure. Bulk writes, in one transaction per chunk.
+    """
+    drifting = [row for row in rows if row['drift']]
+    if not drifting:
+        return 0
+    stamp = timezone.now().strftime('%Y%m%dT%H%M%S%f')
+    with db_transaction.atomic():
+        ledger.record([
+            (row['chama_id'], 'ADJUSTMENT', -row['drift'], f"verify_balances:{stamp}") for row in drifting
+        ])
+        Chama.objects.bulk_update(
+            [Chama(id=row['chama_id'], total_balance=row['expected']) for row in drifting], ['total_balance'],
+            batch_size=500,
+        )
+    return len(drifting)
+
+
+def verify_balances(chunk_size=500, fix=False, report=None):
+    """
+    Check every chama, a chunk at a time, calling `report(row)` for each one
+    that drifts. Returns totals: checked, drifting, absolute drift, fixed and
+    unverified disbursements.
+    """
+    totals = {'checked': 0, 'drifting': 0, 'absolute_drift': ZERO, 'fixed': 0, 'unverified_disbursements': 0}
+    for chama_ids in chama_chunks(chunk_size):
+        rows = check_chunk(chama_ids)
+        for row in rows:
+            totals['unverified_disbursements'] += row['unverified_disbursements']
+            if row['drift']:
+                totals['drifting'] += 1
+                totals['absolute_drift'] += abs(row['drift'])
+                if report:
+                    report(row)
+        totals['checked'] += len(rows)
+        if fix:
+            totals['fixed'] += fix_drift(rows)
+    return totals
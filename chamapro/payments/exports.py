@@ -0,0 +1,77 @@
+"""Streaming CSV exports of MpesaTransaction rows"""
+import csv
+from datetime import datetime, time, timedelta
+from django.utils import timezone
+from .models import MpesaTransaction
+
+CHUNK_SIZE = 2000
+FORMULA_PREFIXES = ('=', '+', '-', '@')
+
+# (CSV header, values_list field)
+COLUMNS = [
+    ('Date', 'transaction_date'),
+    ('Member', 'user__username'),
+    ('Phone', 'phone_number'),
+    ('Type', 'transaction_type'),
+    ('Status', 'status'),
+    ('Amount', 'amount'),
+    ('Fee', 'transaction_fee'),
+    ('Receipt No.', 'receipt_number'),
+    ('Checkout Request ID', 'checkout_request_id'),
+    ('Description', 'description'),
+]
+
+
+class Echo:
+    """File-like object whose write() hands the line back instead of buffering it"""
+    def write(self, value):
+        return value
+
+
+def export_queryset(chama=None, user_id=None, start=None, end=None, transaction_type=None, status=None):
+    """
+    values_list rows for the export, oldest first. `start` and `end` are
+    inclusive local dates.
+    """
+    rows = MpesaTransaction.objects.all()
+    if chama is not None:
+        rows = rows.filter(chama=chama)
+    if user_id is not None:
+        rows = rows.filter(user_id=user_id)
+    if start:
+        rows = rows.filter(transaction_date__gte=timezone.make_aware(datetime.combine(start, time.min)))
+    if end:
+        rows = rows.filter(transaction_date__lt=timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min)))
+    if transaction_type:
+        rows = rows.filter(transaction_type=transaction_type)
+    if status:
+        rows = rows.filter(status=status)
+    return rows.order_by('transaction_date', 'id').values_list(*[field for _, field in COLUMNS])
+
+
+def _cell(value):
+    """Stop spreadsheet apps from evaluating user-supplied text as a formula"""
+    if isinstance(value, str) and value[:1] in FORMULA_PREFIXES:
+        return "'" + value
+    return value
+
+
+def csv_lines(rows, chunk_size=CHUNK_SIZE):
+    """
+    Yield CSV text a chunk of rows at a time, pulling `chunk_size` rows from
+    the database per fetch, so memory use does not depend on the row count.
+    """
+    tz = timezone.get_current_timezone()  # once, not a thread-local lookup per row
+    writer = csv.writer(Echo())
+    yield writer.writerow([header for header, _ in COLUMNS])
+    lines = []
+    for when, member, phone, kind, status, amount, fee, receipt, checkout_id, description in rows.iterator(chunk_size=chunk_size):
+        lines.append(writer.writerow([
+            when.astimezone(tz).strftime('%Y-%m-%d %H:%M:%S'), _cell(member), phone, kind, status,
+            amount, fee, receipt, checkout_id, _cell(description),
+        ]))
+        if len(lines) == chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
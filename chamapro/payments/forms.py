@@ -0,0 +1,22 @@
+# payments/forms.py
+from django import forms
+
+STATUS_CHOICES = [('', 'Any'), ('SUCCESS', 'Success'), ('PENDING', 'Pending'), ('FAILED', 'Failed')]
+
+
+class ExportFilterForm(forms.Form):
+    """Query-string filters for the transaction CSV export"""
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False)
+    type = forms.CharField(required=False, max_length=50)
+    status = forms.ChoiceField(required=False, choices=STATUS_CHOICES)
+    member = forms.IntegerField(required=False, help_text='Export one member\'s statement')
+
+    def clean_type(self):
+        return self.cleaned_data['type'].upper()
+
+    def clean(self):
+        cleaned = super().clean()
+        if cleaned.get('start') and cleaned.get('end') and cleaned['start'] > cleaned['end']:
+            raise forms.ValidationError('Start date must be on or before end date.')
+        return cleaned
@@ -0,0 +1,62 @@
+"""Keyset (cursor) pagination over a chama's contribution history"""
+import base64
+from datetime import datetime
+from django.db.models import Q
+from .models import MpesaTransaction
+
+PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(transaction_date, pk):
+    raw = f"{transaction_date.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(transaction_date, id) from a cursor; ValueError if it was tampered with"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        when, pk = raw.split('|')
+        return datetime.fromisoformat(when), int(pk)
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from exc
+
+
+def contribution_page(chama, cursor=None, limit=PAGE_SIZE):
+    """
+    One page of successful contributions, newest first, and the cursor for the
+    next page (None on the last one). Seeks on (transaction_date, id) through
+    the chama/type/status/date/id index, so every page costs the same however
+    long the history is.
+    """
+    rows = MpesaTransaction.objects.filter(
+        chama=chama,
+        status='SUCCESS',
+        transaction_type='CONTRIBUTION'
+    ).select_related('user').only(
+        'id', 'transaction_date', 'amount', 'receipt_number',
+        'user__username', 'user__first_name', 'user__last_name',
+    ).order_by('-transaction_date', '-id')
+
+    if cursor:
+        when, pk = decode_cursor(cursor)
+        # The plain `<=` gives the database a range to seek to; the OR breaks ties on id
+        rows = rows.filter(transaction_date__lte=when).filter(Q(transaction_date__lt=when) | Q(id__lt=pk))
+
+    # One extra row tells us whether there is a next page without a COUNT
+    page = list(rows[:limit + 1])
+    if len(page) <= limit:
+        return page, None
+    page = page[:limit]
+    return page, encode_cursor(page[-1].transaction_date, page[-1].pk)
+
+
+def serialize_contribution(t):
+    return {
+        'id': t.pk,
+        'member': (t.user.get_full_name() or t.user.username) if t.user else None,
+        'amount': str(t.amount),
+        'receipt_number': t.receipt_number,
+        'date': t.transaction_date.isoformat(),
+    }
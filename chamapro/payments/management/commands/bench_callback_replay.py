@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import random
+from contextlib import redirect_stdout
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries
+from django.db.models import Sum
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from chamapro.bench import temporary_database, percentile
+from chama import ledger
+from chama.models import Chama
+from payments.callbacks import drain_inbox
+from payments.models import MpesaTransaction, CallbackInbox
+from payments.rollups import record_created
+from payments.views import mpesa_callback
+
+
+class Command(BaseCommand):
+    help = "Replay STK callbacks (with Safaricom-style duplicates) through the endpoint and inbox worker on a seeded throwaway database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--callbacks', type=int, default=100_000, help='Total callbacks to fire')
+        parser.add_argument('--duplicate-ratio', type=float, default=0.3, help='Share of callbacks that are replays')
+        parser.add_argument('--drain-every', type=int, default=1000,
+                            help='Run one worker batch after this many callbacks')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        total = options['callbacks']
+        unique = max(int(total * (1 - options['duplicate_ratio'])), 1)
+
+        with temporary_database():
+            chama = self._seed(unique)
+            payloads = [(self._checkout_id(i), self._payload(i, rng)) for i in range(unique)]
+            stream = payloads + [rng.choice(payloads) for _ in range(total - unique)]
+            rng.shuffle(stream)
+
+            factory = RequestFactory()
+            seen = set()
+            first, replay = [], []
+            replay_queries = []
+            drain_time = 0.0
+            start = time.perf_counter()
+            # The view prints a trace line per bad payload; keep it off the report
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                for n, (checkout_id, body) in enumerate(stream, 1):
+                    request = factory.post('/payments/callback/', data=body, content_type='application/json')
+                    is_replay = checkout_id in seen
+                    seen.add(checkout_id)
+                    if is_replay and len(replay_queries) < 1000:
+                        reset_queries()
+                        with CaptureQueriesContext(connection) as ctx:
+                            t0 = time.perf_counter()
+                            mpesa_callback(request)
+                        replay_queries.append(len(ctx.captured_queries))
+                    else:
+                        t0 = time.perf_counter()
+                        mpesa_callback(request)
+                    (replay if is_replay else first).append((time.perf_counter() - t0) * 1000)
+                    if n % options['drain_every'] == 0:
+                        t0 = time.perf_counter()
+                        drain_inbox(options['drain_every'])
+                        drain_time += time.perf_counter() - t0
+            t0 = time.perf_counter()
+            while drain_inbox(options['drain_every'])[0]:
+                pass
+            drain_time += time.perf_counter() - t0
+            elapsed = time.perf_counter() - start
+            inboxed = CallbackInbox.objects.count()
+
+            balance = ledger.balance(chama.id)
+            expected = MpesaTransaction.objects.filter(chama=chama, status='SUCCESS').aggregate(
+                total=Sum('amount'))['total'] or Decimal('0')
+
+        self.stdout.write(f"{total} callbacks ({len(replay)} replays) in {elapsed:.1f}s -> {total / elapsed:,.0f}/s")
+        self.stdout.write(f"worker drained {inboxed} inbox rows in {drain_time:.1f}s -> {inboxed / drain_time:,.0f}/s; "
+                          f"{total - inboxed} settled replays never reached the inbox")
+        self.stdout.write(f"endpoint, first p50 {percentile(first, 50):.3f}ms  p99 {percentile(first, 99):.3f}ms")
+        self.stdout.write(f"endpoint, replay p50 {percentile(replay, 50):.3f}ms  p99 {percentile(replay, 99):.3f}ms  "
+                          f"queries/replay max {max(replay_queries or [0])}")
+        status = self.style.SUCCESS('OK') if balance == expected else self.style.ERROR('DRIFT')
+        self.stdout.write(f"balance {balance} vs successful contributions {expected}: {status}")
+
+    def _seed(self, count):
+        User = get_user_model()
+        users = User.objects.bulk_create(
+            [User(username=f"bench{i}", email=f"bench{i}@example.com") for i in range(50)]
+        )
+        chama = Chama.objects.create(
+            name="Replay Bench", county="Nairobi", phone="254700000000",
+            monthly_contribution=500, created_by=users[0],
+        )
+        chama.members.add(*users)
+        seeded = MpesaTransaction.objects.bulk_create(
+            [
+                MpesaTransaction(
+                    user=users[i % len(users)], chama=chama, transaction_type='CONTRIBUTION',
+                    merchant_request_id=f"mr-{i}", checkout_request_id=self._checkout_id(i),
+                    amount=500, phone_number="254700000000", status='PENDING',
+                )
+                for i in range(count)
+            ],
+            batch_size=5000,
+        )
+        record_created(seeded)
+        return chama
+
+    @staticmethod
+    def _checkout_id(i):
+        return f"ws_CO_{i:024d}"
+
+    def _payload(self, i, rng):
+        checkout_id = self._checkout_id(i)
+        if rng.random() < 0.9:
+            callback = {
+                'CheckoutRequestID': checkout_id, 'MerchantRequestID': f"mr-{i}",
+                'ResultCode': 0, 'ResultDesc': 'The service request is processed successfully.',
+                'CallbackMetadata': {'Item': [
+                    {'Name': 'Amount', 'Value': 500},
+                    {'Name': 'MpesaReceiptNumber', 'Value': f"RB{i:08d}"},
+                    {'Name': 'PhoneNumber', 'Value': 254700000000},
+                ]},
+            }
+        else:
+            callback = {
+                'CheckoutRequestID': checkout_id, 'MerchantRequestID': f"mr-{i}",
+                'ResultCode': 1032, 'ResultDesc': 'Request cancelled by user',
+            }
+        return json.dumps({'Body': {'stkCallback': callback}})
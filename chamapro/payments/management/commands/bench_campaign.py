@@ -0,0 +1,61 @@
+import time
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext, override_settings
+from chamapro.bench import temporary_database
+from chama.models import Chama
+from payments.campaigns import run_campaign
+from payments.daraja_stub import DarajaStub
+from payments.models import ContributionCampaign
+from payments.utils import MpesaGateWay
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Benchmark a \"request contributions\" campaign against a local Daraja stub: sequential vs pooled vs rate-limited"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=200)
+        parser.add_argument('--workers', type=int, default=16)
+        parser.add_argument('--rate', type=float, default=10.0, help='Pushes per second for the rate-limited run')
+        parser.add_argument('--latency', type=float, default=300.0, help='Milliseconds the stub takes per STK push')
+
+    def handle(self, *args, **options):
+        with temporary_database(), DarajaStub(latency=options['latency'] / 1000) as stub, \
+                override_settings(MPESA_BASE_URL=stub.url):
+            chama = self._seed(options['members'])
+            runs = [
+                ('sequential', 1, 0),
+                (f"{options['workers']} threads", options['workers'], 0),
+                (f"{options['workers']} threads @ {options['rate']:g}/s", options['workers'], options['rate']),
+            ]
+            for label, workers, rate in runs:
+                MpesaGateWay().token_store.invalidate()  # a token cached by an earlier run would hide the OAuth call
+                stub.reset()
+                campaign = ContributionCampaign.objects.create(chama=chama, status='RUNNING')
+                reset_queries()
+                start = time.perf_counter()
+                with CaptureQueriesContext(connection) as ctx:
+                    run_campaign(campaign, workers=workers, rate=rate)
+                elapsed = time.perf_counter() - start
+                self.stdout.write(
+                    f"{label:<24} {campaign.sent:>4} sent in {elapsed:6.2f}s  {campaign.sent / elapsed:7.1f} pushes/s  "
+                    f"{len(ctx.captured_queries)} queries  {stub.counters.get('tokens', 0)} token requests"
+                )
+
+    def _seed(self, count):
+        password = make_password(None)
+        admin = User.objects.create(username='admin', email='admin@example.com', password=password)
+        members = User.objects.bulk_create([
+            User(username=f'm{i}', email=f'm{i}@example.com', password=password, phone_number=f'2547{i:08d}')
+            for i in range(count)
+        ])
+        chama = Chama.objects.create(
+            name='Campaign Bench', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=admin,
+        )
+        chama.members.add(*members)
+        return chama
@@ -0,0 +1,57 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from payments.daraja_stub import DarajaStub
+from payments.resilience import metrics
+from payments.utils import MpesaGateWay
+
+
+class Command(BaseCommand):
+    help = "Hit a local Daraja stub that is healthy, slow, then down, and report latency, timeouts, retries and breaker trips"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200)
+        parser.add_argument('--workers', type=int, default=16)
+        parser.add_argument('--latency', type=float, default=50.0, help='Milliseconds a healthy call takes')
+        parser.add_argument('--read-timeout', type=float, default=1.0, help='Seconds before a call is abandoned')
+
+    def handle(self, *args, **options):
+        latency = options['latency'] / 1000
+        scenarios = [
+            ('healthy', {'latency': latency}),
+            ('slow', {'latency': options['read_timeout'] * 2}),
+            ('down (503)', {'latency': latency, 'fail_status': 503}),
+        ]
+        read_timeouts = {endpoint: options['read_timeout'] for endpoint in ('oauth', 'stk_push', 'stk_query', 'b2c')}
+        for label, stub_options in scenarios:
+            with DarajaStub(**stub_options) as stub, \
+                    override_settings(MPESA_BASE_URL=stub.url, MPESA_READ_TIMEOUTS=read_timeouts):
+                gateway = MpesaGateWay()
+                gateway.breaker.reset()
+                # Fetch the token first so only the STK traffic is measured
+                stub.fail_status, fail_status = None, stub.fail_status
+                gateway.get_access_token()
+                stub.fail_status = fail_status
+                metrics.reset()
+
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+                    answers = list(pool.map(
+                        lambda i: gateway.stk_push('254700000000', 100), range(options['calls'])
+                    ))
+                elapsed = time.perf_counter() - start
+
+                accepted = sum(1 for answer in answers if answer.get('ResponseCode') == '0')
+                snapshot = metrics.snapshot()
+                stk = snapshot['endpoints'].get('stk_push', {})
+                counters = snapshot['counters']
+                self.stdout.write(
+                    f"{label:<11} {accepted:>4}/{options['calls']} accepted in {elapsed:6.2f}s  "
+                    f"p50 {stk.get('p50', 0) * 1000:7.1f}ms  p95 {stk.get('p95', 0) * 1000:7.1f}ms  "
+                    f"p99 {stk.get('p99', 0) * 1000:7.1f}ms  "
+                    f"{counters.get('stk_push.timeouts', 0)} timeouts  {counters.get('stk_push.retries', 0)} retries  "
+                    f"{stub.counters.get('stk_push', 0)} reached the stub  "
+                    f"{counters.get('breaker_trips', 0)} trips  {counters.get('short_circuited', 0)} short-circuited"
+                )
+                gateway.breaker.reset()
@@ -0,0 +1,111 @@
+import csv
+import io
+import os
+import time
+import tracemalloc
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from chamapro.bench import temporary_database
+from chama.models import Chama
+from payments.exports import COLUMNS, export_queryset
+from payments.models import MpesaTransaction
+from payments.views import export_transactions
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Benchmark the streaming CSV export against building the file in memory, on a seeded throwaway database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Transactions in the largest export')
+        parser.add_argument('--members', type=int, default=50)
+        parser.add_argument('--skip-in-memory', action='store_true',
+                            help='Only measure the streaming export (the in-memory one needs several GB at 1M rows)')
+
+    def handle(self, *args, **options):
+        checkpoints = sorted({max(options['rows'] // 10, 1), options['rows']})
+        with temporary_database():
+            admin, chama, members = self._seed_chama(options['members'])
+            seeded = 0
+            for target in checkpoints:
+                t0 = time.perf_counter()
+                self._seed_transactions(chama, members, seeded, target)
+                self.stdout.write(f"seeded {target - seeded:,} rows in {time.perf_counter() - t0:.1f}s")
+                seeded = target
+
+                streamed = self._measure(lambda: self._stream(admin, chama))
+                self._report(target, 'streaming', streamed)
+                if not options['skip_in_memory']:
+                    self._report(target, 'in memory', self._measure(lambda: self._in_memory(chama)))
+
+    def _seed_chama(self, count):
+        password = make_password(None)
+        admin = User.objects.create(username='treasurer', email='treasurer@example.com', password=password)
+        members = User.objects.bulk_create(
+            [User(username=f'member{i}', email=f'member{i}@example.com', password=password) for i in range(count)]
+        )
+        chama = Chama.objects.create(
+            name='Export Bench', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=admin,
+        )
+        chama.members.add(admin, *members)
+        return admin, chama, members
+
+    def _seed_transactions(self, chama, members, start, stop, batch=10_000):
+        statuses = ['SUCCESS'] * 8 + ['FAILED', 'PENDING']
+        for offset in range(start, stop, batch):
+            MpesaTransaction.objects.bulk_create([
+                MpesaTransaction(
+                    user=members[i % len(members)],
+                    chama=chama,
+                    merchant_request_id=f'mr_{i}',
+                    checkout_request_id=f'ws_CO_{i:010d}',
+                    amount=100 + i % 900,
+                    phone_number='254700000000',
+                    status=statuses[i % len(statuses)],
+                    receipt_number=f'R{i:09d}' if i % 10 < 8 else None,
+                    description='Monthly contribution',
+                )
+                for i in range(offset, min(offset + batch, stop))
+            ])
+
+    def _stream(self, admin, chama):
+        """Drain the real endpoint's StreamingHttpResponse into /dev/null"""
+        request = RequestFactory().get('/')
+        request.user = admin
+        response = export_transactions(request, chama_id=chama.id)
+        size = 0
+        with open(os.devnull, 'w') as devnull:
+            for chunk in response.streaming_content:
+                devnull.write(chunk.decode())
+                size += len(chunk)
+        return size
+
+    def _in_memory(self, chama):
+        """The naive approach: load every row, build the whole file, then send it"""
+        rows = list(export_queryset(chama=chama))
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([header for header, _ in COLUMNS])
+        writer.writerows(rows)
+        return len(buffer.getvalue().encode())
+
+    def _measure(self, export):
+        # Timed and memory-traced in separate runs; tracemalloc slows Python down a lot
+        t0 = time.perf_counter()
+        size = export()
+        elapsed = time.perf_counter() - t0
+        tracemalloc.start()
+        export()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {'elapsed': elapsed, 'size': size, 'peak': peak}
+
+    def _report(self, rows, label, r):
+        self.stdout.write(
+            f"{rows:>10,} rows  {label:<10} {r['elapsed']:6.2f}s  {rows / r['elapsed']:>9,.0f} rows/s  "
+            f"{r['size'] / 1e6:7.1f} MB csv  peak python memory {r['peak'] / 1e6:7.1f} MB"
+        )
@@ -0,0 +1,70 @@
+import time
+import requests
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from chamapro.bench import percentile
+from payments.daraja_stub import DarajaStub
+from payments.utils import MpesaGateWay
+
+
+class Command(BaseCommand):
+    help = "Benchmark STK pushes against a local Daraja stub: per-call token + new connection vs cached token + pooled session"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='STK pushes per mode')
+        parser.add_argument('--connect-latency', type=float, default=30.0,
+                            help='Milliseconds the stub spends on each new connection (stands in for TLS)')
+        parser.add_argument('--latency', type=float, default=5.0, help='Milliseconds per API call')
+
+    def handle(self, *args, **options):
+        count = options['requests']
+        with DarajaStub(connect_latency=options['connect_latency'] / 1000,
+                        latency=options['latency'] / 1000) as stub:
+            with override_settings(MPESA_BASE_URL=stub.url):
+                results = [
+                    ('unpooled, token per call', self._run(stub, count, self._legacy_push)),
+                    ('pooled, cached token', self._run(stub, count, self._pooled_push())),
+                ]
+
+        baseline = results[0][1]['total']
+        for label, r in results:
+            self.stdout.write(
+                f"{label:<26} total {r['total']:.2f}s  p50 {r['p50']:.1f}ms  p95 {r['p95']:.1f}ms  "
+                f"connections {r['counters'].get('connections', 0)}  token requests {r['counters'].get('tokens', 0)}  "
+                f"speedup x{baseline / r['total']:.1f}"
+            )
+
+    def _run(self, stub, count, push):
+        stub.reset()
+        timings = []
+        start = time.perf_counter()
+        for i in range(count):
+            t0 = time.perf_counter()
+            response = push()
+            timings.append((time.perf_counter() - t0) * 1000)
+            if response.get('ResponseCode') != '0':
+                self.stderr.write(f"push {i} failed: {response}")
+        total = time.perf_counter() - start
+        return {
+            'total': total,
+            'p50': percentile(timings, 50),
+            'p95': percentile(timings, 95),
+            'counters': dict(stub.counters),
+        }
+
+    def _legacy_push(self):
+        """The pre-pooling behaviour: a fresh token and a fresh connection for every call"""
+        gateway = MpesaGateWay()
+        token = requests.get(f"{gateway.base_url}/oauth/v1/generate?grant_type=client_credentials",
+                             auth=(gateway.consumer_key, gateway.consumer_secret)).json()['access_token']
+        response = requests.post(f"{gateway.base_url}/mpesa/stkpush/v1/processrequest",
+                                 headers={"Authorization": f"Bearer {token}"},
+                                 json={"Amount": 100, "PhoneNumber": "254700000000"})
+        return response.json()
+
+    def _pooled_push(self):
+        MpesaGateWay().token_store.invalidate()
+
+        def push():
+            return MpesaGateWay().stk_push("254700000000", 100)
+        return push
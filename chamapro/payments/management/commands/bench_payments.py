@@ -0,0 +1,166 @@
+import os
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.db.models import Count, Sum
+from django.test.utils import override_settings
+from django.utils import timezone
+from chamapro.bench import percentile, temporary_database
+from chama import ledger
+from chama.models import Chama
+from payments.callbacks import drain_inbox
+from payments.campaigns import run_campaign
+from payments.daraja_stub import add_simulator_arguments, simulator_from_options
+from payments.models import CallbackInbox, ContributionCampaign, MpesaTransaction
+from payments.resilience import metrics
+from payments.utils import MpesaGateWay
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive contribution payments end to end against the Daraja simulator: STK pushes from a campaign, "
+        "stkCallbacks over HTTP to /payments/callback/, the inbox worker. Reports throughput and callback p99"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=1000, help='Members asked to pay, one push each')
+        parser.add_argument('--concurrency', type=int, default=16, help='STK pushes in flight at once')
+        parser.add_argument('--push-rate', type=float, default=0, help='STK pushes per second (0: no limit)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Inbox worker batch size')
+        parser.add_argument('--timeout', type=float, default=300, help='Seconds to wait for callbacks to settle')
+        add_simulator_arguments(parser)
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as tmp, \
+                temporary_database(sqlite_file=os.path.join(tmp, 'bench_payments.sqlite3')):
+            if connection.vendor == 'sqlite':
+                # The app server, the campaign and the inbox worker all write at once: take the
+                # write lock when a transaction starts, instead of failing to upgrade a read one
+                connection.settings_dict['OPTIONS'] = {
+                    **connection.settings_dict.get('OPTIONS', {}), 'transaction_mode': 'IMMEDIATE', 'timeout': 60,
+                }
+                connection.close()
+                with connection.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode=WAL')
+            admin, chama = self._seed(options['payments'])
+
+            app = ThreadedWSGIServer(('127.0.0.1', 0), _QuietHandler, allow_reuse_address=False)
+            app.set_app(get_wsgi_application())
+            app_url = 'http://%s:%s' % app.server_address[:2]
+            threading.Thread(target=app.serve_forever, daemon=True).start()
+
+            stub = simulator_from_options(options)
+            overrides = override_settings(
+                MPESA_BASE_URL=stub.url, MPESA_CALLBACK_URL=app_url, MPESA_TOKEN_CACHE='mpesa',
+                MPESA_CONSUMER_KEY='bench', MPESA_CONSUMER_SECRET='bench', MPESA_SHORTCODE='174379',
+                MPESA_PASSKEY='bench', ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, '127.0.0.1'],
+            )
+            with stub, overrides:
+                gateway = MpesaGateWay()
+                gateway.breaker.reset()
+                metrics.reset()
+                stop = threading.Event()
+                worker = threading.Thread(target=self._work, args=(stop, options['batch_size']), daemon=True)
+                worker.start()
+
+                start = time.perf_counter()
+                campaign = ContributionCampaign.objects.create(
+                    chama=chama, created_by=admin, status='RUNNING', started_at=timezone.now()
+                )
+                run_campaign(campaign, workers=options['concurrency'], rate=options['push_rate'], gateway=gateway)
+                pushed = time.perf_counter() - start
+                delivered = stub.callbacks.wait(options['timeout'])
+                while CallbackInbox.objects.filter(processed_at__isnull=True).exists():
+                    time.sleep(0.05)
+                elapsed = time.perf_counter() - start
+                stop.set()
+                worker.join()
+                gateway.breaker.reset()
+            app.shutdown()
+            app.server_close()
+
+            self._report(options, campaign, stub, pushed, elapsed, delivered, chama)
+
+    def _seed(self, count):
+        User = get_user_model()
+        users = User.objects.bulk_create([
+            User(username=f"payer{i}", email=f"payer{i}@example.com", phone_number=f"2547{i:08d}")
+            for i in range(count)
+        ], batch_size=1000)
+        chama = Chama.objects.create(
+            name="Load Chama", county="Nairobi", phone="254700000000", monthly_contribution=500,
+            created_by=users[0],
+        )
+        chama.members.add(*users)
+        return users[0], chama
+
+    def _work(self, stop, batch_size):
+        """The process_callbacks worker, in a thread"""
+        try:
+            while not stop.is_set():
+                if not drain_inbox(batch_size)[0]:
+                    time.sleep(0.05)
+        finally:
+            connection.close()
+
+    def _report(self, options, campaign, stub, pushed, elapsed, delivered, chama):
+        campaign.refresh_from_db()
+        snapshot = metrics.snapshot()
+        stk, counters = snapshot['endpoints'].get('stk_push', {}), snapshot['counters']
+        self.stdout.write(
+            f"pushes     {campaign.sent}/{campaign.total} accepted, {campaign.failed} failed in {pushed:.1f}s "
+            f"({campaign.total / max(pushed, 1e-9):,.1f}/s)  p50 {stk.get('p50', 0) * 1000:.1f}ms  "
+            f"p99 {stk.get('p99', 0) * 1000:.1f}ms"
+        )
+        self.stdout.write(
+            f"daraja     {stub.counters.get('stk_push.failed', 0)} simulated 503s, {counters.get('breaker_trips', 0)} "
+            f"breaker trips, {counters.get('short_circuited', 0)} pushes short-circuited"
+        )
+
+        sender = stub.callbacks
+        latencies = [seconds * 1000 for seconds in sender.latencies]
+        statuses = ', '.join(f"{count} {status}" for status, count in sorted(sender.statuses.items(), key=str))
+        self.stdout.write(
+            f"callbacks  {len(latencies)} posted ({statuses or 'none'})  p50 {percentile(latencies, 50):.1f}ms  "
+            f"p95 {percentile(latencies, 95):.1f}ms  p99 {percentile(latencies, 99):.1f}ms"
+            + ('' if delivered else f"  {sender.pending()} still queued after --timeout")
+        )
+
+        lags = [
+            (processed - received).total_seconds() * 1000
+            for received, processed in CallbackInbox.objects.values_list('received_at', 'processed_at')
+        ]
+        self.stdout.write(f"inbox      lag p50 {percentile(lags, 50):.1f}ms  p99 {percentile(lags, 99):.1f}ms")
+
+        outcomes = {
+            row['status']: row['n']
+            for row in MpesaTransaction.objects.filter(chama=chama).values('status').annotate(n=Count('id'))
+        }
+        settled = outcomes.get('SUCCESS', 0) + outcomes.get('FAILED', 0)
+        self.stdout.write(
+            f"settled    {settled} payments ({outcomes.get('SUCCESS', 0)} SUCCESS, {outcomes.get('FAILED', 0)} FAILED) "
+            f"in {elapsed:.1f}s -> {settled / max(elapsed, 1e-9):,.1f} payments/s end to end, "
+            f"{options['callback_delay']:.1f}s callback delay included"
+        )
+        if outcomes.get('PENDING'):
+            self.stdout.write(self.style.WARNING(
+                f"{outcomes['PENDING']} still PENDING: their callback failed or beat the row; reconcile_pending settles them"
+            ))
+
+        expected = MpesaTransaction.objects.filter(chama=chama, status='SUCCESS').aggregate(
+            total=Sum('amount'))['total'] or Decimal('0')
+        balance = ledger.balance(chama.id)
+        status = self.style.SUCCESS('OK') if balance == expected else self.style.ERROR('DRIFT')
+        self.stdout.write(f"balance    {balance} vs successful contributions {expected}: {status}")
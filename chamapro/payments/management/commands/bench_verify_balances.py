@@ -0,0 +1,71 @@
+import random
+import time
+import tracemalloc
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+from chamapro.bench import temporary_database
+from chama.models import Chama, LedgerEntry
+from payments.drift import verify_balances
+from payments.models import MpesaTransaction
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Benchmark verify_balances over many transactions: time, queries and Python memory per chunk size"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chamas', type=int, default=500)
+        parser.add_argument('--transactions', type=int, default=200_000)
+        parser.add_argument('--drifting', type=int, default=25, help='Chamas given a ledger that disagrees')
+        parser.add_argument('--chunk-sizes', default='100,500')
+        parser.add_argument('--seed', type=int, default=7)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with temporary_database():
+            chama_ids = self._seed(options['chamas'], options['transactions'], options['drifting'], rng)
+            self.stdout.write(f"{len(chama_ids)} chamas, {options['transactions']:,} transactions")
+            for chunk_size in [int(size) for size in options['chunk_sizes'].split(',')]:
+                reset_queries()
+                tracemalloc.start()
+                start = time.perf_counter()
+                with CaptureQueriesContext(connection) as ctx:
+                    totals = verify_balances(chunk_size=chunk_size)
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self.stdout.write(
+                    f"chunk {chunk_size:>5}: {elapsed:6.2f}s  {len(ctx.captured_queries):>4} queries  "
+                    f"peak Python memory {peak / 1024 / 1024:6.1f} MB  {totals['drifting']} drifting found"
+                )
+
+    def _seed(self, chamas, transactions, drifting, rng):
+        owner = User.objects.create(username='owner', email='owner@example.com', password=make_password(None))
+        created = Chama.objects.bulk_create([
+            Chama(name=f'Drift {i}', slug=f'drift-{i}', county='Nairobi', phone='254700000000',
+                  monthly_contribution=500, created_by=owner)
+            for i in range(chamas)
+        ])
+        chama_ids = [c.id for c in created]
+        for start in range(0, transactions, 10_000):
+            rows, entries = [], []
+            for i in range(start, min(start + 10_000, transactions)):
+                chama_id = rng.choice(chama_ids)
+                amount = Decimal(rng.randrange(100, 5000))
+                rows.append(MpesaTransaction(
+                    user=owner, chama_id=chama_id, merchant_request_id='m', checkout_request_id=f'ws_{i}',
+                    amount=amount, phone_number='254700000000', status='SUCCESS',
+                ))
+                entries.append(LedgerEntry(chama_id=chama_id, kind='CONTRIBUTION', amount=amount, reference=f'mpesa:ws_{i}'))
+            MpesaTransaction.objects.bulk_create(rows)
+            LedgerEntry.objects.bulk_create(entries)
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(chama_id=chama_id, kind='CONTRIBUTION', amount=100, reference=f'phantom:{n}')
+            for n, chama_id in enumerate(rng.sample(chama_ids, min(drifting, len(chama_ids))))
+        ])
+        return chama_ids
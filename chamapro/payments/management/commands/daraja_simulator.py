@@ -0,0 +1,31 @@
+import time
+from django.core.management.base import BaseCommand
+from payments.daraja_stub import add_simulator_arguments, simulator_from_options
+
+
+class Command(BaseCommand):
+    help = "Serve a local Daraja (OAuth, STK push, STK query, B2C) that posts stkCallbacks back, for load tests"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--callback-url', help="Post callbacks here instead of the push's CallBackURL")
+        add_simulator_arguments(parser)
+
+    def handle(self, *args, **options):
+        stub = simulator_from_options(
+            options, host=options['host'], port=options['port'], callback_url=options['callback_url'],
+        )
+        stub.start()
+        self.stdout.write(self.style.SUCCESS(f"Daraja simulator on {stub.url}"))
+        self.stdout.write(f"Point the app at it with MPESA_BASE_URL={stub.url}; Ctrl-C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stub.stop()
+        sender = stub.callbacks
+        self.stdout.write(', '.join(f"{name} {count}" for name, count in sorted(stub.counters.items())) or 'No calls')
+        self.stdout.write(', '.join(f"callbacks {status}: {count}" for status, count in sender.statuses.items()))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from payments.utils import MpesaGateWay
+
+
+class Command(BaseCommand):
+    help = "Show (or reset) the Daraja circuit breaker shared by all workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Close the breaker and clear its counters')
+
+    def handle(self, *args, **options):
+        gateway = MpesaGateWay()
+        if options['reset']:
+            gateway.breaker.reset()
+        state = gateway.breaker.state()
+        self.stdout.write(
+            f"{gateway.base_url}: breaker {state['state']}, {state['failures']} recent failures, {state['trips']} trips"
+        )
@@ -0,0 +1,28 @@
+import time
+from django.core.management.base import BaseCommand
+from payments.disbursements import disburse_loans
+
+
+class Command(BaseCommand):
+    help = "Send approved loans to borrowers over M-Pesa B2C; results arrive on /payments/b2c/result/"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting when no loan is waiting')
+        parser.add_argument('--sleep', type=float, default=5.0, help='Seconds to wait between polls')
+
+    def handle(self, *args, **options):
+        while True:
+            outcomes = disburse_loans(options['batch_size'])
+            if outcomes:
+                self.stdout.write(', '.join(f"{count} {outcome.lower()}" for outcome, count in sorted(outcomes.items())))
+            if outcomes.get('UNKNOWN'):
+                self.stdout.write(self.style.WARNING(
+                    "Some B2C requests timed out after sending: check them on the M-Pesa portal before retrying"
+                ))
+            # Loans put back to APPROVED mean M-Pesa is unreachable: wait before trying again
+            if sum(outcomes.values()) - outcomes.get('APPROVED', 0):
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
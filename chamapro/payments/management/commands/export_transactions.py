@@ -0,0 +1,49 @@
+import time
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from chama.models import Chama
+from payments.exports import CHUNK_SIZE, csv_lines, export_queryset
+
+
+class Command(BaseCommand):
+    help = "Stream transactions as CSV to a file or stdout, with the same filters as the export endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chama', help='Chama id (UUID); all chamas if omitted')
+        parser.add_argument('--member', type=int, help="User id, for a single member's statement")
+        parser.add_argument('--start', type=date.fromisoformat, help='First day to include (YYYY-MM-DD)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day to include (YYYY-MM-DD)')
+        parser.add_argument('--type', help='Transaction type, e.g. CONTRIBUTION')
+        parser.add_argument('--status', choices=['SUCCESS', 'PENDING', 'FAILED'])
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Rows fetched per database round trip')
+        parser.add_argument('--output', '-o', help='File to write; stdout if omitted')
+
+    def handle(self, *args, **options):
+        chama = None
+        if options['chama']:
+            chama = Chama.objects.filter(id=options['chama']).first()
+            if chama is None:
+                raise CommandError(f"No chama with id {options['chama']}")
+
+        rows = export_queryset(
+            chama=chama,
+            user_id=options['member'],
+            start=options['start'],
+            end=options['end'],
+            transaction_type=(options['type'] or '').upper(),
+            status=options['status'],
+        )
+        if not options['output']:
+            for chunk in csv_lines(rows, chunk_size=options['chunk_size']):
+                self.stdout.write(chunk, ending='')
+            return
+
+        start = time.perf_counter()
+        written = 0
+        with open(options['output'], 'w', newline='', encoding='utf-8') as out:
+            for chunk in csv_lines(rows, chunk_size=options['chunk_size']):
+                out.write(chunk)
+                written += len(chunk)
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {written / 1e6:.1f} MB to {options['output']} in {time.perf_counter() - start:.2f}s"
+        ))
@@ -0,0 +1,46 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from payments.callbacks import drain_inbox, inbox_stats
+from payments.models import CallbackInbox
+
+
+class Command(BaseCommand):
+    help = "Drain the M-Pesa callback inbox in batches and apply the results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting when the inbox is empty')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Seconds to wait between polls of an empty inbox')
+        parser.add_argument('--stats', action='store_true', help='Print inbox depth and lag, then exit')
+        parser.add_argument('--purge-after', type=int, default=0,
+                            help='Delete processed callbacks older than this many days (0 keeps them)')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            stats = inbox_stats()
+            self.stdout.write(f"depth {stats['depth']}  lag {stats['lag_seconds']:.1f}s")
+            return
+
+        if options['purge_after']:
+            cutoff = timezone.now() - timedelta(days=options['purge_after'])
+            deleted, _ = CallbackInbox.objects.filter(processed_at__lt=cutoff).delete()
+            self.stdout.write(f"Purged {deleted} processed callbacks")
+
+        total = settled = 0
+        start = time.perf_counter()
+        while True:
+            processed, batch_settled = drain_inbox(options['batch_size'])
+            total += processed
+            settled += batch_settled
+            if processed:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {total} callbacks, settled {settled} transactions in {elapsed:.2f}s"
+        ))
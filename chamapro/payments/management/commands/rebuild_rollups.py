@@ -0,0 +1,14 @@
+import time
+from django.core.management.base import BaseCommand
+from payments.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Recompute the monthly TransactionRollup table from MpesaTransaction history"
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        written = rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {written} rollup rows in {time.perf_counter() - start:.2f}s"
+        ))
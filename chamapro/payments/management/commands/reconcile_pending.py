@@ -0,0 +1,35 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from payments.reconcile import reconcile_pending
+
+
+class Command(BaseCommand):
+    help = "Ask M-Pesa (STK Query) for the outcome of PENDING transactions whose callback never arrived"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=5, help='Only check transactions pending for this many minutes')
+        parser.add_argument('--chunk-size', type=int, default=200)
+        parser.add_argument('--workers', type=int, default=None, help='Concurrent queries (default MPESA_CAMPAIGN_WORKERS)')
+        parser.add_argument('--rate', type=float, default=None, help='Queries per second (default MPESA_STK_QUERY_RATE_LIMIT)')
+        parser.add_argument('--loop', action='store_true', help='Keep reconciling instead of exiting after one pass')
+        parser.add_argument('--sleep', type=float, default=60.0, help='Seconds to wait between passes')
+
+    def handle(self, *args, **options):
+        while True:
+            start = time.perf_counter()
+            stats = reconcile_pending(
+                older_than=timedelta(minutes=options['older_than']),
+                chunk_size=options['chunk_size'],
+                workers=options['workers'],
+                rate=options['rate'],
+            )
+            elapsed = time.perf_counter() - start
+            self.stdout.write(self.style.SUCCESS(
+                f"Checked {stats['checked']} pending transactions in {elapsed:.2f}s: "
+                f"{stats['success']} succeeded, {stats['failed']} failed, {stats['expired']} expired, "
+                f"{stats['unresolved']} still pending"
+            ))
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand
+from payments.campaigns import claim_next_campaign, run_campaign
+
+
+class Command(BaseCommand):
+    help = "Send queued \"request contributions\" campaigns as rate-limited, concurrent STK pushes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting when the queue is empty')
+        parser.add_argument('--sleep', type=float, default=2.0, help='Seconds to wait between polls of an empty queue')
+        parser.add_argument('--workers', type=int, help='Concurrent pushes (default: MPESA_CAMPAIGN_WORKERS)')
+        parser.add_argument('--rate', type=float, help='Pushes per second (default: MPESA_STK_RATE_LIMIT; 0 = unlimited)')
+
+    def handle(self, *args, **options):
+        while True:
+            campaign = claim_next_campaign()
+            if campaign is None:
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            start = time.perf_counter()
+            run_campaign(campaign, workers=options['workers'], rate=options['rate'], progress=self._progress)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(self.style.SUCCESS(
+                f"{campaign.chama}: {campaign.sent} sent, {campaign.failed} failed, {campaign.skipped} skipped "
+                f"in {elapsed:.1f}s ({campaign.total / elapsed if elapsed else 0:.1f} pushes/s)"
+            ))
+
+    def _progress(self, campaign):
+        self.stdout.write(f"  {campaign.chama}: {campaign.sent + campaign.failed}/{campaign.total}")
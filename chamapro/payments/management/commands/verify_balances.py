@@ -0,0 +1,52 @@
+import time
+from django.core.management.base import BaseCommand
+from payments.drift import verify_balances
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class Command(BaseCommand):
+    help = "Recompute every chama's balance from contributions and loans and report (or fix) ledger drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Chamas checked per round of grouped queries')
+        parser.add_argument('--fix', action='store_true',
+                            help='Append an ADJUSTMENT entry to each drifting ledger and reset Chama.total_balance')
+        parser.add_argument('--show', type=int, default=50, help='Print at most this many drifting chamas')
+
+    def handle(self, *args, **options):
+        shown = 0
+
+        def report(row):
+            nonlocal shown
+            if shown >= options['show']:
+                return
+            shown += 1
+            self.stdout.write(self.style.WARNING(
+                f"{row['name']} ({row['chama_id']}): ledger {row['ledger']} expected {row['expected']} drift {row['drift']:+} "
+                f"[contributions {row['contribution_drift']:+}, loans {row['loan_drift']:+}, "
+                f"investments {row['investment_drift']:+}, "
+                f"opening/adjustments {row['unexplained']:+}]"
+            ))
+
+        start = time.perf_counter()
+        totals = verify_balances(chunk_size=options['chunk_size'], fix=options['fix'], report=report)
+        elapsed = time.perf_counter() - start
+
+        summary = (
+            f"Checked {totals['checked']} chamas in {elapsed:.2f}s: {totals['drifting']} drifting "
+            f"(KES {totals['absolute_drift']} in total)"
+        )
+        if options['fix']:
+            summary += f", {totals['fixed']} fixed"
+        if resource:
+            summary += f"; peak memory {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB"
+        self.stdout.write(self.style.ERROR(summary) if totals['drifting'] and not options['fix'] else self.style.SUCCESS(summary))
+        if totals['unverified_disbursements']:
+            self.stdout.write(self.style.WARNING(
+                f"{totals['unverified_disbursements']} loans are DISBURSED without an M-Pesa B2C conversation "
+                "(approved before asynchronous disbursement): confirm they were really paid out"
+            ))
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:07
+
+import logging
+from django.db import migrations, models
+from django.db.models import Count
+
+logger = logging.getLogger(__name__)
+
+
+def deduplicate(apps, schema_editor):
+    """
+    Make room for the unique constraints. Empty receipts become NULL. Of
+    the rows sharing a receipt, the first keeps it and the rest lose it.
+    Of the rows sharing a checkout id, a settled one (else the first) keeps
+    it and the rest are renamed "<id>-dup<pk>". No row is deleted, and
+    every change is logged.
+    """
+    MpesaTransaction = apps.get_model('payments', 'MpesaTransaction')
+    blank = MpesaTransaction.objects.filter(receipt_number='').update(receipt_number=None)
+    if blank:
+        logger.warning("0003: set %d empty receipt numbers to NULL", blank)
+
+    receipts = (
+        MpesaTransaction.objects.filter(receipt_number__isnull=False)
+        .values('receipt_number').annotate(n=Count('id')).filter(n__gt=1).values_list('receipt_number', flat=True)
+    )
+    for receipt in list(receipts):
+        keep, *rest = MpesaTransaction.objects.filter(receipt_number=receipt).order_by('id').values_list('id', flat=True)
+        MpesaTransaction.objects.filter(id__in=rest).update(receipt_number=None)
+        logger.warning("0003: receipt %s kept by transaction %d, removed from %s", receipt, keep, rest)
+
+    checkouts = (
+        MpesaTransaction.objects.values('checkout_request_id').annotate(n=Count('id')).filter(n__gt=1)
+        .values_list('checkout_request_id', flat=True)
+    )
+    for checkout_request_id in list(checkouts):
+        rows = MpesaTransaction.objects.filter(checkout_request_id=checkout_request_id)
+        keep = (rows.exclude(status='PENDING').order_by('id').first() or rows.order_by('id').first()).id
+        for pk in list(rows.exclude(id=keep).values_list('id', flat=True)):
+            renamed = f"{checkout_request_id[:100 - len(f'-dup{pk}')]}-dup{pk}"
+            MpesaTransaction.objects.filter(id=pk).update(checkout_request_id=renamed)
+            logger.warning(
+                "0003: checkout id %s kept by transaction %d, transaction %d renamed to %s",
+                checkout_request_id, keep, pk, renamed,
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0002_mpesatransaction_transaction_fee'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='mpesatransaction',
+            name='checkout_request_id',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='mpesatransaction',
+            name='receipt_number',
+            field=models.CharField(blank=True, max_length=50, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0005_penalty_period'),
+        ('payments', '0004_callbackinbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['chama', 'transaction_type', 'status', 'transaction_date'], name='payments_mp_chama_i_695421_idx'),
+        ),
+    ]
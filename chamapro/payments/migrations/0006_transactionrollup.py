@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0006_contributionobligation'),
+        ('payments', '0005_transaction_period_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('contribution_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('contribution_count', models.IntegerField(default=0)),
+                ('success_count', models.IntegerField(default=0)),
+                ('failed_count', models.IntegerField(default=0)),
+                ('pending_count', models.IntegerField(default=0)),
+                ('chama', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='chama.chama')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transaction_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'month'], name='payments_tr_user_id_047b9d_idx')],
+                'constraints': [models.UniqueConstraint(fields=('chama', 'user', 'month'), name='unique_rollup_per_month'), models.UniqueConstraint(condition=models.Q(('chama__isnull', True)), fields=('user', 'month'), name='unique_chamaless_rollup_per_month')],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:20
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0006_contributionobligation'),
+        ('payments', '0006_transactionrollup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='mpesatransaction',
+            name='payments_mp_chama_i_695421_idx',
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['chama', 'transaction_type', 'status', 'transaction_date', 'id'], name='payments_mp_chama_i_0ccce4_idx'),
+        ),
+    ]
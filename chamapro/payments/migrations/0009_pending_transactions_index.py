@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chama', '0006_contributionobligation'),
+        ('payments', '0008_contributioncampaign'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(condition=models.Q(('status', 'PENDING')), fields=['id'], name='mpesa_pending_idx'),
+        ),
+    ]
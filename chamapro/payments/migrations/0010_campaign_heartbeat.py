@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:11
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_heartbeats(apps, schema_editor):
+    """Campaigns already running count from when they started"""
+    ContributionCampaign = apps.get_model('payments', 'ContributionCampaign')
+    ContributionCampaign.objects.filter(status='RUNNING').update(heartbeat_at=F('started_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0009_pending_transactions_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contributioncampaign',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_heartbeats, migrations.RunPython.noop),
+    ]
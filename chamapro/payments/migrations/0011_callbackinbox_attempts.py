@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0010_campaign_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callbackinbox',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0011_callbackinbox_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callbackinbox',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Q
 from django.conf import settings
 
 class MpesaTransaction(models.Model):
@@ -6,14 +7,102 @@ class MpesaTransaction(models.Model):
     chama = models.ForeignKey('chama.Chama', on_delete=models.SET_NULL, null=True, blank=True, related_name='transactions')
     transaction_type = models.CharField(max_length=50, default='CONTRIBUTION')
     merchant_request_id = models.CharField(max_length=100)
-    checkout_request_id = models.CharField(max_length=100)
+    checkout_request_id = models.CharField(max_length=100, unique=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     phone_number = models.CharField(max_length=15)
     status = models.CharField(max_length=20, default='PENDING')
     transaction_fee = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
-    receipt_number = models.CharField(max_length=50, null=True, blank=True)
+    receipt_number = models.CharField(max_length=50, null=True, blank=True, unique=True)
     transaction_date = models.DateTimeField(auto_now_add=True)
     description = models.TextField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # "Who paid this chama in this period" lookups (penalties, dues, reports),
+            # and keyset pages of contribution history ordered by (transaction_date, id)
+            models.Index(fields=['chama', 'transaction_type', 'status', 'transaction_date', 'id']),
+            # Reconciliation walks the (few) PENDING rows by id; partial, so settled history costs nothing
+            models.Index(fields=['id'], condition=Q(status='PENDING'), name='mpesa_pending_idx'),
+        ]
+
     def __str__(self):
         return f"{self.phone_number} - {self.amount} - {self.status}"
+
+
+class CallbackInbox(models.Model):
+    """Raw M-Pesa callbacks, appended by the endpoint and drained by `process_callbacks`"""
+    checkout_request_id = models.CharField(max_length=100, blank=True, db_index=True)
+    payload = models.TextField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    error = models.CharField(max_length=200, blank=True)
+    attempts = models.IntegerField(default=0)  # failed settlements; set aside after callbacks.MAX_ATTEMPTS
+    next_attempt_at = models.DateTimeField(null=True, blank=True)  # after a failed settlement, not retried before
+
+    class Meta:
+        verbose_name_plural = 'callback inbox'
+        indexes = [
+            models.Index(fields=['processed_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.checkout_request_id} ({'processed' if self.processed_at else 'pending'})"
+
+
+class TransactionRollup(models.Model):
+    """
+    Monthly per-member transaction totals, kept current by the callback worker.
+    Reports and charts read this instead of aggregating MpesaTransaction.
+    """
+    chama = models.ForeignKey('chama.Chama', on_delete=models.CASCADE, null=True, blank=True, related_name='rollups')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='transaction_rollups')
+    month = models.DateField()  # first day of the month, local time
+    contribution_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    contribution_count = models.IntegerField(default=0)
+    success_count = models.IntegerField(default=0)
+    failed_count = models.IntegerField(default=0)
+    pending_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chama', 'user', 'month'], name='unique_rollup_per_month'),
+            models.UniqueConstraint(fields=['user', 'month'], condition=Q(chama__isnull=True),
+                                    name='unique_chamaless_rollup_per_month'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'month']),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.chama} {self.month:%b %Y}"
+
+
+class ContributionCampaign(models.Model):
+    """An admin's "request contributions from all members" run, sent by `run_campaigns`"""
+    STATUS_CHOICES = [
+        ('QUEUED', 'Queued'),
+        ('RUNNING', 'Running'),
+        ('COMPLETED', 'Completed'),
+    ]
+    chama = models.ForeignKey('chama.Chama', on_delete=models.CASCADE, related_name='campaigns')
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='QUEUED')
+    # Progress, updated by the runner as pushes complete
+    total = models.IntegerField(default=0)
+    sent = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    skipped = models.IntegerField(default=0)  # no phone number, or already paid for the period
+    last_error = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Moved by the runner with every progress update; a RUNNING campaign whose runner died stops moving it
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.chama} campaign {self.created_at:%d %b %Y %H:%M} ({self.status})"
@@ -0,0 +1,91 @@
+"""Settle PENDING transactions whose callback never arrived, via STK Query"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.utils import timezone
+from .callbacks import settle_transactions
+from .models import MpesaTransaction
+from .utils import MpesaGateWay, RateLimiter
+
+STILL_PROCESSING = '500.001.1001'
+EXPIRED = {'status': 'FAILED', 'description': "Expired: M-Pesa had no result for the payment"}
+
+
+def parse_stk_query(response):
+    """
+    Field updates for a settled STK Query answer, in the same shape as
+    parse_stk_callback(); None while M-Pesa has no final result (or the
+    query itself failed), so the row is tried again on a later pass.
+    """
+    result_code = response.get('ResultCode')
+    if result_code is None or response.get('errorCode') == STILL_PROCESSING:
+        return None
+    if str(result_code) == '0':
+        # STK Query does not return the receipt number; the statement has it
+        return {'status': 'SUCCESS', 'description': "Payment Successful (reconciled)"}
+    return {'status': 'FAILED', 'description': response.get('ResultDesc')}
+
+
+def stale_pending(older_than, after_id=0, limit=200):
+    """(id, checkout_request_id, transaction_date) of PENDING rows older than `older_than`, by id after `after_id`"""
+    cutoff = timezone.now() - older_than
+    return list(
+        MpesaTransaction.objects.filter(status='PENDING', id__gt=after_id, transaction_date__lt=cutoff)
+        .order_by('id')
+        .values_list('id', 'checkout_request_id', 'transaction_date')[:limit]
+    )
+
+
+def reconcile_pending(older_than=timedelta(minutes=5), chunk_size=200, workers=None, rate=None, gateway=None,
+                      expire_after=None):
+    """
+    Walk stale PENDING transactions a chunk at a time. Each chunk is queried
+    concurrently (`workers` threads sharing the pooled gateway, paced at `rate`
+    queries per second), then every final answer in it is applied with one
+    settle_transactions() call, the same path callbacks take.
+
+    A transaction pushed more than `expire_after` ago (default
+    MPESA_PENDING_EXPIRE_AFTER seconds) that M-Pesa answers for without a
+    result is settled as FAILED, so it is not queried forever. One whose
+    query never got an answer is left PENDING.
+
+    Returns counts: checked, settled, success, failed, expired, unresolved.
+    """
+    workers = workers or getattr(settings, 'MPESA_CAMPAIGN_WORKERS', 8)
+    rate = getattr(settings, 'MPESA_STK_QUERY_RATE_LIMIT', 10) if rate is None else rate
+    if expire_after is None:
+        expire_after = timedelta(seconds=getattr(settings, 'MPESA_PENDING_EXPIRE_AFTER', 24 * 60 * 60))
+    gateway = gateway or MpesaGateWay()
+    limiter = RateLimiter(rate)
+    stats = {'checked': 0, 'settled': 0, 'success': 0, 'failed': 0, 'expired': 0, 'unresolved': 0}
+
+    def query(checkout_request_id):
+        limiter.acquire()
+        response = gateway.stk_query(checkout_request_id)
+        return parse_stk_query(response), bool(response.get('Answered'))
+
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            rows = stale_pending(older_than, last_id, chunk_size)
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            expires = timezone.now() - expire_after
+            results = {}
+            for (_, checkout_id, pushed_at), (updates, answered) in zip(rows, pool.map(query, [r[1] for r in rows])):
+                if updates is None and answered and pushed_at < expires:
+                    updates = EXPIRED
+                if updates is not None:
+                    results[checkout_id] = updates
+            with db_transaction.atomic():
+                settled = settle_transactions(results)
+
+            stats['checked'] += len(rows)
+            stats['settled'] += len(settled)
+            stats['success'] += sum(1 for t in settled if t.status == 'SUCCESS')
+            stats['failed'] += sum(1 for t in settled if t.status == 'FAILED' and t.description != EXPIRED['description'])
+            stats['expired'] += sum(1 for t in settled if t.description == EXPIRED['description'])
+            stats['unresolved'] += len(rows) - len(results)
+    return stats
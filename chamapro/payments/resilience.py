@@ -0,0 +1,150 @@
+"""Circuit breaker and latency metrics for calls to the Daraja API"""
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from django.conf import settings
+from django.core.cache import caches
+from chamapro.bench import percentile
+
+# cache.add() is not atomic on the file backend; keep this worker's threads from tripping twice
+_trip_lock = threading.Lock()
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Daraja timed out, refused the connection, answered 502/503/504, or the
+    breaker is open. `sent` is True when the request may have reached Daraja
+    (read timeout, dropped connection, 504), so a payment could still happen.
+    """
+
+    def __init__(self, message, sent=False):
+        super().__init__(message)
+        self.sent = sent
+
+
+class CircuitBreaker:
+    """
+    Breaker shared by every worker through the MPESA_TOKEN_CACHE cache.
+
+    `threshold` failures within `window` seconds open it; for the next
+    `cooldown` seconds callers fail fast without touching the network. After
+    that one caller is let through as a probe (half-open): its success closes
+    the breaker, its failure opens it for another cooldown.
+
+    Successful calls while closed cost one cache read and no writes.
+    """
+
+    def __init__(self, name, threshold=None, window=None, cooldown=None):
+        self.cache = caches[getattr(settings, 'MPESA_TOKEN_CACHE', 'default')]
+        self.threshold = threshold or getattr(settings, 'MPESA_BREAKER_THRESHOLD', 5)
+        self.window = window or getattr(settings, 'MPESA_BREAKER_WINDOW', 30)
+        self.cooldown = cooldown or getattr(settings, 'MPESA_BREAKER_COOLDOWN', 30)
+        self.key = f"mpesa:breaker:{name}"
+
+    def before_call(self):
+        """
+        Return True if the caller is the half-open probe, False for an
+        ordinary call; raise UpstreamUnavailable while the breaker is open.
+        """
+        open_until = self.cache.get(f"{self.key}:open")
+        if open_until is None:
+            return False
+        if time.time() >= open_until and self.cache.add(f"{self.key}:probe", os.getpid(), timeout=self.cooldown):
+            return True
+        metrics.incr('short_circuited')
+        raise UpstreamUnavailable("M-Pesa is temporarily unavailable, please try again shortly")
+
+    def record_success(self, probe):
+        if probe:
+            self.cache.delete_many([f"{self.key}:open", f"{self.key}:probe", f"{self.key}:failures"])
+
+    def record_failure(self, probe):
+        if probe:
+            self._open()
+            self.cache.delete(f"{self.key}:probe")
+            return
+        with _trip_lock:
+            if self.cache.get(f"{self.key}:open") is not None:
+                return  # a call that was in flight when the breaker tripped
+            failures_key = f"{self.key}:failures"
+            self.cache.add(failures_key, 0, timeout=self.window)
+            try:
+                failures = self.cache.incr(failures_key)
+            except ValueError:  # expired between add() and incr()
+                failures = 1
+                self.cache.set(failures_key, failures, timeout=self.window)
+            if failures >= self.threshold and self.cache.add(f"{self.key}:open", time.time() + self.cooldown, timeout=None):
+                self.cache.delete(failures_key)
+                self.cache.add(f"{self.key}:trips", 0, timeout=None)
+                self.cache.incr(f"{self.key}:trips")
+                metrics.incr('breaker_trips')
+
+    def _open(self):
+        self.cache.set(f"{self.key}:open", time.time() + self.cooldown, timeout=None)
+
+    def state(self):
+        """'closed', 'open' or 'half-open', the failures in the current window and all-time trips"""
+        values = self.cache.get_many([f"{self.key}:{part}" for part in ('open', 'failures', 'trips')])
+        open_until = values.get(f"{self.key}:open")
+        if open_until is None:
+            state = 'closed'
+        else:
+            state = 'open' if time.time() < open_until else 'half-open'
+        return {
+            'state': state,
+            'failures': values.get(f"{self.key}:failures", 0),
+            'trips': values.get(f"{self.key}:trips", 0),
+        }
+
+    def reset(self):
+        self.cache.delete_many([f"{self.key}:{part}" for part in ('open', 'probe', 'failures', 'trips')])
+
+
+class UpstreamMetrics:
+    """
+    This process's recent Daraja latencies per endpoint (a bounded sample)
+    and outcome counters: calls, errors, timeouts, retries, short_circuited,
+    breaker_trips.
+    """
+
+    SAMPLE_SIZE = 2048
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latencies = defaultdict(lambda: deque(maxlen=self.SAMPLE_SIZE))
+            self.counters = defaultdict(int)
+
+    def observe(self, endpoint, seconds):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.counters[f'{endpoint}.calls'] += 1
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        """{'endpoints': {name: {count, p50, p95, p99}}, 'counters': {...}} with latencies in seconds"""
+        with self._lock:
+            samples = {endpoint: list(values) for endpoint, values in self.latencies.items()}
+            counters = dict(self.counters)
+        return {
+            'endpoints': {
+                endpoint: {
+                    'count': counters.get(f'{endpoint}.calls', 0),
+                    'p50': percentile(values, 50),
+                    'p95': percentile(values, 95),
+                    'p99': percentile(values, 99),
+                }
+                for endpoint, values in samples.items()
+            },
+            'counters': counters,
+        }
+
+
+metrics = UpstreamMetrics()
@@ -0,0 +1,109 @@
+"""Incremental maintenance of TransactionRollup"""
+from collections import defaultdict
+from decimal import Decimal
+from django.db import transaction as db_transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+from chama.caching import charts, invalidate_charts
+from .models import MpesaTransaction, TransactionRollup
+
+COUNTERS = ['contribution_total', 'contribution_count', 'success_count', 'failed_count', 'pending_count']
+STATUS_COUNTERS = {'SUCCESS': 'success_count', 'FAILED': 'failed_count', 'PENDING': 'pending_count'}
+
+
+def month_key(value):
+    """First day of the local month of a datetime"""
+    return timezone.localdate(value).replace(day=1)
+
+
+def _apply(deltas):
+    """
+    Add {(chama_id, user_id, month): {counter: delta}} to the rollup rows,
+    and once committed, move the users' chart data to a new cache version.
+    A fixed number of statements however many rows change: missing rows are
+    created, the affected rows locked and read, then written back in bulk.
+    """
+    if not deltas:
+        return
+    user_ids = {user_id for _, user_id, _ in deltas}
+    db_transaction.on_commit(lambda: invalidate_charts(user_ids))
+    with db_transaction.atomic():
+        TransactionRollup.objects.bulk_create(
+            [TransactionRollup(chama_id=c, user_id=u, month=m) for c, u, m in deltas],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+        rows = TransactionRollup.objects.select_for_update().filter(
+            user_id__in=user_ids, month__in={month for _, _, month in deltas}
+        ).order_by('id')
+        changed = []
+        for row in rows:
+            changes = deltas.get((row.chama_id, row.user_id, row.month))
+            if not changes:
+                continue
+            for field, delta in changes.items():
+                setattr(row, field, getattr(row, field) + (delta if field == 'contribution_total' else int(delta)))
+            changed.append(row)
+        TransactionRollup.objects.bulk_update(changed, COUNTERS, batch_size=500)
+
+
+def record_created(transactions):
+    """Count newly created PENDING transactions"""
+    deltas = defaultdict(lambda: defaultdict(int))
+    for t in transactions:
+        if t.user_id:
+            deltas[(t.chama_id, t.user_id, month_key(t.transaction_date))]['pending_count'] += 1
+    _apply(deltas)
+
+
+def record_settled(transactions):
+    """Move transactions that just left PENDING into their final counters"""
+    deltas = defaultdict(lambda: defaultdict(Decimal))
+    for t in transactions:
+        if not t.user_id:
+            continue
+        row = deltas[(t.chama_id, t.user_id, month_key(t.transaction_date))]
+        row['pending_count'] -= 1
+        row[STATUS_COUNTERS[t.status]] += 1
+        if t.status == 'SUCCESS' and t.transaction_type == 'CONTRIBUTION':
+            row['contribution_total'] += Decimal(t.amount)
+            row['contribution_count'] += 1
+    _apply(deltas)
+
+
+def rebuild_rollups():
+    """Recompute every rollup row from MpesaTransaction. Returns rows written."""
+    contribution = Q(status='SUCCESS', transaction_type='CONTRIBUTION')
+    rows = (
+        MpesaTransaction.objects.filter(user__isnull=False)
+        .annotate(month=TruncMonth('transaction_date'))
+        .values('chama_id', 'user_id', 'month')
+        .annotate(
+            contribution_total=Sum('amount', filter=contribution, default=0),
+            contribution_count=Count('id', filter=contribution),
+            success_count=Count('id', filter=Q(status='SUCCESS')),
+            failed_count=Count('id', filter=Q(status='FAILED')),
+            pending_count=Count('id', filter=Q(status='PENDING')),
+        )
+        .order_by()
+    )
+    written = 0
+    with db_transaction.atomic():
+        TransactionRollup.objects.all().delete()
+        batch = []
+        for row in rows.iterator(chunk_size=5000):
+            batch.append(TransactionRollup(
+                chama_id=row['chama_id'],
+                user_id=row['user_id'],
+                month=timezone.localdate(row['month']),
+                **{field: row[field] for field in COUNTERS},
+            ))
+            if len(batch) >= 5000:
+                TransactionRollup.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+        TransactionRollup.objects.bulk_create(batch)
+        written += len(batch)
+        db_transaction.on_commit(charts.invalidate)
+    return written
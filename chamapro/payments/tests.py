@@ -1,3 +1,787 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import tempfile
+import threading
+import time
+from http.client import RemoteDisconnected
+from unittest import mock
+from datetime import timedelta
+from decimal import Decimal
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Sum
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+from chama import ledger
+from chama.models import Chama, Investment, Loan
+from chama.obligations import get_obligation
+from .campaigns import claim_next_campaign, run_campaign
+from . import callbacks
+from .callbacks import drain_inbox, settle_transactions
+from .daraja_stub import CallbackSender, DarajaStub
+from .disbursements import approve_and_reserve, disburse_loans
+from .drift import verify_balances
+from .models import CallbackInbox, ContributionCampaign, MpesaTransaction, TransactionRollup
+from .reconcile import parse_stk_query, reconcile_pending
+from .resilience import metrics
+from .rollups import COUNTERS, rebuild_rollups, record_created
+from .utils import AccessTokenStore, MpesaGateWay, RateLimiter
+
+User = get_user_model()
+
+
+class TransactionExportTests(TestCase):
+    def setUp(self):
+        self.treasurer = User.objects.create_user(username='treasurer', email='t@example.com', password='pw')
+        self.member = User.objects.create_user(username='member', email='m@example.com', password='pw')
+        self.chama = Chama.objects.create(
+            name='Export Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.treasurer,
+        )
+        self.chama.members.add(self.treasurer, self.member)
+        rows = []
+        for i, (user, status) in enumerate([
+            (self.treasurer, 'SUCCESS'), (self.member, 'SUCCESS'), (self.member, 'FAILED'), (self.member, 'PENDING'),
+        ]):
+            rows.append(MpesaTransaction(
+                user=user, chama=self.chama, merchant_request_id='m', checkout_request_id=f'ws_{i}',
+                amount=100 * (i + 1), phone_number='254700000000', status=status,
+                description='=HYPERLINK("x")' if i == 0 else 'Contribution',
+            ))
+        MpesaTransaction.objects.bulk_create(rows)
+        self.url = reverse('payments:export_transactions', kwargs={'chama_id': self.chama.pk})
+
+    def read(self, response):
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        body = b''.join(response.streaming_content).decode()
+        return list(csv.DictReader(io.StringIO(body)))
+
+    def test_admin_exports_every_member_with_filters(self):
+        self.client.force_login(self.treasurer)
+        self.assertEqual(len(self.read(self.client.get(self.url))), 4)
+        rows = self.read(self.client.get(self.url, {'status': 'SUCCESS', 'type': 'contribution'}))
+        self.assertEqual([r['Member'] for r in rows], ['treasurer', 'member'])
+        self.assertTrue(rows[0]['Description'].startswith("'="))
+
+    def test_member_only_gets_own_statement(self):
+        self.client.force_login(self.member)
+        rows = self.read(self.client.get(self.url, {'member': self.treasurer.pk}))
+        self.assertEqual({r['Member'] for r in rows}, {'member'})
+        self.assertEqual(len(rows), 3)
+
+    def test_bad_filters_are_rejected(self):
+        self.client.force_login(self.treasurer)
+        self.assertEqual(self.client.get(self.url, {'start': '2026-02-01', 'end': '2026-01-01'}).status_code, 400)
+
+    def test_management_command_matches_endpoint(self):
+        out = io.StringIO()
+        call_command('export_transactions', chama=str(self.chama.pk), status='FAILED', stdout=out)
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual([(r['Member'], r['Amount']) for r in rows], [('member', '300.00')])
+
+
+class PaymentViewTests(TestCase):
+    def setUp(self):
+        self.payer = User.objects.create_user(username='payer', email='p@example.com', password='pw', phone_number='254711000001')
+        self.chama = Chama.objects.create(
+            name='Paying Chama', county='Nairobi', phone='254700000000', monthly_contribution=500,
+            created_by=self.payer, subscription_plan='STANDARD',
+        )
+        self.chama.members.add(self.payer)
+        self.client.force_login(self.payer)
+
+    def test_phones_are_normalised_before_the_push(self):
+        accepted = {'ResponseCode': '0', 'MerchantRequestID': 'm', 'CheckoutRequestID': 'ws_1'}
+        with mock.patch.object(MpesaGateWay, 'stk_push', return_value=accepted) as stk_push:
+            self.client.post(reverse('payments:initiate_payment'), {'phone': '0711 000 001', 'amount': '500'})
+            accepted['CheckoutRequestID'] = 'ws_2'
+            self.client.post(reverse('payments:pay_subscription', kwargs={'chama_id': self.chama.pk}), {'phone': '+254711000001'})
+        self.assertEqual([call.args[0] for call in stk_push.call_args_list], ['254711000001'] * 2)
+        self.assertEqual(
+            list(MpesaTransaction.objects.order_by('checkout_request_id').values_list('user__username', 'phone_number')),
+            [('payer', '254711000001')] * 2,
+        )
+
+
+def isolate_mpesa_cache(test):
+    """Give the test an empty 'mpesa' cache of its own (tokens, locks, breaker), removed after it"""
+    location = test.enterContext(tempfile.TemporaryDirectory())
+    test.enterContext(override_settings(CACHES={**settings.CACHES, 'mpesa': {**settings.CACHES['mpesa'], 'LOCATION': location}}))
+    caches['mpesa'].clear()
+
+
+# Gateway calls run in pool threads, which cannot use a database cache inside the test transaction
+@override_settings(MPESA_TOKEN_CACHE='mpesa')
+class ContributionCampaignTests(TestCase):
+    def setUp(self):
+        isolate_mpesa_cache(self)
+        MpesaGateWay().breaker.reset()
+        self.admin = User.objects.create_user(username='admin', email='a@example.com', password='pw', phone_number='0711000000')
+        self.owing = User.objects.create_user(username='owing', email='o@example.com', password='pw', phone_number='254711000001')
+        self.paid = User.objects.create_user(username='paid', email='p@example.com', password='pw', phone_number='0711000002')
+        self.no_phone = User.objects.create_user(username='nophone', email='n@example.com', password='pw')
+        self.chama = Chama.objects.create(
+            name='Campaign Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.admin,
+        )
+        self.chama.members.add(self.admin, self.owing, self.paid, self.no_phone)
+        obligation = get_obligation(self.chama, self.paid)
+        obligation.paid_amount, obligation.status = 500, 'PAID'
+        obligation.save()
+        self.url = reverse('payments:request_contributions', kwargs={'chama_id': self.chama.pk})
+
+    def test_only_the_admin_can_queue_one_campaign_at_a_time(self):
+        self.client.force_login(self.owing)
+        self.client.post(self.url)
+        self.assertFalse(ContributionCampaign.objects.exists())
+        self.client.force_login(self.admin)
+        self.client.post(self.url)
+        self.client.post(self.url)
+        self.assertEqual(ContributionCampaign.objects.filter(chama=self.chama).count(), 1)
+
+    def test_campaign_pushes_to_members_who_owe(self):
+        ContributionCampaign.objects.create(chama=self.chama, created_by=self.admin)
+        with DarajaStub() as stub, override_settings(MPESA_BASE_URL=stub.url):
+            campaign = run_campaign(claim_next_campaign(), workers=4, rate=0)
+            self.assertEqual(stub.counters['stk_push'], 2)
+        self.assertEqual((campaign.status, campaign.sent, campaign.failed, campaign.skipped), ('COMPLETED', 2, 0, 2))
+        self.assertEqual(
+            set(MpesaTransaction.objects.filter(chama=self.chama).values_list('phone_number', 'amount', 'status')),
+            {('254711000000', Decimal('500.00'), 'PENDING'), ('254711000001', Decimal('500.00'), 'PENDING')},
+        )
+        self.assertIsNone(claim_next_campaign())
+
+    def test_campaign_whose_runner_died_is_claimed_again(self):
+        self.client.force_login(self.admin)
+        self.client.post(self.url)
+        crashed = claim_next_campaign()
+        self.assertIsNone(claim_next_campaign())
+        ContributionCampaign.objects.filter(id=crashed.id).update(sent=1, heartbeat_at=timezone.now() - timedelta(minutes=10))
+
+        with DarajaStub() as stub, override_settings(MPESA_BASE_URL=stub.url):
+            campaign = run_campaign(claim_next_campaign(), workers=2, rate=0)
+        self.assertEqual(campaign.id, crashed.id)
+        self.assertEqual((campaign.status, campaign.sent, campaign.total), ('COMPLETED', 2, 2))
+        # The chama can ask again now
+        self.client.post(self.url)
+        self.assertEqual(ContributionCampaign.objects.filter(chama=self.chama).count(), 2)
+
+    def test_rate_limiter_paces_calls(self):
+        now = [0.0]
+        limiter = RateLimiter(2, burst=1, clock=lambda: now[0], sleep=lambda s: now.__setitem__(0, now[0] + s))
+        for _ in range(5):
+            limiter.acquire()
+        self.assertAlmostEqual(now[0], 2.0)
+
+
+@override_settings(MPESA_TOKEN_CACHE='mpesa')
+class ReconcilePendingTests(TestCase):
+    def setUp(self):
+        isolate_mpesa_cache(self)
+        MpesaGateWay().breaker.reset()
+        self.admin = User.objects.create_user(username='admin', email='a@example.com', password='pw')
+        self.chama = Chama.objects.create(
+            name='Reconcile Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.admin,
+        )
+
+    def add_pending(self, count, minutes_ago=30):
+        users = User.objects.bulk_create([
+            User(username=f'r{MpesaTransaction.objects.count()}_{i}', email=f'r{i}@example.com')
+            for i in range(count)
+        ])
+        self.chama.members.add(*users)
+        start = MpesaTransaction.objects.count()
+        rows = MpesaTransaction.objects.bulk_create([
+            MpesaTransaction(
+                user=user, chama=self.chama, merchant_request_id='m', checkout_request_id=f'ws_{start + i}',
+                amount=100, phone_number='254700000000', status='PENDING',
+            )
+            for i, user in enumerate(users)
+        ])
+        MpesaTransaction.objects.filter(id__in=[t.id for t in rows]).update(
+            transaction_date=timezone.now() - timedelta(minutes=minutes_ago)
+        )
+        return rows
+
+    def test_final_answers_are_settled_and_the_rest_left_pending(self):
+        paid, cancelled, processing = self.add_pending(3)
+        recent, = self.add_pending(1, minutes_ago=1)
+        with DarajaStub() as stub, override_settings(MPESA_BASE_URL=stub.url):
+            stub.query_results = {cancelled.checkout_request_id: '1032', processing.checkout_request_id: None}
+            stats = reconcile_pending(chunk_size=2, workers=4, rate=0)
+            self.assertEqual(stub.counters['stk_query'], 3)
+        self.assertEqual(stats, {'checked': 3, 'settled': 2, 'success': 1, 'failed': 1, 'expired': 0, 'unresolved': 1})
+        statuses = dict(MpesaTransaction.objects.values_list('id', 'status'))
+        self.assertEqual(
+            [statuses[t.id] for t in (paid, cancelled, processing, recent)], ['SUCCESS', 'FAILED', 'PENDING', 'PENDING']
+        )
+        self.assertEqual(ledger.balance(self.chama.id), 100)
+        self.assertEqual(get_obligation(self.chama, paid.user).paid_amount, 100)
+
+    def test_transactions_m_pesa_has_no_result_for_expire(self):
+        old, = self.add_pending(1, minutes_ago=25 * 60)
+        unanswered, = self.add_pending(1, minutes_ago=25 * 60)
+        recent, = self.add_pending(1)
+        with DarajaStub() as stub, override_settings(MPESA_BASE_URL=stub.url):
+            stub.query_results = {t.checkout_request_id: None for t in (old, recent)}
+            gateway = MpesaGateWay()
+            stk_query = gateway.stk_query
+            # The query for `unanswered` never reaches Daraja: its outcome is still unknown
+            with mock.patch.object(gateway, 'stk_query', side_effect=lambda checkout_request_id: (
+                {'ResponseCode': '1', 'RequestSent': False} if checkout_request_id == unanswered.checkout_request_id
+                else stk_query(checkout_request_id)
+            )):
+                stats = reconcile_pending(workers=2, rate=0, gateway=gateway)
+        self.assertEqual((stats['expired'], stats['unresolved']), (1, 2))
+        old.refresh_from_db()
+        self.assertEqual((old.status, old.description), ('FAILED', 'Expired: M-Pesa had no result for the payment'))
+        self.assertEqual(MpesaTransaction.objects.filter(status='PENDING').count(), 2)
+
+    def test_settling_a_chunk_costs_the_same_queries_at_any_size(self):
+        self.add_pending(5)
+        with DarajaStub() as stub, override_settings(MPESA_BASE_URL=stub.url):
+            with CaptureQueriesContext(connection) as small:
+                reconcile_pending(chunk_size=100, workers=4, rate=0)
+            self.add_pending(50)
+            with CaptureQueriesContext(connection) as large:
+                reconcile_pending(chunk_size=100, workers=4, rate=0)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+        self.assertFalse(MpesaTransaction.objects.filter(status='PENDING').exists())
+
+
+@override_settings(
+    MPESA_READ_TIMEOUTS={'stk_push': 0.2, 'stk_query': 0.2}, MPESA_RETRIES=2, MPESA_RETRY_BACKOFF=0,
+    MPESA_BREAKER_THRESHOLD=3, MPESA_TOKEN_CACHE='mpesa',
+)
+class DarajaResilienceTests(TestCase):
+    def setUp(self):
+        isolate_mpesa_cache(self)
+        self.stub = DarajaStub().start()
+        self.settings_override = override_settings(MPESA_BASE_URL=self.stub.url)
+        self.settings_override.enable()
+        self.gateway = MpesaGateWay()
+        self.gateway.breaker.reset()
+        self.gateway.get_access_token()
+        metrics.reset()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.stub.stop()
+
+    def test_only_idempotent_calls_are_retried_after_a_read_timeout(self):
+        self.stub.latencies = {'stk_push': 1, 'stk_query': 1}
+        self.assertEqual(self.gateway.stk_query('ws_1')['ResponseCode'], '1')
+        self.assertEqual(self.gateway.stk_push('254700000000', 100)['ResponseCode'], '1')
+        self.assertEqual((self.stub.counters['stk_query'], self.stub.counters['stk_push']), (3, 1))
+        counters = metrics.snapshot()['counters']
+        self.assertEqual((counters['stk_query.timeouts'], counters['stk_query.retries']), (3, 2))
+
+    def test_breaker_fails_fast_while_open_and_a_probe_closes_it(self):
+        self.stub.fail_status = 503
+        for _ in range(3):
+            self.gateway.stk_push('254700000000', 100)
+        self.assertEqual(self.gateway.breaker.state()['state'], 'open')
+        self.assertEqual(self.gateway.stk_push('254700000000', 100)['ResponseCode'], '1')
+        self.assertEqual(self.stub.counters['stk_push'], 3)
+
+        # Another worker sees the same breaker; once the cooldown is over one probe gets through
+        self.stub.fail_status = None
+        breaker = MpesaGateWay().breaker
+        breaker.cache.set(f"{breaker.key}:open", 0, timeout=None)
+        self.assertEqual(self.gateway.stk_push('254700000000', 100)['ResponseCode'], '0')
+        self.assertEqual(breaker.state(), {'state': 'closed', 'failures': 0, 'trips': 1})
+
+    def test_only_connections_never_made_count_as_not_sent(self):
+        dropped = requests.ConnectionError(
+            ProtocolError('Connection aborted.', RemoteDisconnected('Remote end closed connection without response'))
+        )
+        with mock.patch.object(self.gateway.session, 'request', side_effect=dropped) as request:
+            result = self.gateway.disburse_funds('254700000000', 100)
+        self.assertIs(result['RequestSent'], True)
+        self.assertEqual(request.call_count, 1)  # a B2C payment is never repeated
+
+        refused = requests.ConnectionError(
+            MaxRetryError(None, '/mpesa/b2c/v1/paymentrequest', NewConnectionError(None, 'Connection refused'))
+        )
+        with mock.patch.object(self.gateway.session, 'request', side_effect=refused) as request:
+            result = self.gateway.disburse_funds('254700000000', 100)
+        self.assertIs(result['RequestSent'], False)
+        self.assertEqual(request.call_count, 3)  # nothing reached Daraja, so retrying is safe
+
+
+@override_settings(MPESA_TOKEN_CACHE='mpesa')
+class DarajaSimulatorTests(TestCase):
+    def setUp(self):
+        isolate_mpesa_cache(self)
+        MpesaGateWay().breaker.reset()
+        self.admin = User.objects.create_user(username='admin', email='a@example.com', password='pw', phone_number='254711000000')
+        payers = [
+            User.objects.create_user(username=f'payer{i}', email=f'p{i}@example.com', password='pw', phone_number=f'25471100001{i}')
+            for i in range(5)
+        ]
+        self.chama = Chama.objects.create(
+            name='Simulated Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.admin,
+        )
+        self.chama.members.add(self.admin, *payers)
+
+    def test_stk_callbacks_settle_the_pushed_payments(self):
+        sender = CallbackSender(results={'0': 1, '1032': 1}, seed=7)
+        ContributionCampaign.objects.create(chama=self.chama, created_by=self.admin)
+        with DarajaStub() as stub, override_settings(MPESA_BASE_URL=stub.url):
+            stub.callbacks = sender  # scheduled but not sent: delivered through the test client below
+            gateway = MpesaGateWay()
+            run_campaign(claim_next_campaign(), workers=3, rate=0, gateway=gateway)
+            scheduled = [sender._queue.get_nowait() for _ in range(sender.pending())]
+            self.assertEqual(len(scheduled), 6)
+            for _, url, body in scheduled:
+                self.assertTrue(url.endswith('/payments/callback/'))
+                self.client.post(reverse('payments:callback'), body, content_type='application/json')
+            drain_inbox()
+
+            transactions = MpesaTransaction.objects.filter(chama=self.chama)
+            results = {t.checkout_request_id: stub.query_results[t.checkout_request_id] for t in transactions}
+            self.assertEqual(set(results.values()), {'0', '1032'})
+            for t in transactions:
+                self.assertEqual(t.status, 'SUCCESS' if results[t.checkout_request_id] == '0' else 'FAILED')
+                # STK Query tells the same story as the callback
+                self.assertEqual(gateway.stk_query(t.checkout_request_id)['ResultCode'], results[t.checkout_request_id])
+        self.assertEqual(ledger.balance(self.chama.id), 500 * list(results.values()).count('0'))
+
+    def test_failure_rates_answer_503s(self):
+        with DarajaStub(failure_rates={'stk_push': 1}) as stub, override_settings(MPESA_BASE_URL=stub.url):
+            gateway = MpesaGateWay()
+            self.assertEqual(gateway.stk_push('254711000000', 100)['ResponseCode'], '1')
+            self.assertEqual(gateway.stk_query('ws_1')['ResultCode'], '0')
+            self.assertEqual((stub.counters['stk_push'], stub.counters['stk_push.failed']), (1, 1))
+
+
+@override_settings(MPESA_TOKEN_CACHE='mpesa')
+class LoanDisbursementTests(TestCase):
+    def setUp(self):
+        isolate_mpesa_cache(self)
+        MpesaGateWay().breaker.reset()
+        self.admin = User.objects.create_user(username='admin', email='a@example.com', password='pw')
+        self.borrower = User.objects.create_user(
+            username='borrower', email='b@example.com', password='pw', phone_number='0711000001'
+        )
+        self.chama = Chama.objects.create(
+            name='Loan Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.admin,
+        )
+        ledger.record([(self.chama.id, 'OPENING', 1000, '')])
+        self.chama.members.add(self.admin, self.borrower)
+        self.client.force_login(self.admin)
+
+    def request_loan(self, amount):
+        loan = Loan.objects.create(chama=self.chama, borrower=self.borrower, amount=amount)
+        return loan, reverse('chama:approve_loan', kwargs={'slug': self.chama.slug, 'pk': self.chama.pk, 'loan_id': loan.id})
+
+    def balance(self):
+        return ledger.balance(self.chama.id)
+
+    def post_result(self, loan, result_code, url='payments:b2c_result', conversation_id=None):
+        loan.refresh_from_db()
+        return self.client.post(reverse(url), json.dumps({'Result': {
+            'ResultType': 0, 'ResultCode': result_code, 'ResultDesc': 'done',
+            'ConversationID': loan.conversation_id if conversation_id is None else conversation_id,
+            'TransactionID': 'RKL0001',
+        }}), content_type='application/json')
+
+    def test_approval_reserves_the_balance_once_without_calling_mpesa(self):
+        loan, url = self.request_loan(600)
+        too_big, too_big_url = self.request_loan(600)
+        self.client.get(url)
+        self.client.get(url)
+        self.client.get(too_big_url)
+        self.assertEqual(self.balance(), 400)
+        loan.refresh_from_db()
+        too_big.refresh_from_db()
+        self.assertEqual((loan.status, too_big.status), ('APPROVED', 'PENDING'))
+
+    def test_worker_and_b2c_results_drive_the_state_machine(self):
+        paid, paid_url = self.request_loan(300)
+        failed, failed_url = self.request_loan(200)
+        expired, expired_url = self.request_loan(100)
+        for url in (paid_url, failed_url, expired_url):
+            self.client.get(url)
+        self.assertEqual(self.balance(), 400)
+
+        with DarajaStub() as stub, override_settings(MPESA_BASE_URL=stub.url):
+            self.assertEqual(disburse_loans(), {'DISBURSING': 3})
+            self.assertEqual(stub.counters['b2c'], 3)
+
+        self.assertEqual(self.post_result(paid, 0).json()['ResultCode'], 0)
+        self.post_result(paid, 2001)  # a replay with a different outcome changes nothing
+        self.post_result(failed, 2001)
+        self.post_result(expired, 1, url='payments:b2c_timeout')
+        statuses = dict(Loan.objects.values_list('id', 'status'))
+        self.assertEqual([statuses[loan.id] for loan in (paid, failed, expired)], ['DISBURSED', 'FAILED', 'FAILED'])
+        self.assertEqual(self.balance(), 700)
+
+    def test_forged_results_only_settle_the_loan_they_name_while_disbursing(self):
+        paid, paid_url = self.request_loan(300)
+        self.client.get(paid_url)
+        with DarajaStub() as stub, override_settings(MPESA_BASE_URL=stub.url):
+            disburse_loans()
+        self.post_result(paid, 0)
+        approved, approved_url = self.request_loan(200)
+        self.client.get(approved_url)
+
+        # Made-up or missing conversation ids, and a failure for a loan already paid out
+        for conversation_id in ('AG_forged', '', paid.conversation_id):
+            for result_code in (0, 2001):
+                response = self.post_result(approved, result_code, conversation_id=conversation_id)
+                self.assertEqual(response.json()['ResultCode'], 0)
+            self.post_result(approved, 1, url='payments:b2c_timeout', conversation_id=conversation_id)
+        paid.refresh_from_db()
+        approved.refresh_from_db()
+        self.assertEqual((paid.status, paid.receipt_number, approved.status), ('DISBURSED', 'RKL0001', 'APPROVED'))
+        self.assertEqual(self.balance(), 500)
+
+    def test_unreachable_mpesa_puts_the_loan_back_in_the_queue(self):
+        loan, url = self.request_loan(300)
+        self.client.get(url)
+        with DarajaStub() as stub, override_settings(MPESA_BASE_URL=stub.url):
+            MpesaGateWay().get_access_token()
+            stub.fail_status = 503
+            self.assertEqual(disburse_loans(), {'APPROVED': 1})
+        loan.refresh_from_db()
+        self.assertEqual((loan.status, self.balance()), ('APPROVED', 700))
+
+    def disburse_with(self, **response):
+        """Claim and send one approved loan, Daraja's side of the B2C call replaced by `response`"""
+        loan, url = self.request_loan(300)
+        self.client.get(url)
+        with DarajaStub() as stub, override_settings(MPESA_BASE_URL=stub.url):
+            gateway = MpesaGateWay()
+            gateway.breaker.reset()
+            gateway.get_access_token()
+            with mock.patch.object(gateway.session, 'request', **response) as request:
+                outcomes = disburse_loans(gateway=gateway), disburse_loans(gateway=gateway)
+            gateway.breaker.reset()
+        loan.refresh_from_db()
+        return loan, outcomes, request.call_count
+
+    def test_payout_that_may_have_gone_through_is_left_for_a_check(self):
+        dropped = requests.ConnectionError(ProtocolError('Connection aborted.', RemoteDisconnected('closed')))
+        unreadable = mock.Mock(status_code=200, **{'json.side_effect': ValueError('Expecting value')})
+        for response, balance in (({'side_effect': dropped}, 700), ({'return_value': unreadable}, 400)):
+            loan, outcomes, calls = self.disburse_with(**response)
+            # Neither refunded nor queued again: the borrower may already have the money
+            self.assertEqual(outcomes, ({'UNKNOWN': 1}, {}))
+            self.assertEqual((loan.status, loan.conversation_id, calls), ('DISBURSING', '', 1))
+            self.assertEqual(self.balance(), balance)
+
+    def test_rejection_from_daraja_fails_the_loan_and_refunds_it(self):
+        rejected = mock.Mock(status_code=400, **{'json.return_value': {
+            'requestId': '1', 'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid Amount',
+        }})
+        loan, outcomes, calls = self.disburse_with(return_value=rejected)
+        self.assertEqual(outcomes, ({'FAILED': 1}, {}))
+        self.assertEqual((loan.status, loan.failure_reason, self.balance()), ('FAILED', 'Bad Request - Invalid Amount', 1000))
+
+
+class BalanceDriftTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(username='admin', email='a@example.com', password='pw')
+        self.chama = Chama.objects.create(
+            name='Drift Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.admin,
+        )
+        self.chama.members.add(self.admin)
+        for i in range(3):
+            MpesaTransaction.objects.create(
+                user=self.admin, chama=self.chama, merchant_request_id='m', checkout_request_id=f'ws_{i}',
+                amount=400, phone_number='254700000000', status='SUCCESS',
+            )
+            ledger.record([(self.chama.id, 'CONTRIBUTION', 400, f'mpesa:ws_{i}')])
+        approve_and_reserve(Loan.objects.create(chama=self.chama, borrower=self.admin, amount=500), self.admin)
+
+    def test_consistent_ledgers_pass(self):
+        investment = Investment.objects.create(chama=self.chama, name='T-bill', amount=300, date_invested=timezone.localdate())
+        ledger.record_investment(investment)
+        totals = verify_balances(chunk_size=1)
+        self.assertEqual((totals['checked'], totals['drifting']), (1, 0))
+
+    def test_investments_missing_from_the_ledger_drift(self):
+        Investment.objects.create(chama=self.chama, name='T-bill', amount=300, date_invested=timezone.localdate())
+        out = io.StringIO()
+        call_command('verify_balances', stdout=out)
+        self.assertIn('expected 400 drift +300', out.getvalue())
+        self.assertIn('investments +300', out.getvalue())
+
+    def test_drift_is_reported_and_fixed_with_an_adjustment(self):
+        # A settled contribution the ledger missed, and a disbursement the old fallback made without M-Pesa
+        MpesaTransaction.objects.create(
+            user=self.admin, chama=self.chama, merchant_request_id='m', checkout_request_id='ws_missed',
+            amount=250, phone_number='254700000000', status='SUCCESS',
+        )
+        Loan.objects.create(chama=self.chama, borrower=self.admin, amount=100, status='DISBURSED')
+        out = io.StringIO()
+        call_command('verify_balances', stdout=out)
+        self.assertIn('expected 850 drift -150', out.getvalue())
+        self.assertIn('1 loans are DISBURSED without', out.getvalue())
+
+        totals = verify_balances(fix=True)
+        self.assertEqual((totals['drifting'], totals['fixed']), (1, 1))
+        self.assertEqual(ledger.balance(self.chama.id), 1200 + 250 - 500 - 100)
+        self.assertEqual(verify_balances()['drifting'], 0)
+        self.chama.refresh_from_db()
+        self.assertEqual(self.chama.total_balance, 850)
+
+
+def stk_callback(checkout_request_id, result_code=0, receipt=None, amount=500):
+    """An stkCallback body as Daraja posts it"""
+    callback = {'MerchantRequestID': 'm', 'CheckoutRequestID': checkout_request_id, 'ResultCode': result_code,
+                'ResultDesc': 'Done' if result_code == 0 else 'Request cancelled by user'}
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': amount},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt or f'R{checkout_request_id}'},
+            {'Name': 'PhoneNumber', 'Value': 254711000001},
+        ]}
+    return json.dumps({'Body': {'stkCallback': callback}})
+
+
+class CallbackInboxTests(TestCase):
+    def setUp(self):
+        self.member = User.objects.create_user(username='member', email='m@example.com', password='pw')
+        self.chama = Chama.objects.create(
+            name='Inbox Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.member,
+        )
+        self.chama.members.add(self.member)
+        for checkout_request_id in ('ws_a', 'ws_b', 'ws_c'):
+            MpesaTransaction.objects.create(
+                user=self.member, chama=self.chama, merchant_request_id='m', checkout_request_id=checkout_request_id,
+                amount=500, phone_number='254711000001',
+            )
+
+    def post(self, body):
+        return self.client.post(reverse('payments:callback'), body, content_type='application/json')
+
+    def statuses(self):
+        return dict(MpesaTransaction.objects.values_list('checkout_request_id', 'status'))
+
+    def test_first_delivery_wins_and_replays_change_nothing(self):
+        self.post(stk_callback('ws_a'))
+        self.post(stk_callback('ws_a', result_code=1032))  # Daraja retried with a different answer
+        self.post(stk_callback('ws_b', result_code=1032))
+        self.post(json.dumps({'Body': {'stkCallback': {'ResultCode': 0}}}))
+        self.assertEqual(drain_inbox(batch_size=2), (2, 1))
+        self.assertEqual(drain_inbox(), (2, 1))
+        self.assertEqual(drain_inbox(), (0, 0))
+        self.assertEqual(self.statuses(), {'ws_a': 'SUCCESS', 'ws_b': 'FAILED', 'ws_c': 'PENDING'})
+        self.assertEqual(
+            list(CallbackInbox.objects.exclude(error='').values_list('error', flat=True)), ['Missing CheckoutRequestID']
+        )
+
+        # A replay that slips past the endpoint's check is dropped by the worker
+        CallbackInbox.objects.create(checkout_request_id='ws_a', payload=stk_callback('ws_a', result_code=1032))
+        self.assertEqual(drain_inbox(), (1, 0))
+        self.assertEqual(self.statuses()['ws_a'], 'SUCCESS')
+        self.assertEqual(ledger.balance(self.chama.id), 500)
+
+    def test_a_late_callback_fills_in_a_reconciled_receipt(self):
+        with transaction.atomic():
+            settle_transactions({'ws_a': parse_stk_query({'ResultCode': '0'})})
+        self.post(stk_callback('ws_a', receipt='RLATE1'))
+        self.assertEqual(drain_inbox(), (1, 0))
+        receipted = MpesaTransaction.objects.get(checkout_request_id='ws_a')
+        self.assertEqual((receipted.status, receipted.receipt_number), ('SUCCESS', 'RLATE1'))
+        self.assertEqual(ledger.balance(self.chama.id), 500)
+
+        # Now it is a replay like any other
+        self.post(stk_callback('ws_a', receipt='RLATE1'))
+        self.assertEqual(CallbackInbox.objects.filter(processed_at__isnull=True).count(), 0)
+
+    def test_a_callback_that_keeps_failing_does_not_hold_back_the_rest(self):
+        record_contributions = callbacks.record_contributions
+
+        def poisoned(transactions):
+            if any(t.checkout_request_id == 'ws_b' for t in transactions):
+                raise IntegrityError('UNIQUE constraint failed')
+            record_contributions(transactions)
+
+        for checkout_request_id in ('ws_a', 'ws_b', 'ws_c'):
+            self.post(stk_callback(checkout_request_id))
+        poison = CallbackInbox.objects.get(checkout_request_id='ws_b')
+        with mock.patch.object(callbacks, 'record_contributions', side_effect=poisoned):
+            self.assertEqual(drain_inbox(), (3, 2))
+            self.assertEqual(self.statuses(), {'ws_a': 'SUCCESS', 'ws_b': 'PENDING', 'ws_c': 'SUCCESS'})
+            poison.refresh_from_db()
+            self.assertEqual((poison.processed_at, poison.attempts), (None, 1))
+            self.assertIn('IntegrityError', poison.error)
+
+            # Not retried straight away, then after a wait that doubles each time
+            self.assertEqual(drain_inbox(), (0, 0))
+            now = timezone.now()
+            for attempt in range(1, callbacks.MAX_ATTEMPTS):
+                self.assertAlmostEqual(
+                    (poison.next_attempt_at - now).total_seconds(), callbacks.RETRY_AFTER * 2 ** (attempt - 1), delta=5
+                )
+                with mock.patch('django.utils.timezone.now', return_value=poison.next_attempt_at):
+                    self.assertEqual(drain_inbox(), (1, 0))
+                now = poison.next_attempt_at
+                poison.refresh_from_db()
+            self.assertEqual(drain_inbox(), (0, 0))
+        poison.refresh_from_db()
+        self.assertIsNotNone(poison.processed_at)
+        self.assertEqual(poison.attempts, callbacks.MAX_ATTEMPTS)
+        self.assertEqual(ledger.balance(self.chama.id), 1000)
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.members = [
+            User.objects.create_user(username=f'member{i}', email=f'm{i}@example.com', password='pw') for i in range(2)
+        ]
+        self.chama = Chama.objects.create(
+            name='Rollup Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.members[0],
+        )
+        self.chama.members.add(*self.members)
+
+    def push(self, n, user, amount=500, transaction_type='CONTRIBUTION', days_ago=0):
+        t = MpesaTransaction.objects.create(
+            user=user, chama=self.chama, merchant_request_id='m', checkout_request_id=f'ws_{n}',
+            amount=amount, phone_number='254711000001', transaction_type=transaction_type,
+        )
+        if days_ago:
+            MpesaTransaction.objects.filter(id=t.id).update(transaction_date=t.transaction_date - timedelta(days=days_ago))
+            t.refresh_from_db()
+        record_created([t])
+
+    def rollups(self):
+        return set(TransactionRollup.objects.values_list('chama_id', 'user_id', 'month', *COUNTERS))
+
+    def test_incremental_rollups_match_a_rebuild(self):
+        first, second = self.members
+        self.push(1, first)
+        self.push(2, first, amount=300, days_ago=40)
+        self.push(3, first)
+        self.push(4, second, amount=250)
+        self.push(5, second, transaction_type='SUBSCRIPTION')
+        self.push(6, second)  # never answered: stays PENDING
+
+        for body in (
+            stk_callback('ws_1'), stk_callback('ws_2', amount=300), stk_callback('ws_3', result_code=1032),
+            stk_callback('ws_4', amount=250), stk_callback('ws_5'),
+            stk_callback('ws_1'), stk_callback('ws_3'),  # replays, the second with a different answer
+        ):
+            self.client.post(reverse('payments:callback'), body, content_type='application/json')
+            drain_inbox()
+        CallbackInbox.objects.create(checkout_request_id='ws_4', payload=stk_callback('ws_4', result_code=1))
+        drain_inbox()
+
+        incremental = self.rollups()
+        self.assertEqual(len(incremental), 3)
+        rebuild_rollups()
+        self.assertEqual(self.rollups(), incremental)
+        totals = TransactionRollup.objects.filter(user=first).aggregate(Sum('contribution_total'), Sum('failed_count'))
+        self.assertEqual((totals['contribution_total__sum'], totals['failed_count__sum']), (800, 1))
+
+
+class CallbackEndpointTests(TestCase):
+    def setUp(self):
+        self.member = User.objects.create_user(username='member', email='m@example.com', password='pw')
+        self.chama = Chama.objects.create(
+            name='Endpoint Chama', county='Nairobi', phone='254700000000',
+            monthly_contribution=500, created_by=self.member,
+        )
+        for checkout_request_id in ('ws_a', 'ws_b'):
+            MpesaTransaction.objects.create(
+                user=self.member, chama=self.chama, merchant_request_id='m', checkout_request_id=checkout_request_id,
+                amount=500, phone_number='254711000001',
+            )
+
+    def post(self, body):
+        return self.client.post(reverse('payments:callback'), body, content_type='application/json')
+
+    def test_malformed_bodies_are_rejected_without_an_error(self):
+        for body in ('not json', '[1, 2]', '"text"', 'null', '{"Body": null}', '{"Body": {"stkCallback": []}}', b'\xff{'):
+            self.assertEqual(self.post(body).status_code, 400, body)
+        self.assertFalse(CallbackInbox.objects.exists())
+
+    def test_replayed_callback_is_acknowledged_and_dropped(self):
+        self.assertEqual(self.post(stk_callback('ws_a')).json(), {'status': 'ok'})
+        drain_inbox()
+        response = self.post(stk_callback('ws_a'))
+        self.assertEqual((response.status_code, response.json()), (200, {'status': 'ok'}))
+        self.assertEqual(CallbackInbox.objects.count(), 1)
+        self.assertEqual(ledger.balance(self.chama.id), 500)
+
+    def test_duplicate_receipt_settles_only_one_transaction(self):
+        self.post(stk_callback('ws_a', receipt='RKX1'))
+        self.post(stk_callback('ws_b', receipt='RKX1'))
+        drain_inbox()
+        statuses = dict(MpesaTransaction.objects.values_list('checkout_request_id', 'status'))
+        self.assertEqual(statuses, {'ws_a': 'SUCCESS', 'ws_b': 'PENDING'})
+        self.assertEqual(ledger.balance(self.chama.id), 500)
+
+    def test_checkout_and_receipt_numbers_are_unique(self):
+        MpesaTransaction.objects.filter(checkout_request_id='ws_a').update(receipt_number='RKX1')
+        fields = dict(user=self.member, chama=self.chama, merchant_request_id='m', amount=500, phone_number='254711000001')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            MpesaTransaction.objects.create(checkout_request_id='ws_a', **fields)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            MpesaTransaction.objects.create(checkout_request_id='ws_c', receipt_number='RKX1', **fields)
+        # Transactions without a receipt yet do not clash
+        MpesaTransaction.objects.create(checkout_request_id='ws_d', **fields)
+
+
+@override_settings(MPESA_TOKEN_CACHE='mpesa', MPESA_TOKEN_REFRESH_MARGIN=300)
+class AccessTokenTests(TestCase):
+    def setUp(self):
+        isolate_mpesa_cache(self)
+        self.fetches = []
+        self.store = AccessTokenStore('token-tests', self.fetch)
+
+    def fetch(self):
+        self.fetches.append(time.time())
+        time.sleep(0.1)  # long enough for every caller to pile up behind the refresh
+        return {'access_token': f'token{len(self.fetches)}', 'expires_in': '3600'}
+
+    def test_concurrent_callers_share_one_fetch(self):
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(self.store.get())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tokens, ['token1'] * 8)
+        self.assertEqual(len(self.fetches), 1)
+
+    def test_token_is_reused_until_just_before_it_expires(self):
+        now = time.time()
+        with mock.patch('time.time', return_value=now):
+            self.assertEqual(self.store.get(), 'token1')
+        with mock.patch('time.time', return_value=now + 3600 - 301):
+            self.assertEqual(self.store.get(), 'token1')
+        with mock.patch('time.time', return_value=now + 3600 - 299):
+            self.assertEqual(self.store.get(), 'token2')
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_revoked_token_is_refreshed_after_a_401(self):
+        gateway = MpesaGateWay()
+        gateway.breaker.reset()
+        gateway.token_store = self.store
+        revoked = mock.Mock(status_code=401)
+        accepted = mock.Mock(status_code=200, **{'json.return_value': {'ResponseCode': '0'}})
+        with mock.patch.object(gateway.session, 'request', side_effect=[revoked, accepted]) as request:
+            self.assertEqual(gateway.stk_query('ws_1')['ResponseCode'], '0')
+        self.assertEqual(
+            [call.kwargs['headers']['Authorization'] for call in request.call_args_list], ['Bearer token1', 'Bearer token2']
+        )
+        self.assertEqual(len(self.fetches), 2)
 
-# Create your tests here.
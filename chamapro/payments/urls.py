@@ -8,9 +8,14 @@ urlpatterns = [
     path('initiate/', views.initiate_payment, name='initiate_payment'),
     path('contribute/<uuid:chama_id>/', views.initiate_contribution, name='initiate_contribution'),
     path('callback/', views.mpesa_callback, name='callback'),
+    path('b2c/result/', views.b2c_result, name='b2c_result'),
+    path('b2c/timeout/', views.b2c_timeout, name='b2c_timeout'),
     path('subscribe/<uuid:chama_id>/', views.pay_subscription, name='pay_subscription'),
     path('my-contributions/', views.contributions_view, name='contributions'),
     path('chama-contributions/<uuid:chama_id>/', views.chama_contributions_view, name='chama_contributions'),
+    path('chama-contributions/<uuid:chama_id>/export/', views.export_transactions, name='export_transactions'),
+    path('request-contributions/<uuid:chama_id>/', views.request_contributions, name='request_contributions'),
+    path('request-contributions/<uuid:chama_id>/<int:campaign_id>/', views.campaign_progress, name='campaign_progress'),
     path('loans/', views.loans_view, name='loans'),
     path('transactions/', views.transactions_view, name='transactions'),
 ]
\ No newline at end of file
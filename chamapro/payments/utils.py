@@ -1,7 +1,155 @@
+import os
+import time
+import random
+import hashlib
+import threading
 import requests
 import base64
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from django.conf import settings
+from django.core.cache import caches
+from chamapro import profiling
+from .resilience import CircuitBreaker, UpstreamUnavailable, metrics
+
+# Read timeouts in seconds per Daraja endpoint (the connect timeout is shared)
+DEFAULT_READ_TIMEOUTS = {'oauth': 10, 'stk_push': 15, 'stk_query': 10, 'b2c': 20}
+# Gateway-side trouble worth retrying; other error statuses are real answers
+RETRY_STATUSES = {502, 503, 504}
+
+# One keep-alive session per worker process (re-created after a fork)
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# Serialises token refreshes between threads of the same worker
+_token_refresh_lock = threading.Lock()
+
+
+def get_http_session():
+    """Return this worker's pooled requests.Session for Daraja calls"""
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                pool_size = getattr(settings, 'MPESA_HTTP_POOL_SIZE', 20)
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session, _session_pid = session, pid
+    return _session
+
+
+def normalize_phone(phone):
+    """0712345678 -> 254712345678, the form Daraja expects"""
+    phone = phone.strip().replace(' ', '').lstrip('+')
+    if phone.startswith('0'):
+        phone = '254' + phone[1:]
+    return phone
+
+
+class RateLimiter:
+    """
+    Token bucket shared by threads calling Daraja: on average at most `rate`
+    calls per second, with bursts of up to `burst`. A falsy rate means no limit.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst or max(rate or 1, 1)
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self.sleep(wait)
+
+
+class AccessTokenStore:
+    """
+    Daraja OAuth token shared by all workers through the 'mpesa' cache.
+
+    The token is refreshed `MPESA_TOKEN_REFRESH_MARGIN` seconds before it
+    expires. Only one caller refreshes at a time (single-flight): threads wait
+    on a local lock and other processes see the cache lock, keep using the
+    still-valid token and pick up the new one once it lands in the cache.
+    """
+
+    LOCK_TIMEOUT = 15   # seconds a refresh may hold the cross-process lock
+    WAIT_INTERVAL = 0.05
+
+    def __init__(self, consumer_key, fetch):
+        digest = hashlib.sha1(consumer_key.encode()).hexdigest()[:12]
+        self.key = f"mpesa:token:{digest}"
+        self.lock_key = f"{self.key}:refresh"
+        self.fetch = fetch
+        self.cache = caches[getattr(settings, 'MPESA_TOKEN_CACHE', 'default')]
+        self.margin = getattr(settings, 'MPESA_TOKEN_REFRESH_MARGIN', 300)
+
+    def get(self):
+        entry = self.cache.get(self.key)
+        if entry and entry['refresh_at'] > time.time():
+            return entry['access_token']
+        with _token_refresh_lock:
+            return self._refresh()
+
+    def invalidate(self):
+        self.cache.delete(self.key)
+
+    def _refresh(self):
+        # Another thread may have refreshed while we waited for the lock
+        entry = self.cache.get(self.key)
+        if entry and entry['refresh_at'] > time.time():
+            return entry['access_token']
+
+        if not self.cache.add(self.lock_key, os.getpid(), timeout=self.LOCK_TIMEOUT):
+            # Another worker is refreshing: the old token is fine until it expires
+            if entry and entry['expires_at'] > time.time():
+                return entry['access_token']
+            deadline = time.time() + self.LOCK_TIMEOUT
+            while time.time() < deadline:
+                time.sleep(self.WAIT_INTERVAL)
+                entry = self.cache.get(self.key)
+                if entry and entry['expires_at'] > time.time():
+                    return entry['access_token']
+            # The refreshing worker died or stalled; fall through and fetch
+
+        try:
+            data = self.fetch()
+        finally:
+            self.cache.delete(self.lock_key)
+
+        if not data or not data.get('access_token'):
+            if entry and entry['expires_at'] > time.time():
+                return entry['access_token']
+            return None
+
+        now = time.time()
+        expires_in = int(data.get('expires_in') or 3599)
+        entry = {
+            'access_token': data['access_token'],
+            'expires_at': now + expires_in,
+            'refresh_at': now + max(expires_in - self.margin, 0),
+        }
+        self.cache.set(self.key, entry, timeout=expires_in)
+        return entry['access_token']
+
 
 class MpesaGateWay:
     def __init__(self):
@@ -9,32 +157,133 @@ class MpesaGateWay:
         self.consumer_secret = settings.MPESA_CONSUMER_SECRET
         self.shortcode = settings.MPESA_SHORTCODE
         self.passkey = settings.MPESA_PASSKEY
-        self.base_url = "https://sandbox.safaricom.co.ke" if settings.DEBUG else "https://api.safaricom.co.ke"
+        self.base_url = getattr(settings, 'MPESA_BASE_URL', '') or (
+            "https://sandbox.safaricom.co.ke" if settings.DEBUG else "https://api.safaricom.co.ke"
+        )
+        self.session = get_http_session()
+        self.token_store = AccessTokenStore(self.consumer_key, self._fetch_access_token)
+        connect_timeout = getattr(settings, 'MPESA_CONNECT_TIMEOUT', 3.05)
+        read_timeouts = {**DEFAULT_READ_TIMEOUTS, **getattr(settings, 'MPESA_READ_TIMEOUTS', {})}
+        self.timeouts = {endpoint: (connect_timeout, read) for endpoint, read in read_timeouts.items()}
+        self.retries = getattr(settings, 'MPESA_RETRIES', 2)
+        self.backoff = getattr(settings, 'MPESA_RETRY_BACKOFF', 0.25)
+        self.breaker = CircuitBreaker(self.base_url)
 
-    def get_access_token(self):
-        url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
+    def _request(self, endpoint, method, path, idempotent=False, **kwargs):
+        """
+        One Daraja call with the endpoint's (connect, read) timeouts, through
+        the shared circuit breaker. Raises UpstreamUnavailable if it fails.
+
+        Connect timeouts and refused connections are retried for every call,
+        since nothing reached Daraja. Read timeouts, dropped connections and 502/503/504 are only
+        retried when `idempotent`: a repeated STK push or B2C payment could
+        charge or pay a member twice. Retries back off with full jitter so
+        workers that failed together do not retry together.
+        """
+        probe = self.breaker.before_call()
+        sent = False
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, f"{self.base_url}{path}", timeout=self.timeouts[endpoint], **kwargs
+                )
+            except requests.RequestException as e:
+                metrics.observe(endpoint, time.perf_counter() - start)
+                profiling.record_call(endpoint, time.perf_counter() - start, type(e).__name__)
+                error, retryable = self._classify(endpoint, e, idempotent)
+                sent = sent or not self._never_sent(e)
+            else:
+                metrics.observe(endpoint, time.perf_counter() - start)
+                profiling.record_call(endpoint, time.perf_counter() - start, response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.record_success(probe)
+                    return response
+                error, retryable = f"HTTP {response.status_code}", idempotent
+                sent = sent or response.status_code == 504
+            metrics.incr(f'{endpoint}.errors')
+            if not retryable or attempt == self.retries:
+                break
+            metrics.incr(f'{endpoint}.retries')
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+        self.breaker.record_failure(probe)
+        raise UpstreamUnavailable(f"M-Pesa did not respond: {error}", sent=sent)
+
+    @classmethod
+    def _classify(cls, endpoint, error, idempotent):
+        """(error, retryable) for an exception raised by requests"""
+        if isinstance(error, requests.Timeout):
+            metrics.incr(f'{endpoint}.timeouts')
+        return error, idempotent or cls._never_sent(error)
+
+    @staticmethod
+    def _never_sent(error):
+        """
+        True only when no connection was made, so Daraja cannot have seen the
+        request. requests raises ConnectionError for dropped connections
+        (RemoteDisconnected, ProtocolError) too; those may have been sent.
+        """
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        if not isinstance(error, requests.ConnectionError) or not error.args:
+            return False
+        reason = getattr(error.args[0], 'reason', error.args[0])  # MaxRetryError wraps the cause
+        return isinstance(reason, NewConnectionError)
+
+    def _fetch_access_token(self):
         try:
-            response = requests.get(url, auth=(self.consumer_key, self.consumer_secret))
+            response = self._request(
+                'oauth', 'GET', "/oauth/v1/generate?grant_type=client_credentials",
+                idempotent=True, auth=(self.consumer_key, self.consumer_secret),
+            )
             response.raise_for_status()
-            return response.json().get('access_token')
+            return response.json()
         except Exception as e:
             # Log error here
             return None
 
-    def stk_push(self, phone_number, amount, account_reference="ChamaPro", transaction_desc="Payment"):
-        access_token = self.get_access_token()
-        if not access_token:
-            return {"ResponseCode": "1", "ResponseDescription": "Failed to get access token"}
+    def get_access_token(self):
+        return self.token_store.get()
+
+    def _post(self, endpoint, path, payload, idempotent=False):
+        """
+        POST to Daraja with the cached token, retrying once if it was revoked.
+        Daraja's answers come back with Answered: True. Failures carry
+        RequestSent: False (never reached Daraja), True (may have) or None
+        (cannot be told).
+        """
+        for attempt in range(2):
+            access_token = self.get_access_token()
+            if not access_token:
+                return {"ResponseCode": "1", "ResponseDescription": "Failed to get access token", "RequestSent": False}
 
+            headers = {
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": "application/json"
+            }
+            try:
+                response = self._request(endpoint, 'POST', path, idempotent=idempotent, headers=headers, json=payload)
+                if response.status_code == 401 and attempt == 0:
+                    self.token_store.invalidate()
+                    continue
+                data = response.json()
+            except UpstreamUnavailable as e:
+                # RequestSent: False means Daraja never saw it, so it is safe to try again later
+                return {"ResponseCode": "1", "ResponseDescription": str(e), "RequestSent": e.sent}
+            except Exception as e:
+                # e.g. an unreadable body: whether Daraja acted on the request cannot be told
+                return {"ResponseCode": "1", "ResponseDescription": str(e), "RequestSent": None}
+            if not isinstance(data, dict):
+                return {"ResponseCode": "1", "ResponseDescription": "Unexpected response from M-Pesa", "RequestSent": None}
+            # Daraja's own answer: its ResponseCode (or errorCode) is final
+            return {**data, "RequestSent": True, "Answered": True}
+
+    def stk_push(self, phone_number, amount, account_reference="ChamaPro", transaction_desc="Payment"):
         timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
         password_str = f"{self.shortcode}{self.passkey}{timestamp}"
         password = base64.b64encode(password_str.encode()).decode('utf-8')
 
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
             "BusinessShortCode": self.shortcode,
             "Password": password,
@@ -49,27 +298,29 @@ class MpesaGateWay:
             "TransactionDesc": transaction_desc
         }
 
-        url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
-        try:
-            response = requests.post(url, headers=headers, json=payload)
-            return response.json()
-        except Exception as e:
-            return {"ResponseCode": "1", "ResponseDescription": str(e)}
+        return self._post('stk_push', "/mpesa/stkpush/v1/processrequest", payload)
+
+    def stk_query(self, checkout_request_id):
+        """Ask Daraja for the outcome of an STK push whose callback never arrived"""
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password_str = f"{self.shortcode}{self.passkey}{timestamp}"
+        password = base64.b64encode(password_str.encode()).decode('utf-8')
+
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id
+        }
 
-    def disburse_funds(self, phone_number, amount, remarks="Loan Disbursement"):
+        # A status read: safe to retry
+        return self._post('stk_query', "/mpesa/stkpushquery/v1/query", payload, idempotent=True)
+
+    def disburse_funds(self, phone_number, amount, remarks="Loan Disbursement", occasion="Loan"):
         """
         B2C API to send money from Chama to Member (e.g., Loans, Dividends)
         Requires MPESA_INITIATOR_NAME and MPESA_SECURITY_CREDENTIAL in settings
         """
-        access_token = self.get_access_token()
-        if not access_token:
-            return {"ResponseCode": "1", "ResponseDescription": "Failed to get access token"}
-
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
             "InitiatorName": getattr(settings, 'MPESA_INITIATOR_NAME', 'testapi'),
             "SecurityCredential": getattr(settings, 'MPESA_SECURITY_CREDENTIAL', 'your_encrypted_credential'),
@@ -80,12 +331,7 @@ class MpesaGateWay:
             "Remarks": remarks,
             "QueueTimeOutURL": f"{settings.MPESA_CALLBACK_URL}/payments/b2c/timeout/",
             "ResultURL": f"{settings.MPESA_CALLBACK_URL}/payments/b2c/result/",
-            "Occasion": "Loan"
+            "Occasion": occasion
         }
-        
-        url = f"{self.base_url}/mpesa/b2c/v1/paymentrequest"
-        try:
-            response = requests.post(url, headers=headers, json=payload)
-            return response.json()
-        except Exception as e:
-            return {"ResponseCode": "1", "ResponseDescription": str(e)}
\ No newline at end of file
+
+        return self._post('b2c', "/mpesa/b2c/v1/paymentrequest", payload)
@@ -1,16 +1,25 @@
 import json
-from datetime import timedelta
-from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponse, JsonResponse
+from django.shortcuts import render, redirect, get_object_or_404
+from django.contrib import messages
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
-from django.db.models import F, Sum
+from django.db.models import Sum
 from django.contrib.auth import get_user_model
-from .utils import MpesaGateWay
-from .models import MpesaTransaction
-from chama.models import Chama, Penalty
+from .utils import MpesaGateWay, normalize_phone
+from .models import MpesaTransaction, CallbackInbox, TransactionRollup, ContributionCampaign
+from .rollups import record_created
+from .disbursements import apply_b2c_result
+from .callbacks import stk_callback_of
+from .exports import csv_lines, export_queryset
+from .forms import ExportFilterForm
+from chama.models import Penalty
+from chama.membership import ADMIN, MEMBER, chama_access
+from chama.obligations import get_obligation
+from chama.penalties import period_reason
+from chamapro.metrics import registry
 
 @login_required
 def initiate_payment(request):
@@ -26,27 +35,26 @@ def initiate_payment(request):
         transaction_user = request.user
         
         # Normalize phone for lookup (e.g., 0712... to 254712...)
-        clean_phone = phone.strip()
-        if clean_phone.startswith('0'):
-            clean_phone = '254' + clean_phone[1:]
+        clean_phone = normalize_phone(phone)
         
         user_by_phone = User.objects.filter(phone_number=clean_phone).first()
         if user_by_phone:
             transaction_user = user_by_phone
 
         gateway = MpesaGateWay()
-        response = gateway.stk_push(phone, amount, account_reference="Contribution")
+        response = gateway.stk_push(clean_phone, amount, account_reference="Contribution")
         
         if response.get('ResponseCode') == '0':
-            MpesaTransaction.objects.create(
+            transaction = MpesaTransaction.objects.create(
                 user=transaction_user,
                 transaction_type='CONTRIBUTION',
                 merchant_request_id=response.get('MerchantRequestID'),
                 checkout_request_id=response.get('CheckoutRequestID'),
                 amount=amount,
-                phone_number=phone,
+                phone_number=clean_phone,
                 status='PENDING'
             )
+            record_created([transaction])
             return JsonResponse(response)
         else:
             return JsonResponse(response, status=400)
@@ -54,49 +62,32 @@ def initiate_payment(request):
     return render(request, 'payments/initiate.html')
 
 @login_required
+@chama_access(role=MEMBER)
 def initiate_contribution(request, chama_id):
-    chama = get_object_or_404(Chama, id=chama_id)
+    chama = request.chama
     
     # --- PENALTY CHECK LOGIC ---
-    today = timezone.now().date()
-    
-    # 1. Check if user is late for MONTHLY contribution
-    if chama.contribution_frequency == 'MONTHLY' and chama.contribution_day:
-        # Construct due date for this month
-        try:
-            due_date = today.replace(day=chama.contribution_day)
-        except ValueError:
-            due_date = today.replace(day=28) # Fallback for short months
-            
-        cutoff_date = due_date + timedelta(days=chama.penalty_grace_period)
-        
-        # If today is past the cutoff (Grace period over)
-        if today > cutoff_date:
-            # Check if they have paid for this month
-            has_paid = MpesaTransaction.objects.filter(
-                user=request.user,
-                chama=chama,
-                transaction_type='CONTRIBUTION',
-                status='SUCCESS',
-                transaction_date__month=today.month,
-                transaction_date__year=today.year
-            ).exists()
-            
-            if not has_paid:
-                # Create penalty if it doesn't exist yet
-                reason = f"Late Contribution: {today.strftime('%B %Y')}"
-                Penalty.objects.get_or_create(
-                    user=request.user,
-                    chama=chama,
-                    reason=reason,
-                    defaults={'amount': chama.penalty_amount}
-                )
-
-    # 2. Calculate Total Due (Contribution + Unpaid Penalties)
+    # The nightly `assess_penalties` job covers everyone; this catches a late
+    # member who visits before it has run.
+    today = timezone.localdate()
+    obligation = get_obligation(chama, request.user, today)
+    cutoff_date = chama.penalty_cutoff(obligation.period_start)
+
+    # If today is past the cutoff (Grace period over) and nothing was paid this period
+    if cutoff_date and today > cutoff_date and obligation.status == 'DUE':
+        # Create penalty if it doesn't exist yet
+        Penalty.objects.get_or_create(
+            user=request.user,
+            chama=chama,
+            period=obligation.period_start,
+            defaults={'amount': chama.penalty_amount, 'reason': period_reason(chama, obligation.period_start)}
+        )
+
+    # 2. Calculate Total Due (Outstanding Contribution + Unpaid Penalties)
     unpaid_penalties = Penalty.objects.filter(user=request.user, chama=chama, is_paid=False)
     penalty_total = sum(p.amount for p in unpaid_penalties)
     
-    suggested_amount = chama.monthly_contribution + penalty_total
+    suggested_amount = (obligation.outstanding or chama.monthly_contribution) + penalty_total
     
     # Allow pre-filling amount from query params (e.g. ?amount=500)
     initial_amount = request.GET.get('amount', suggested_amount)
@@ -113,9 +104,7 @@ def initiate_contribution(request, chama_id):
         transaction_user = request.user
         
         # Normalize phone for lookup
-        clean_phone = phone.strip()
-        if clean_phone.startswith('0'):
-            clean_phone = '254' + clean_phone[1:]
+        clean_phone = normalize_phone(phone)
             
         user_by_phone = User.objects.filter(phone_number=clean_phone).first()
         if user_by_phone:
@@ -124,19 +113,20 @@ def initiate_contribution(request, chama_id):
         gateway = MpesaGateWay()
         # Use Chama Name as reference (truncated to 12 chars for API limits)
         account_ref = chama.name[:12].replace(" ", "")
-        response = gateway.stk_push(phone, amount, account_reference=account_ref)
+        response = gateway.stk_push(clean_phone, amount, account_reference=account_ref)
         
         if response.get('ResponseCode') == '0':
-            MpesaTransaction.objects.create(
+            transaction = MpesaTransaction.objects.create(
                 user=transaction_user,
                 chama=chama,
                 transaction_type='CONTRIBUTION',
                 merchant_request_id=response.get('MerchantRequestID'),
                 checkout_request_id=response.get('CheckoutRequestID'),
                 amount=amount,
-                phone_number=phone,
+                phone_number=clean_phone,
                 status='PENDING'
             )
+            record_created([transaction])
             return redirect('chama:chama_detail', slug=chama.slug, pk=chama.id)
         else:
             return render(request, 'payments/contribution_form.html', {'chama': chama, 'error': response.get('ResponseDescription', 'Payment Failed'), 'initial_amount': amount, 'penalties': unpaid_penalties, 'penalty_total': penalty_total})
@@ -144,9 +134,10 @@ def initiate_contribution(request, chama_id):
     return render(request, 'payments/contribution_form.html', {'chama': chama, 'initial_amount': initial_amount, 'penalties': unpaid_penalties, 'penalty_total': penalty_total})
 
 @login_required
+@chama_access(role=MEMBER)
 def pay_subscription(request, chama_id):
     """View to handle monthly subscription payments"""
-    chama = get_object_or_404(Chama, id=chama_id)
+    chama = request.chama
     
     # Determine amount based on plan
     amount = 0
@@ -165,9 +156,7 @@ def pay_subscription(request, chama_id):
             return render(request, 'payments/pay_subscription.html', {'chama': chama, 'amount': amount, 'error': 'Phone number is required'})
 
         # Normalize phone
-        clean_phone = phone.strip()
-        if clean_phone.startswith('0'):
-            clean_phone = '254' + clean_phone[1:]
+        clean_phone = normalize_phone(phone)
 
         gateway = MpesaGateWay()
         account_ref = f"SUB-{chama.name[:8]}".replace(" ", "")
@@ -176,7 +165,7 @@ def pay_subscription(request, chama_id):
         response = gateway.stk_push(clean_phone, amount, account_reference=account_ref, transaction_desc=f"Subscription for {chama.name}")
         
         if response.get('ResponseCode') == '0':
-            MpesaTransaction.objects.create(
+            transaction = MpesaTransaction.objects.create(
                 user=request.user,
                 chama=chama,
                 transaction_type='SUBSCRIPTION',
@@ -187,6 +176,7 @@ def pay_subscription(request, chama_id):
                 status='PENDING',
                 description=f"Monthly {chama.subscription_plan} Subscription"
             )
+            record_created([transaction])
             # Show success message or redirect to a waiting page
             return render(request, 'payments/pay_subscription.html', {
                 'chama': chama, 
@@ -202,69 +192,60 @@ def pay_subscription(request, chama_id):
 @csrf_exempt
 @require_POST
 def mpesa_callback(request):
-    print("--- M-PESA CALLBACK RECEIVED ---")
+    """
+    Append the raw callback to the inbox and acknowledge at once.
+    The `process_callbacks` worker applies it (see payments.callbacks).
+    """
     try:
-        data = json.loads(request.body)
-        # print(f"Payload: {data}") # Uncomment to see full data
-    except json.JSONDecodeError:
-        print("Error: Invalid JSON received")
+        stk_callback = stk_callback_of(json.loads(request.body))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        stk_callback = None
+    if stk_callback is None:
+        # Not JSON, or not {"Body": {"stkCallback": {...}}}: a retry would not fix it
+        registry.event('mpesa_callbacks', kind='stk', outcome='invalid')
         return JsonResponse({'status': 'error'}, status=400)
 
-    stk_callback = data.get('Body', {}).get('stkCallback', {})
-    
-    checkout_request_id = stk_callback.get('CheckoutRequestID')
-    result_code = stk_callback.get('ResultCode')
-    result_desc = stk_callback.get('ResultDesc')
-    
-    print(f"Processing ID: {checkout_request_id} | Code: {result_code} | Desc: {result_desc}")
-    
-    try:
-        transaction = MpesaTransaction.objects.get(checkout_request_id=checkout_request_id)
-        if result_code == 0:
-            transaction.status = 'SUCCESS'
-            transaction.description = "Payment Successful"
-            items = stk_callback.get('CallbackMetadata', {}).get('Item', [])
-            for item in items:
-                if item.get('Name') == 'MpesaReceiptNumber':
-                    transaction.receipt_number = item.get('Value')
-                elif item.get('Name') == 'PhoneNumber':
-                    transaction.phone_number = str(item.get('Value'))
-            
-            # --- HANDLE SUBSCRIPTION RENEWAL ---
-            if transaction.transaction_type == 'SUBSCRIPTION' and transaction.chama:
-                chama = transaction.chama
-                # Extend expiry by 30 days from now (or from current expiry if valid)
-                if chama.subscription_expiry and chama.subscription_expiry > timezone.now():
-                    chama.subscription_expiry += timedelta(days=30)
-                else:
-                    chama.subscription_expiry = timezone.now() + timedelta(days=30)
-                chama.subscription_status = 'ACTIVE'
-                chama.save()
-
-            # --- AUTO-CLEAR PENALTIES ---
-            # If payment is successful, check if we can clear penalties
-            elif transaction.transaction_type == 'CONTRIBUTION' and transaction.chama and transaction.user:
-                # Update Chama Total Balance
-                Chama.objects.filter(id=transaction.chama.id).update(
-                    total_balance=F('total_balance') + transaction.amount
-                )
-                
-                unpaid_penalties = Penalty.objects.filter(user=transaction.user, chama=transaction.chama, is_paid=False)
-                for penalty in unpaid_penalties:
-                    # Simple logic: If they paid enough, assume they cleared the penalty
-                    penalty.is_paid = True
-                    penalty.paid_at = timezone.now()
-                    penalty.save()
-        else:
-            transaction.status = 'FAILED'
-            transaction.description = result_desc # Save the failure reason (e.g., Cancelled by user)
-        transaction.save()
-        print(f"Transaction updated to: {transaction.status}")
-    except MpesaTransaction.DoesNotExist:
-        print("Error: Transaction not found for this CheckoutRequestID")
-    
+    checkout_request_id = str(stk_callback.get('CheckoutRequestID') or '')
+
+    # Safaricom retries callbacks: a settled transaction means this is a replay,
+    # unless reconciliation settled it without the receipt this one carries
+    settled = MpesaTransaction.objects.filter(checkout_request_id=checkout_request_id).exclude(status='PENDING')
+    if settled.exclude(status='SUCCESS', receipt_number__isnull=True).exists():
+        registry.event('mpesa_callbacks', kind='stk', outcome='replay')
+        return JsonResponse({'status': 'ok'})
+
+    CallbackInbox.objects.create(
+        checkout_request_id=checkout_request_id[:100],
+        payload=request.body.decode('utf-8', 'replace'),
+    )
+    registry.event('mpesa_callbacks', kind='stk', outcome='queued')
     return JsonResponse({'status': 'ok'})
 
+def _b2c_notification(request, timed_out):
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        registry.event('mpesa_callbacks', kind='b2c', outcome='invalid')
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Invalid JSON'}, status=400)
+    status = apply_b2c_result(data, timed_out=timed_out)
+    # None: a replay, or a conversation no DISBURSING loan is waiting on
+    registry.event(
+        'mpesa_callbacks', kind='b2c_timeout' if timed_out else 'b2c', outcome=(status or 'ignored').lower()
+    )
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
+@csrf_exempt
+@require_POST
+def b2c_result(request):
+    """Daraja's ResultURL for loan disbursements: the payment went through or failed"""
+    return _b2c_notification(request, timed_out=False)
+
+@csrf_exempt
+@require_POST
+def b2c_timeout(request):
+    """Daraja's QueueTimeOutURL: the B2C request expired unprocessed, so the loan failed"""
+    return _b2c_notification(request, timed_out=True)
+
 def home_view(request):
     """Temporary home view for payments app"""
     return HttpResponse("""
@@ -302,19 +283,19 @@ def contributions_view(request):
     return render(request, 'payments/contributions.html', context)
 
 @login_required
+@chama_access(role=MEMBER)
 def chama_contributions_view(request, chama_id):
     """View to show total contributions for all members in a specific Chama"""
-    chama = get_object_or_404(Chama, id=chama_id)
+    chama = request.chama
     
-    # Group by user and sum their successful contributions
-    member_contributions = MpesaTransaction.objects.filter(
+    # Group by user and sum their successful contributions (from the monthly rollup)
+    member_contributions = TransactionRollup.objects.filter(
         chama=chama,
-        transaction_type='CONTRIBUTION',
-        status='SUCCESS'
+        contribution_count__gt=0
     ).values(
         'user__username', 'user__first_name', 'user__last_name', 'user__email'
     ).annotate(
-        total_amount=Sum('amount')
+        total_amount=Sum('contribution_total')
     ).order_by('-total_amount')
     
     return render(request, 'payments/chama_contributions.html', {
@@ -322,6 +303,65 @@ def chama_contributions_view(request, chama_id):
         'member_contributions': member_contributions
     })
 
+@login_required
+@chama_access(role=ADMIN)
+@require_POST
+def request_contributions(request, chama_id):
+    """Admin action: queue an STK push to every member who still owes for this period"""
+    chama = request.chama
+    active = ContributionCampaign.objects.filter(chama=chama, status__in=['QUEUED', 'RUNNING']).exists()
+    if active:
+        messages.info(request, "A contribution request is already being sent to members.")
+    else:
+        ContributionCampaign.objects.create(chama=chama, created_by=request.user)
+        messages.success(request, "Contribution requests are being sent to all members.")
+    return redirect('chama:chama_detail', slug=chama.slug, pk=chama.id)
+
+@login_required
+@chama_access(role=ADMIN)
+def campaign_progress(request, chama_id, campaign_id):
+    """Progress of a contribution request campaign, polled by the chama page"""
+    campaign = get_object_or_404(ContributionCampaign, id=campaign_id, chama=request.chama)
+    return JsonResponse({
+        'status': campaign.status,
+        'total': campaign.total,
+        'sent': campaign.sent,
+        'failed': campaign.failed,
+        'skipped': campaign.skipped,
+    })
+
+@login_required
+@chama_access(role=MEMBER)
+def export_transactions(request, chama_id):
+    """
+    Stream the chama's transactions as CSV. Members get their own statement;
+    the admin gets every member's rows, or one member's with ?member=<id>.
+    Filters: ?start=&end= (YYYY-MM-DD, inclusive), ?type=, ?status=.
+    """
+    chama = request.chama
+    form = ExportFilterForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    filters = form.cleaned_data
+
+    member_id = filters['member']
+    if request.chama_role != ADMIN:
+        member_id = request.user.pk
+
+    rows = export_queryset(
+        chama=chama,
+        user_id=member_id,
+        start=filters['start'],
+        end=filters['end'],
+        transaction_type=filters['type'],
+        status=filters['status'],
+    )
+    kind = 'transactions' if member_id is None else f'statement-{member_id}'
+    filename = f"{chama.slug}-{kind}-{timezone.localdate():%Y%m%d}.csv"
+    response = StreamingHttpResponse(csv_lines(rows), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
 def loans_view(request):
     """Loans page"""
     return HttpResponse("Loans page - Coming soon")